@@ -0,0 +1,186 @@
+import argparse
+import email
+import email.message
+import email.policy
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+import easy.features
+import benchmarks.corpus
+
+
+# Benchmark of easy.features.evaluate over a synthetic corpus.
+#
+#   python -m benchmarks.bench_features --save-baseline baseline.json
+#   python -m benchmarks.bench_features --baseline baseline.json --threshold 0.2
+#
+# Exits with status 1 when a whole-run metric (throughput, memory) is worse
+# than the baseline by more than threshold (a fraction). Feature times are
+# too short to be stable, slower ones are reported without failing.
+# Baselines only make sense on the same host.
+
+
+def parse(raw: bytes) -> email.message.EmailMessage:
+    return email.message_from_bytes(raw, policy=email.policy.default)
+
+
+def bench_throughput(raws: list[bytes], repeat: int) -> dict:
+    # best of repeat runs, parse and evaluate timed separately
+    best_parse = best_evaluate = float('inf')
+    for _ in range(repeat):
+        parse_time = evaluate_time = 0.0
+        for raw in raws:
+            t0 = time.perf_counter()
+            msg = parse(raw)
+            t1 = time.perf_counter()
+            easy.features.evaluate(msg)
+            t2 = time.perf_counter()
+            parse_time += t1 - t0
+            evaluate_time += t2 - t1
+        best_parse = min(best_parse, parse_time)
+        best_evaluate = min(best_evaluate, evaluate_time)
+    return {
+        'msgs_per_sec': len(raws) / (best_parse + best_evaluate),
+        'evaluate_msgs_per_sec': len(raws) / best_evaluate,
+        'parse_msgs_per_sec': len(raws) / best_parse,
+    }
+
+
+def bench_features(raws: list[bytes], repeat: int) -> dict[str, float]:
+    # mean seconds per message of every feature computation, as profiled
+    # by evaluate, best of repeat runs for each feature. 'body_analysis' is
+    # shared by every body feature.
+    best: dict[str, float] = {}
+    msgs = [parse(raw) for raw in raws]
+    for _ in range(repeat):
+        totals: dict[str, float] = {}
+        for msg in msgs:
+            profile = {}
+            try:
+                easy.features._evaluate(msg, profile)
+            except Exception:
+                # evaluate would return None, features computed so far are timed
+                pass
+            for name, seconds in profile.items():
+                totals[name] = totals.get(name, 0.0) + seconds
+        for name, t in totals.items():
+            best[name] = min(best.get(name, float('inf')), t / len(raws))
+    return best
+
+
+def bench_memory(raws: list[bytes]) -> dict[str, float]:
+    # peak memory allocated while parsing and evaluating a message
+    peaks = []
+    tracemalloc.start()
+    try:
+        for raw in raws:
+            tracemalloc.reset_peak()
+            base, _ = tracemalloc.get_traced_memory()
+            easy.features.evaluate(parse(raw))
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append((peak - base) / len(raw))
+    finally:
+        tracemalloc.stop()
+    return {
+        'peak_per_msg_byte_mean': statistics.mean(peaks),
+        'peak_per_msg_byte_max': max(peaks),
+    }
+
+
+def run(args) -> dict:
+    raws = list(benchmarks.corpus.generate(args.messages, seed=args.seed, kinds=args.kinds))
+    return {
+        'corpus': {
+            'messages': len(raws),
+            'bytes': sum(map(len, raws)),
+            'seed': args.seed,
+            'kinds': args.kinds,
+        },
+        'host': {'python': platform.python_version(), 'machine': platform.machine()},
+        'throughput': bench_throughput(raws, args.repeat),
+        'features': bench_features(raws, args.repeat),
+        'memory': bench_memory(raws),
+    }
+
+
+def compare(result: dict, baseline: dict, threshold: float) -> list[str]:
+    # returns regressions of whole-run metrics, higher is better for
+    # throughput, lower for memory
+    regressions = []
+    if result['corpus'] != baseline['corpus']:
+        regressions.append('corpus differs from baseline, results are not comparable')
+        return regressions
+    for name, value in result['throughput'].items():
+        base = baseline['throughput'].get(name)
+        if base and value < base * (1 - threshold):
+            regressions.append(f'{name}: {value:.1f} < {base:.1f}')
+    for name, value in result['memory'].items():
+        base = baseline['memory'].get(name)
+        if base and value > base * (1 + threshold):
+            regressions.append(f'{name}: {value:.2f} > {base:.2f}')
+    return regressions
+
+
+def slower_features(result: dict, baseline: dict, threshold: float) -> list[str]:
+    # features slower than the baseline, informative only
+    if result['corpus'] != baseline['corpus']:
+        return []
+    slower = []
+    evaluate_time = sum(baseline['features'].values())
+    for name, value in result['features'].items():
+        base = baseline['features'].get(name)
+        # features taking less than 1% of evaluate are just noise
+        if not base or base < evaluate_time * 0.01:
+            continue
+        if value > base * (1 + threshold):
+            slower.append(f'{name}: {value * 1e6:.1f}us > {base * 1e6:.1f}us')
+    return slower
+
+
+def print_report(result: dict):
+    corpus = result['corpus']
+    print(f"corpus: {corpus['messages']} messages, {corpus['bytes'] / 1e6:.1f} MB, seed {corpus['seed']}")
+    for name, value in result['throughput'].items():
+        print(f'{name:>28}: {value:10.1f}')
+    print('feature time per message:')
+    total = sum(result['features'].values())
+    for name, value in sorted(result['features'].items(), key=lambda i: -i[1]):
+        print(f'{name:>28}: {value * 1e6:10.1f}us {value / total:6.1%}')
+    print('peak memory / message size:')
+    for name, value in result['memory'].items():
+        print(f'{name:>28}: {value:10.2f}')
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.bench_features')
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--kinds', nargs='+', choices=benchmarks.corpus._kinds)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', help='compare results to a saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    parser.add_argument('--save-baseline', help='save results as baseline')
+    args = parser.parse_args(argv)
+    result = run(args)
+    print_report(result)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as fp:
+            json.dump(result, fp, indent=4)
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        for s in slower_features(result, baseline, args.threshold):
+            print('slower feature:', s)
+        regressions = compare(result, baseline, args.threshold)
+        for r in regressions:
+            print('regression:', r)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,145 @@
+import typing
+import random
+import email.message
+import email.policy
+import email.utils
+
+
+# Deterministic generator of synthetic messages, the same seed always
+# yields the same bytes. Message kinds and their weights:
+#   plain       short text/plain, human-like
+#   newsletter  large html (style, tables, tracking links) with text alternative
+#   nested      multipart/mixed > alternative > related, inline images,
+#               forwarded message/rfc822
+#   attachment  text with big base64 attachments (pdf/zip)
+
+_kinds = ['plain', 'newsletter', 'nested', 'attachment']
+_weights = [4, 3, 2, 1]
+
+_words = (
+    'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod '
+    'tempor incididunt ut labore et dolore magna aliqua offer sale account '
+    'order invoice meeting tomorrow thanks regards update newsletter free'
+).split()
+
+_services = ['shop.example.com', 'news.example.org', 'mail.service.io', 'deals.example.net']
+_people = ['alice@example.com', 'bob@example.org', 'carol@mail.example.net']
+
+
+def generate(
+    n: int, *, seed: int = 0, kinds: list[str] | None = None
+) -> typing.Generator[bytes, None, None]:
+    r = random.Random(seed)
+    for i in range(n):
+        kind = r.choices(kinds or _kinds, weights=None if kinds else _weights)[0]
+        msg = _make(kind, i, r)
+        # generated boundaries would be random
+        for k, part in enumerate(msg.walk()):
+            if part.is_multipart() and part.get_content_maintype() == 'multipart':
+                part.set_boundary(f'=_{i}.{k}_=')
+        yield msg.as_bytes(policy=email.policy.SMTP)
+
+
+def _make(kind: str, i: int, r: random.Random) -> email.message.EmailMessage:
+    match kind:
+        case 'plain':
+            return _plain(i, r)
+        case 'newsletter':
+            return _newsletter(i, r)
+        case 'nested':
+            return _nested(i, r)
+        case 'attachment':
+            return _attachment(i, r)
+    raise ValueError(f"unknown message kind: {kind}")
+
+
+def _headers(msg: email.message.EmailMessage, i: int, r: random.Random, sender: str):
+    msg['Message-ID'] = f'<{i}.{r.randrange(10**9)}@{sender.split("@")[1]}>'
+    # fixed epoch, dates must not depend on when the corpus is generated
+    msg['Date'] = email.utils.formatdate(1_700_000_000 + i * 3600, usegmt=True)
+    msg['From'] = sender
+    msg['To'] = ', '.join(r.sample(_people, r.randint(1, len(_people))))
+    msg['Subject'] = _text(r, 6)
+
+
+def _text(r: random.Random, n: int) -> str:
+    return ' '.join(r.choice(_words) for _ in range(n))
+
+
+def _paragraphs(r: random.Random, n: int) -> str:
+    return '\n\n'.join(_text(r, r.randint(20, 80)) for _ in range(n))
+
+
+def _plain(i: int, r: random.Random) -> email.message.EmailMessage:
+    msg = email.message.EmailMessage()
+    _headers(msg, i, r, r.choice(_people))
+    msg.set_content(_paragraphs(r, r.randint(1, 6)))
+    return msg
+
+
+def _html(r: random.Random, domain: str, size: int) -> str:
+    # about size characters of newsletter-like html
+    rows = []
+    length = 0
+    while length < size:
+        link = f'https://{r.choice([domain, "www." + domain, "tracker.example.com"])}/c/{r.randrange(10**6)}'
+        row = (
+            f'<tr><td style="padding:8px;font-family:Arial,sans-serif;color:#{r.randrange(16**6):06x}">'
+            f'<a href="{link}" style="text-decoration:none">{_text(r, 4)}</a>'
+            f'<p>{_text(r, r.randint(10, 40))}</p></td></tr>\n'
+        )
+        rows.append(row)
+        length += len(row)
+    return (
+        '<html>\n<head>\n<style>\n'
+        + 'td { border: 0; } p { margin: 0 0 8px 0; line-height: 1.4; }\n' * 20
+        + '</style>\n</head>\n<body>\n<table width="600">\n'
+        + ''.join(rows)
+        + '</table>\n'
+        + f'<a href="mailto:unsubscribe@{domain}">unsubscribe</a>\n'
+        + '</body>\n</html>\n'
+    )
+
+
+def _newsletter(i: int, r: random.Random) -> email.message.EmailMessage:
+    msg = email.message.EmailMessage()
+    domain = r.choice(_services)
+    _headers(msg, i, r, f'news@{domain}')
+    msg['List-Unsubscribe'] = f'<https://{domain}/unsubscribe>'
+    msg['Feedback-ID'] = f'{r.randrange(10**6)}:campaign:{domain}'
+    msg['X-Mailer'] = 'bulk-mailer 1.0'
+    msg.set_content(_paragraphs(r, 3))
+    msg.add_alternative(_html(r, domain, r.choice([20_000, 80_000, 200_000])), subtype='html')
+    return msg
+
+
+def _nested(i: int, r: random.Random) -> email.message.EmailMessage:
+    msg = email.message.EmailMessage()
+    domain = r.choice(_services)
+    _headers(msg, i, r, f'info@{domain}')
+    msg['Reply-To'] = f'support@{domain}'
+    msg.set_content(_paragraphs(r, 2))
+    msg.add_alternative(_html(r, domain, 10_000), subtype='html')
+    html_part = msg.get_payload()[1]
+    for _ in range(r.randint(1, 3)):
+        html_part.add_related(
+            r.randbytes(r.randint(2_000, 30_000)),
+            maintype='image', subtype='png', cid=f'<img{r.randrange(10**6)}@{domain}>'
+        )
+    forwarded = _plain(i, r)
+    msg.add_attachment(forwarded)
+    return msg
+
+
+def _attachment(i: int, r: random.Random) -> email.message.EmailMessage:
+    msg = email.message.EmailMessage()
+    _headers(msg, i, r, r.choice(_people))
+    msg.set_content(_paragraphs(r, 1))
+    for _ in range(r.randint(1, 2)):
+        subtype = r.choice(['pdf', 'zip'])
+        msg.add_attachment(
+            r.randbytes(r.choice([100_000, 1_000_000, 4_000_000])),
+            maintype='application', subtype=subtype,
+            filename=f'document{r.randrange(100)}.{subtype}'
+        )
+    return msg
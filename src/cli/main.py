@@ -1,22 +1,43 @@
+import time
+# start of the CLI, reported by --timings
+_started = time.perf_counter()
 import sys
+import os
 import json
+import typing
+import functools
 import pathlib
-from requests_oauthlib import OAuth2Session
 import cli.userdata
-import easy.auth
-import easy.email
-import email.message
-import easy.features
+# option choices, cheap to import
+import easy.archive
 import click
-import mailbox
 
+if typing.TYPE_CHECKING:
+    # annotations only: modules are imported by the commands needing them,
+    # requests_oauthlib (easy.auth) and imaplib (easy.email) are slow to import
+    import email.message
+    import easy.auth
+    import easy.email
+    import easy.features
+    import easy.cache
+    import easy.mbox
+    import easy.profiling
 
-class OauthProviderConf(easy.auth.OAuthConf, easy.email.ImapConf):
-    pass
+    class OauthProviderConf(easy.auth.OAuthConf, easy.email.ImapConf):
+        pass
+
+
+    class ProviderConf(OauthProviderConf):
+        domains: list[str]
+        # limits shared by accounts of the provider (download-all)
+        max_connections: typing.NotRequired[int]
+        # FETCH commands per second
+        max_fetch_rate: typing.NotRequired[float]
 
 
-class ProviderConf(OauthProviderConf):
-    domains: list[str]
+_provider_required = [
+    'auth_uri', 'token_uri', 'client_id', 'scopes', 'redirect_uri', 'imap_server', 'imap_port', 'domains'
+]
 
 
 def load_json_from_file(filename) -> any:
@@ -28,37 +49,43 @@ def load_json_from_file(filename) -> any:
         return None
 
 
-def load_provider_confs() -> list[ProviderConf]:
+def load_provider_confs() -> list['ProviderConf']:
     provider_confs = []
     conf_dir = cli.userdata.get_system_appconfig_path()
     for conf_file in conf_dir.glob('*.json'):
             conf: ProviderConf = load_json_from_file(conf_file)
-            # validation ?
-            #provider_conf: ProviderConf = {
-            #    # OAuth fields
-            #    'auth_uri': conf['auth_uri'],
-            #    'token_uri': conf['token_uri'],
-            #    'refresh_uri': conf.get('refresh_uri'),  # Optional field
-            #    'client_id': conf['client_id'],
-            #    'scopes': conf['scopes'],
-            #    'client_secret': conf.get('client_secret'),  # Optional field
-            #    'redirect_uri': conf['redirect_uri'],
-            #    # IMAP fields
-            #    'imap_server': conf['imap_server'],
-            #    'imap_port': conf['imap_port'],
-            #    # Other fields
-            #    'domains': conf['domains']
-            #}
+            missing = [k for k in _provider_required if not isinstance(conf, dict) or k not in conf]
+            if missing:
+                raise click.ClickException(f"invalid provider configuration {conf_file}: missing {', '.join(missing)}")
             provider_confs.append(conf)
     return provider_confs
 
 
-def map_provider_conf_by_domain() -> dict[str, ProviderConf]:
-    provider_confs = load_provider_confs()
+def map_provider_conf_by_domain() -> dict[str, 'ProviderConf']:
+    # cached in the user data directory along with modification times and
+    # sizes of configuration files, rebuilt when any of them changes, is
+    # added or removed
+    conf_dir = cli.userdata.get_system_appconfig_path()
+    stamps = {
+        p.name: [st.st_mtime_ns, st.st_size]
+        for p in conf_dir.glob('*.json') for st in [p.stat()]
+    }
+    cache_path = cli.userdata.get_system_userdata_path() / 'providers-cache.json'
+    try:
+        cache = load_json_from_file(cache_path)
+    except ValueError:
+        cache = None
+    if cache is not None and cache.get('stamps') == stamps:
+        return cache['domains']
     mapping = {}
-    for provider_conf in provider_confs:
+    for provider_conf in load_provider_confs():
         for domain in provider_conf['domains']:
             mapping[domain] = provider_conf
+    # written whole or not at all, concurrent runs may rebuild it
+    tmp_path = cache_path.with_name(f'{cache_path.name}.{os.getpid()}')
+    with open(tmp_path, 'w') as f:
+        json.dump({'stamps': stamps, 'domains': mapping}, f)
+    os.replace(tmp_path, cache_path)
     return mapping
 
 
@@ -68,25 +95,160 @@ def prompt_auth_url_cli(auth_url: str) -> str:
     return auth_res
 
            
-def configure_inbox(ctx, *, provider=None, user=None, path=None):
+def configure_inbox(
+    ctx, 
+    *, 
+    provider=None, 
+    user=None, 
+    path=None, 
+    checkpoints=None, 
+    connections=1, 
+    ordered=True,
+    save_index=False,
+    search=None,
+    folders=(),
+    store=None,
+    identities=None
+):
+    import easy.email
+    if store:
+        if path or user or folders:
+            raise click.UsageError('--store cannot be combined with --mbox, --folder or an account')
+        import easy.store
+        with easy.store.MessageStore(store) as s:
+            return s.inbox(search)
     if path:
+        if search or folders:
+            raise click.UsageError('--folder and search filters (--since, --before, --from, --domain, --has-header, --larger, --smaller) require an IMAP account or --store')
+        if easy.archive.is_archive(path):
+            return easy.email.LocalArchive(easy.email.ArchiveConf(path=path))
         conf = easy.email.MboxConf(path=path)
-        return easy.email.LocalMbox(conf)
+        return easy.email.LocalMbox(conf, save_index=save_index)
     if user:
-        domain = user.split('@')[1]
-        conf = ctx.obj['providerconfigs'][domain] if not provider \
-                                                  else ctx.obj['providerconfigs'][provider]
+        conf = provider_conf(ctx, user, provider)
         datastore = ctx.obj['userdatastore']
         credentials = datastore.get_json(user)
-        return easy.email.ImapInbox(conf, credentials)
+        return easy.email.ImapInbox(
+            conf, 
+            credentials, 
+            checkpoints, 
+            connections=connections, 
+            ordered=ordered,
+            refresh=credentials_refresher(ctx, user, conf),
+            search=search,
+            folders=folders or ('INBOX',),
+            identities=identities
+        )
+
+
+def search_options(command):
+    # IMAP search filters, passed to command as a single search argument
+    # (easy.email.SearchFilter, None without filters)
+    options = [
+        click.option('--since', type=click.DateTime(['%Y-%m-%d']), help='only messages received on or after this date (IMAP, --store)'),
+        click.option('--before', type=click.DateTime(['%Y-%m-%d']), help='only messages received before this date (IMAP, --store)'),
+        click.option('--from', 'sender', type=str, help='only messages whose From header, display name included, contains this text (IMAP, --store)'),
+        click.option('--domain', type=str, help='only messages sent from this domain or its subdomains (IMAP, --store)'),
+        click.option('--has-header', 'has_headers', multiple=True, help='only messages having this header e.g. List-Unsubscribe, can be repeated (IMAP, --store)'),
+        click.option('--larger', type=click.IntRange(min=0), help='only messages larger than this many bytes (IMAP, --store)'),
+        click.option('--smaller', type=click.IntRange(min=1), help='only messages smaller than this many bytes (IMAP, --store)'),
+    ]
+
+    @functools.wraps(command)
+    def with_search(*args, since, before, sender, domain, has_headers, larger, smaller, **kwargs):
+        search: 'easy.email.SearchFilter' = {}
+        if since:
+            search['since'] = since.date()
+        if before:
+            search['before'] = before.date()
+        if sender:
+            search['sender'] = sender
+        if domain:
+            search['domain'] = domain
+        if has_headers:
+            search['headers'] = list(has_headers)
+        if larger is not None:
+            search['larger'] = larger
+        if smaller is not None:
+            search['smaller'] = smaller
+        return command(*args, search=search or None, **kwargs)
+
+    for option in reversed(options):
+        with_search = option(with_search)
+    return with_search
+
+
+def provider_conf(ctx, user: str, provider: str | None = None) -> 'ProviderConf':
+    # provider of the user address domain, unless given
+    domain = user.split('@')[1]
+    return ctx.obj['providerconfigs'][domain] if not provider \
+                                              else ctx.obj['providerconfigs'][provider]
+
+
+def credentials_refresher(ctx, user: str, conf: 'ProviderConf'):
+    # refreshes the access token of user, new credentials are stored
+    datastore = ctx.obj['userdatastore']
+
+    def refresh(credentials: dict) -> dict:
+        import easy.auth
+        credentials = easy.auth.refresh_credentials(conf, credentials)
+        datastore.store_json(user, credentials)
+        return credentials
+
+    return refresh
+
+
+def checkpoints_key(user: str) -> str:
+    # sync checkpoints are stored next to user credentials
+    return f'{user}#checkpoints'
+
+
+def identities_key(user: str) -> str:
+    # identities of messages downloaded from several folders, see
+    # easy.email.ImapInbox
+    return f'{user}#identities'
+
+
+class LazyObj(dict):
+    # context object, entries are made by their factory when first used:
+    # commands not reading provider configurations don't load them
+    factories = {
+        'userdatastore': lambda: cli.userdata.UnsafeFileStore(),
+        'providerconfigs': lambda: map_provider_conf_by_domain(),
+    }
+
+    def __missing__(self, key):
+        value = self[key] = self.factories[key]()
+        return value
+
+
+def check_features(ctx, param, value):
+    import easy.features
+    names = list(easy.features.Features.__annotations__)
+    for name in value:
+        if name not in names:
+            raise click.BadParameter(f"{name!r} is not one of {', '.join(names)}")
+    return value
 
 
 @click.group()
 @click.pass_context
-def _cli(ctx):
-    ctx.ensure_object(dict)
-    ctx.obj['userdatastore'] = cli.userdata.UnsafeFileStore()
-    ctx.obj['providerconfigs'] = map_provider_conf_by_domain()
+@click.option('--timings', is_flag=True, default=False, help='print time spent importing modules, setting up and running the command to stderr')
+def _cli(ctx, timings):
+    ctx.obj = LazyObj(ctx.obj or {})
+    if timings:
+        invoked = time.perf_counter()
+
+        def report():
+            end = time.perf_counter()
+            print(
+                f'timings: imports {(_imported - _started) * 1000:.1f} ms, '
+                f'setup {(invoked - _imported) * 1000:.1f} ms, '
+                f'command {(end - invoked) * 1000:.1f} ms',
+                file=sys.stderr
+            )
+
+        ctx.call_on_close(report)
 
 
 @_cli.command()
@@ -97,12 +259,11 @@ def login(ctx, provider: str, user: str):
     # if user is email, use domain to retrieve conf.
     # if user is username, a parameter to specify provider is required.
     # For now only oauth works so user is always an email
-    domain = user.split('@')[1]
-    conf = ctx.obj['providerconfigs'][domain] if not provider \
-                                              else ctx.obj['providerconfigs'][provider]
+    conf = provider_conf(ctx, user, provider)
     datastore = ctx.obj['userdatastore']
     # this method authenticates users and stores credentials (tokens or password for basic auth)
     # to be used for subsequent commands
+    import easy.auth
     authenticator = easy.auth.OauthInteractiveAuthenticator(conf, prompt_auth_url_cli)
     credentials: dict = authenticator.authenticate(user)
     datastore.store_json(user, credentials)
@@ -112,24 +273,244 @@ def login(ctx, provider: str, user: str):
 @click.pass_context
 @click.option('--mbox', type=click.Path(dir_okay=False))
 @click.option('--provider', type=str)
+@click.option('--full', is_flag=True, default=False, help='ignore sync checkpoints, download every message to a new --mbox file, the previous one is moved to <mbox>.<timestamp>')
+@click.option('--compress', type=click.Choice(list(easy.archive.CODECS)), help='write a compressed archive to --mbox instead of a mbox file, read by --mbox of other commands')
+@click.option('--store', type=click.Path(file_okay=False), help='add messages to a local message store instead of --mbox (see import)')
+@click.option('--connections', type=click.IntRange(min=1), default=1, help='number of concurrent IMAP connections')
+@click.option('--unordered', 'ordered', flag_value=False, default=True, help='output messages as soon as they are fetched (--connections)')
+@click.option('--folder', 'folders', multiple=True, help="IMAP folder, or LIST pattern e.g. '*' for every folder, can be repeated (default INBOX). Messages in more than one folder are fetched once, by later runs of several folders too")
 @click.argument('user', type=str)
-def download(ctx, mbox, provider, user: str):
-    inbox = configure_inbox(ctx, user=user, provider=provider)
-    if mbox:
-        write_mbox(inbox, mbox)
-    else:
+@search_options
+def download(ctx, mbox, provider, full, compress, store, connections, ordered, folders, user: str, search):
+    if mbox and store:
+        raise click.UsageError('--mbox and --store cannot be combined')
+    if not mbox and not store:
+        inbox = configure_inbox(
+            ctx, 
+            user=user, 
+            provider=provider, 
+            connections=connections, 
+            ordered=ordered,
+            search=search,
+            folders=folders
+        )
         write_stdout(inbox)
-
-
-def write_mbox(inbox: easy.email.ImapInbox, path):
-    mbox = mailbox.mbox(path)
-    for msg in inbox.fetch():
-        mbox.add(msg)
-    mbox.flush()
-    mbox.unlock()
-
-
-def write_stdout(inbox: easy.email.ImapInbox):
+        return
+    # incremental sync, only messages after the last checkpoint are appended
+    datastore = ctx.obj['userdatastore']
+    checkpoints = {} if full else datastore.get_json(checkpoints_key(user)) or {}
+    if full:
+        datastore.delete(identities_key(user))
+    identities = [r.decode() for r in datastore.get_records(identities_key(user))]
+    inbox = configure_inbox(
+        ctx, 
+        user=user, 
+        provider=provider, 
+        checkpoints=checkpoints, 
+        connections=connections, 
+        ordered=ordered,
+        search=search,
+        folders=folders,
+        identities=identities
+    )
+    invalidated = [] if full else inbox.invalidated()
+    if invalidated:
+        # appending them again would duplicate messages already downloaded
+        print(f"uids reassigned in {', '.join(invalidated)}, downloading everything again", file=sys.stderr)
+        checkpoints.clear()
+        identities.clear()
+        datastore.delete(identities_key(user))
+    if (full or invalidated) and mbox:
+        # the store skips messages already stored
+        rotated = rotate_output(mbox)
+        if rotated is not None:
+            print(f'previous download moved to {rotated}', file=sys.stderr)
+    # checkpoints are stored whenever downloaded messages are synced to disk,
+    # identities are appended first
+    stored = len(identities)
+
+    def store_checkpoints():
+        nonlocal stored
+        datastore.append(identities_key(user), (i.encode() for i in inbox.identities[stored:]))
+        stored = len(inbox.identities)
+        datastore.store_json(checkpoints_key(user), inbox.checkpoints)
+
+    if store:
+        # internal dates are indexed, searched as IMAP does
+        import easy.store
+        with easy.store.MessageStore(store, codec=compress or 'zlib', on_sync=store_checkpoints) as s:
+            for received, msgb in inbox.fetch_raw_dated():
+                s.add(msgb, received=received)
+        return
+    with open_writer(mbox, compress, on_sync=store_checkpoints) as writer:
+        for msgb in inbox.fetch_raw():
+            writer.add(msgb)
+
+
+@_cli.command('import')
+@click.pass_context
+@click.option('--store', required=True, type=click.Path(file_okay=False), help='local message store, created if missing')
+@click.option('--compress', type=click.Choice(list(easy.archive.CODECS)), default='zlib', help='compression of messages added')
+@click.argument('files', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+def import_(ctx, store, compress, files):
+    # mbox files and archives, messages already in the store are skipped
+    import easy.store
+    with easy.store.MessageStore(store, codec=compress) as s:
+        for path in files:
+            inbox = configure_inbox(ctx, path=path)
+            added = skipped = 0
+            for msgb in inbox.fetch_raw():
+                if s.add(msgb):
+                    added += 1
+                else:
+                    skipped += 1
+            print(f'{path}: {added} messages added, {skipped} already stored', file=sys.stderr)
+
+
+def rotate_output(path) -> pathlib.Path | None:
+    # moves a download aside (<path>.<timestamp>), along with its mbox
+    # index, so that a full download starts a new file
+    import easy.mbox
+    path = pathlib.Path(path)
+    if not path.exists() or path.stat().st_size == 0:
+        return None
+    rotated = path.with_name(f"{path.name}.{time.strftime('%Y%m%d%H%M%S')}")
+    path.rename(rotated)
+    index = easy.mbox.index_path(path)
+    if index.exists():
+        index.rename(easy.mbox.index_path(rotated))
+    return rotated
+
+
+def open_writer(
+    path, compress: str | None, *, on_sync=None
+) -> 'easy.mbox.MboxWriter | easy.archive.ArchiveWriter':
+    # appends to a mbox file, or to a compressed archive with codec compress
+    import easy.mbox
+    path = pathlib.Path(path)
+    if path.exists() and path.stat().st_size > 0 \
+    and easy.archive.is_archive(path) != (compress is not None):
+        if compress is None:
+            raise click.UsageError(f'{path} is a compressed archive, append to it with --compress')
+        raise click.UsageError(f'{path} is a mbox file, it can\'t be appended to with --compress')
+    if compress is not None:
+        return easy.archive.ArchiveWriter(path, codec=compress, on_sync=on_sync)
+    return easy.mbox.MboxWriter(path, on_sync=on_sync)
+
+
+@_cli.command('download-all')
+@click.pass_context
+@click.option('--dir', 'directory', required=True, type=click.Path(file_okay=False), help='where mbox files are written, one per account named after it')
+@click.option('--full', is_flag=True, default=False, help='ignore sync checkpoints, download every message to new files, previous ones are moved to <file>.<timestamp>')
+@click.option('--compress', type=click.Choice(list(easy.archive.CODECS)), help='write compressed archives (<account>.arc) instead of mbox files, read by --mbox of other commands')
+@click.option('--jobs', type=click.IntRange(min=1), default=8, help='number of accounts downloaded at once')
+@click.option('--connections', type=click.IntRange(min=1), default=1, help='max IMAP connections per account')
+@click.option('--pipeline', type=click.IntRange(min=1), default=4, help='FETCH commands in flight per connection')
+@click.argument('accounts', type=click.File('r'))
+def download_all(ctx, directory, full, compress, jobs, connections, pipeline, accounts):
+    # ACCOUNTS lists an account per line, optionally followed by its provider.
+    # Accounts are downloaded concurrently by a single process, accounts of the
+    # same provider share its limits (max_connections, max_fetch_rate)
+    import asyncio
+    import contextlib
+    import easy.aioimap
+    users = read_accounts(accounts)
+    datastore = ctx.obj['userdatastore']
+    confs = {user: provider_conf(ctx, user, provider) for user, provider in users}
+    credentials = {user: datastore.get_json(user) for user in confs}
+    missing = [user for user, c in credentials.items() if c is None]
+    if missing:
+        raise click.UsageError(f"not logged in: {', '.join(missing)}")
+    limiter = easy.aioimap.ConnectionLimiter(
+        {c['imap_server']: c['max_connections'] for c in confs.values() if 'max_connections' in c},
+        rates={c['imap_server']: c['max_fetch_rate'] for c in confs.values() if 'max_fetch_rate' in c}
+    )
+    inboxes = {
+        user: easy.aioimap.AsyncImapInbox(
+            conf,
+            credentials[user],
+            {} if full else datastore.get_json(checkpoints_key(user)) or {},
+            connections=connections,
+            pipeline=pipeline,
+            limiter=limiter,
+            refresh=credentials_refresher(ctx, user, conf)
+        )
+        for user, conf in confs.items()
+    }
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    counts = dict.fromkeys(inboxes, 0)
+    sizes = dict.fromkeys(inboxes, 0)
+
+    def store_checkpoints(user: str):
+        datastore.store_json(checkpoints_key(user), inboxes[user].checkpoints)
+
+    paths = {user: directory / f"{user}.{'arc' if compress else 'mbox'}" for user in inboxes}
+
+    async def invalidated() -> list[str]:
+        # accounts whose uids have been reassigned, as download does.
+        # Accounts failing the check fail their download as well
+        found = await asyncio.gather(
+            *(inbox.invalidated() for inbox in inboxes.values()), return_exceptions=True
+        )
+        return [user for user, f in zip(inboxes, found) if f and not isinstance(f, BaseException)]
+
+    async def download_inboxes() -> dict[str, easy.aioimap.FetchResult]:
+        # every message is downloaded again to a new file
+        for user in inboxes if full else await invalidated():
+            inboxes[user].checkpoints.clear()
+            rotated = rotate_output(paths[user])
+            if rotated is not None:
+                print(f'{user}: previous download moved to {rotated}', file=sys.stderr)
+        with contextlib.ExitStack() as stack:
+            writers = {
+                user: stack.enter_context(open_writer(
+                    paths[user],
+                    compress,
+                    on_sync=lambda user=user: store_checkpoints(user)
+                ))
+                for user in inboxes
+            }
+
+            def consume(user: str, msgb: bytes):
+                writers[user].add(msgb)
+                counts[user] += 1
+                sizes[user] += len(msgb)
+
+            return await easy.aioimap.fetch_many(inboxes, consume, jobs=jobs)
+
+    start = time.monotonic()
+    results = asyncio.run(download_inboxes())
+    elapsed = time.monotonic() - start
+    for user, result in results.items():
+        status = 'ok' if result.error is None else f'error: {result.error!r}'
+        print(
+            f'{user}: {counts[user]} messages, {sizes[user] / 2**20:.1f} MB '
+            f'in {result.seconds:.1f}s, {status}',
+            file=sys.stderr
+        )
+    total, size = sum(counts.values()), sum(sizes.values())
+    print(
+        f'{len(results)} accounts: {total} messages, {size / 2**20:.1f} MB in {elapsed:.1f}s '
+        f'({total / max(elapsed, 1e-9):.1f} messages/s, {size / 2**20 / max(elapsed, 1e-9):.2f} MB/s)',
+        file=sys.stderr
+    )
+    if any(r.error is not None for r in results.values()):
+        ctx.exit(1)
+
+
+def read_accounts(lines) -> list[tuple[str, str | None]]:
+    # (user, provider) pairs, blank lines and '#' comments skipped
+    accounts = []
+    for line in lines:
+        fields = line.split('#', 1)[0].split()
+        if not fields:
+            continue
+        accounts.append((fields[0], fields[1] if len(fields) > 1 else None))
+    return accounts
+
+
+def write_stdout(inbox: 'easy.email.ImapInbox'):
     # experimental, how to separate messages ?
     for msg in inbox.fetch():
         sys.stdout.write(str(msg) + '\n')
@@ -140,48 +521,229 @@ def write_stdout(inbox: easy.email.ImapInbox):
 @click.option('--mbox', type=click.Path(exists=True, dir_okay=False))
 @click.option('--csv', 'output', flag_value='CSV', default=True)
 @click.option('--json', 'output', flag_value='JSON')
+@click.option('--npz', 'output', flag_value='NPZ', help='binary numpy matrix, with columns names and msgids (--msgid)')
 @click.option('--no-headers', 'output_headers', flag_value=False, default=True, help='avoid inserting headers in the first line (csv)')
 @click.option('--msgid', 'output_msgid', flag_value=True, default=False, help='avoid inserting headers in the first line (csv)')
+@click.option('--workers', type=click.IntRange(min=1), default=1, help='number of processes evaluating features')
+@click.option('--unordered', 'ordered', flag_value=False, default=True, help='output features as soon as they are evaluated (--workers)')
+@click.option('--save-index', is_flag=True, default=False, help='store the mbox index next to it, to be reused by next runs (--mbox)')
+@click.option('--cache', 'use_cache', is_flag=True, default=False, help='reuse features of messages evaluated by previous runs')
+@click.option('--cache-size', type=click.IntRange(min=0), default=1024, help='max MB of cached features (--cache), least recently used messages are evicted as new ones are added')
+@click.option('--profile', is_flag=True, default=False, help='print time spent on every feature to stderr')
+@click.option('--feature', 'only_features', multiple=True, callback=check_features, help='evaluate only this feature, can be repeated. Bodies are fetched only for body features')
+@click.option('--bodystructure', is_flag=True, default=False, help='compute body features from the IMAP message structure, fetching text parts only')
+@click.option('--folder', 'folders', multiple=True, help="IMAP folder, or LIST pattern e.g. '*' for every folder, can be repeated (default INBOX). Messages in more than one folder are fetched once")
+@click.option('--store', type=click.Path(exists=True, file_okay=False), help='read a local message store (see import), only messages matching search filters')
 @click.argument('user', required=False, type=str)
-def mkfeatures(ctx, mbox, output, output_headers, output_msgid, user):
-    inbox = configure_inbox(ctx, user=user, path=mbox)
-    features = \
-        filter(
-            lambda f: f is not None, 
-            map(
-                lambda m: mkfeature(m, msgid=output_msgid), 
-                inbox.fetch()
+@search_options
+def mkfeatures(
+    ctx, 
+    mbox, 
+    output, 
+    output_headers, 
+    output_msgid, 
+    workers, 
+    ordered, 
+    save_index, 
+    use_cache, 
+    cache_size, 
+    profile,
+    only_features,
+    bodystructure,
+    folders,
+    store,
+    user,
+    search
+):
+    lazy = only_features or bodystructure
+    if lazy and (workers > 1 or use_cache or profile):
+        raise click.UsageError('--feature and --bodystructure cannot be combined with --workers, --cache or --profile')
+    inbox = configure_inbox(ctx, user=user, path=mbox, save_index=save_index, search=search, folders=folders, store=store)
+    cache = open_feature_cache(max_bytes=cache_size << 20) if use_cache else None
+    if profile:
+        import easy.profiling
+    profiler = easy.profiling.Profiler() if profile else None
+    try:
+        if workers > 1 or cache is not None or profiler is not None:
+            features = mkfeatures_raw(
+                inbox, 
+                workers=workers, 
+                ordered=ordered, 
+                msgid=output_msgid,
+                cache=cache,
+                profiler=profiler
             )
+        elif lazy:
+            # lazy messages, bodies are loaded by body features only
+            msgs = inbox.fetch_structured() if bodystructure else inbox.fetch_lazy()
+            features = \
+                filter(
+                    lambda f: f is not None, 
+                    map(
+                        lambda m: mkfeature(m, msgid=output_msgid, features=only_features or None), 
+                        msgs
+                    )
+                )
+        else:
+            features = \
+                filter(
+                    lambda f: f is not None, 
+                    map(
+                        lambda m: mkfeature(m, msgid=output_msgid), 
+                        inbox.fetch()
+                    )
+                )
+        # csv
+        match output:
+            case 'JSON':
+                write_json(features) 
+            case 'CSV':
+                write_csv(features, write_headers=output_headers) 
+            case 'NPZ':
+                write_npz(features, msgid=output_msgid)
+    finally:
+        if cache is not None:
+            cache.close()
+        if profiler is not None:
+            print(profiler.summary(), file=sys.stderr)
+
+
+def mkfeature(
+    m: 'easy.features.Message', msgid: bool = False, features=None
+):
+    import easy.features
+    f = easy.features.evaluate(m, features=features)
+    if f is not None and msgid:
+        f['msgid'] = m['message-id']
+    return f
+
+
+def mkfeatures_raw(
+    inbox: 'easy.email.Inbox', 
+    *, 
+    workers: int = 1, 
+    ordered: bool = True, 
+    msgid: bool = False,
+    cache: 'easy.cache.FeatureCache | None' = None,
+    profiler: 'easy.profiling.Profiler | None' = None
+):
+    results = evaluate_raw(
+        inbox, workers=workers, ordered=ordered, cache=cache, profiler=profiler
+    )
+    for f, m in results:
+        if msgid:
+            f['msgid'] = m
+        yield f
+
+
+def evaluate_raw(
+    inbox: 'easy.email.Inbox', 
+    *, 
+    workers: int = 1, 
+    ordered: bool = True, 
+    cache: 'easy.cache.FeatureCache | None' = None,
+    profiler: 'easy.profiling.Profiler | None' = None
+):
+    # evaluates raw messages, in worker processes and/or through the cache.
+    # Cached messages are not evaluated, hence not profiled.
+    if workers > 1:
+        import easy.parallel
+        return easy.parallel.evaluate_parallel(
+            inbox.fetch_raw(), 
+            workers=workers, 
+            ordered=ordered,
+            cache=cache,
+            profiler=profiler
         )
-    # csv
+    import easy.cache
+    return easy.cache.evaluate_cached(inbox.fetch_raw(), cache, profiler=profiler)
+
+
+def open_feature_cache(**kwargs) -> 'easy.cache.FeatureCache':
+    import easy.cache
+    path = cli.userdata.get_system_userdata_path() / 'features-cache.sqlite'
+    return easy.cache.FeatureCache(path, **kwargs)
+
+
+@_cli.command('clear-cache')
+@click.pass_context
+@click.option('--outdated', is_flag=True, default=False, help='only remove features computed by previous versions')
+def clear_cache(ctx, outdated):
+    with open_feature_cache() as cache:
+        removed = cache.clear(outdated_only=outdated)
+    print(f'removed {removed} cached messages')
+
+
+@_cli.command()
+@click.pass_context
+@click.option('--mbox', type=click.Path(exists=True, dir_okay=False))
+@click.option('--provider', type=str)
+@click.option('--csv', 'output', flag_value='CSV', default=True)
+@click.option('--json', 'output', flag_value='JSON')
+@click.option('--no-headers', 'output_headers', flag_value=False, default=True, help='avoid inserting headers in the first line (csv)')
+@click.option('--top', type=click.IntRange(min=1), default=None, help='only the most frequent domains')
+@click.option('--max-domains', type=click.IntRange(min=1), default=100_000, help='domains tracked at once, beyond that counts of the most frequent ones are approximated')
+@click.option('--store', type=click.Path(exists=True, file_okay=False), help='read a local message store (see import), only messages matching search filters')
+@click.argument('user', required=False, type=str)
+@search_options
+def services(ctx, mbox, provider, output, output_headers, top, max_domains, store, user, search):
+    # only headers are fetched
+    import easy.services
+    inbox = configure_inbox(ctx, provider=provider, user=user, path=mbox, search=search, store=store)
+    aggregator = easy.services.aggregate(inbox.fetch_headers(), max_domains=max_domains)
+    stats = aggregator.top(top)
     match output:
         case 'JSON':
-            write_json(features) 
+            write_json(stats)
         case 'CSV':
-            write_csv(features, write_headers=output_headers) 
+            write_csv(stats, write_headers=output_headers)
+    print(
+        f'{aggregator.messages} messages, {len(aggregator)} domains, '
+        f'{aggregator.skipped} without sender, {aggregator.replaced} domains replaced',
+        file=sys.stderr
+    )
 
 
-def mkfeature(m: email.message.EmailMessage, msgid: bool = False):
-    f = easy.features.evaluate(m)
-    if f is not None and msgid:
-        f['msgid'] = m['message-id']
-    return f
-
-
-def write_json(features):
+def write_json(features, *, batch_size: int = 1024):
+    lines = []
     for f in features:
-        sys.stdout.write(json.dumps(f) + '\n')
+        lines.append(json.dumps(f) + '\n')
+        if len(lines) >= batch_size:
+            sys.stdout.write(''.join(lines))
+            lines = []
+    sys.stdout.write(''.join(lines))
 
 
-def write_csv(features, *, write_headers: bool = True):
-    for i, f in enumerate(features):
-        keys = f.keys()
-        if i == 0 and write_headers:
-            headers = ",".join(keys)
-            sys.stdout.write(headers + '\n')
-        row = [f[key] for key in keys]
-        out = ','.join(map(str, row))
-        sys.stdout.write(out + '\n')
+def write_csv(features, *, write_headers: bool = True, batch_size: int = 1024):
+    # every row has the same keys of the first one
+    lines = []
+    keys = None
+    for f in features:
+        if keys is None:
+            keys = list(f.keys())
+            if write_headers:
+                lines.append(','.join(keys) + '\n')
+        lines.append(','.join([str(f[key]) for key in keys]) + '\n')
+        if len(lines) >= batch_size:
+            sys.stdout.write(''.join(lines))
+            lines = []
+    sys.stdout.write(''.join(lines))
+
+
+def write_npz(features, *, msgid: bool = False):
+    # numpy is required by this output only
+    import easy.matrix
+    builder = None
+    for f in features:
+        m = f.pop('msgid', None)
+        if builder is None:
+            builder = easy.matrix.MatrixBuilder(f.keys())
+        builder.append(f, (m or '') if msgid else None)
+    if builder is None:
+        import easy.features
+        builder = easy.matrix.MatrixBuilder(easy.features.Features.__annotations__)
+    sys.stdout.flush()
+    easy.matrix.save(sys.stdout.buffer, builder.build())
 
 
 @_cli.command()
@@ -190,29 +752,137 @@ def write_csv(features, *, write_headers: bool = True):
 @click.option('--csv', 'output', flag_value='CSV', default=True)
 @click.option('--json', 'output', flag_value='JSON')
 @click.option('--no-headers', 'headers', flag_value=False, default=True, help='avoid inserting headers in the first line (csv)')
+@click.option('--store', type=click.Path(exists=True, file_okay=False), help='read a local message store (see import), only messages matching search filters')
 @click.argument('user', required=False, type=str)
-def label(ctx, mbox, output, user):
-    inbox = configure_inbox(ctx, user=user, path=mbox)
+@search_options
+def label(ctx, mbox, output, headers, store, user, search):
+    inbox = configure_inbox(ctx, user=user, path=mbox, search=search, store=store)
     for msg in inbox.fetch():
         label = label_msg(msg)
 
 
-def label_msg(msg: email.message.EmailMessage) -> int:
+def label_msg(msg: 'email.message.EmailMessage') -> int:
     pass
 
 
-def render_msg(msg: email.message.EmailMessage) -> int:
+def render_msg(msg: 'email.message.EmailMessage') -> int:
     pass
 
 
 @_cli.command()
 @click.pass_context
-@click.option('--model', default=None, type=str)
-@click.argument('labels', type=click.Path(dir_okay=False))
-def train(ctx, model, labels):
-    pass
+@click.option('--model', default=None, type=click.Path(dir_okay=False), help='where to save the model (default: user data directory)')
+@click.option('--epochs', type=click.IntRange(min=1), default=10)
+@click.option('--batch-size', type=click.IntRange(min=1), default=1024)
+@click.option('--learning-rate', type=click.FloatRange(min=0, min_open=True), default=0.5)
+@click.argument('labels', type=click.Path(exists=True, dir_okay=False))
+def train(ctx, model, epochs, batch_size, learning_rate, labels):
+    # numpy is required by training only
+    import easy.model
+    columns, chunks = easy.model.labeled_chunks(labels)
+    m = easy.model.fit(
+        chunks, 
+        columns, 
+        epochs=epochs, 
+        batch_size=batch_size, 
+        learning_rate=learning_rate,
+        on_epoch=lambda e, loss: print(f'epoch {e}: loss {loss:.4f}', file=sys.stderr)
+    )
+    path = model or default_model_path()
+    easy.model.save(path, m)
+    print(f'model saved to {path}')
+
+
+def default_model_path() -> pathlib.Path:
+    return cli.userdata.get_system_userdata_path() / 'model.npz'
+
+
+@_cli.command()
+@click.pass_context
+@click.option('--mbox', type=click.Path(exists=True, dir_okay=False))
+@click.option('--features', 'features_path', type=click.Path(exists=True, dir_okay=False), help='classify precomputed features (mkfeatures --csv or --npz, with --msgid)')
+@click.option('--model', default=None, type=click.Path(exists=True, dir_okay=False), help='trained model (default: user data directory)')
+@click.option('--threshold', type=click.FloatRange(min=0, max=1), default=0.5, help='minimum score of messages labeled as sent-by-service')
+@click.option('--csv', 'output', flag_value='CSV', default=True)
+@click.option('--json', 'output', flag_value='JSON')
+@click.option('--no-headers', 'output_headers', flag_value=False, default=True, help='avoid inserting headers in the first line (csv)')
+@click.option('--batch-size', type=click.IntRange(min=1), default=4096, help='messages scored at once')
+@click.option('--workers', type=click.IntRange(min=1), default=1, help='number of processes evaluating features')
+@click.option('--cache', 'use_cache', is_flag=True, default=False, help='reuse features of messages evaluated by previous runs')
+@click.option('--store', type=click.Path(exists=True, file_okay=False), help='read a local message store (see import), only messages matching search filters')
+@click.argument('user', required=False, type=str)
+@search_options
+def classify(
+    ctx, 
+    mbox, 
+    features_path, 
+    model, 
+    threshold, 
+    output, 
+    output_headers, 
+    batch_size, 
+    workers, 
+    use_cache, 
+    store,
+    user,
+    search
+):
+    # numpy is required by classification only
+    import easy.features
+    import easy.matrix
+    import easy.model
+    m = easy.model.load(model or default_model_path())
+    if m.version != easy.features.FEATURES_VERSION:
+        print(
+            f'warning: model trained on features version {m.version}, '
+            f'current is {easy.features.FEATURES_VERSION}',
+            file=sys.stderr
+        )
+    if features_path:
+        batches = easy.model.feature_chunks(
+            features_path, m.columns, chunk_size=batch_size
+        )
+        write_scores(m, batches, threshold, output, output_headers)
+        return
+    inbox = configure_inbox(ctx, user=user, path=mbox, search=search, store=store)
+    cache = open_feature_cache() if use_cache else None
+    try:
+        results = evaluate_raw(inbox, workers=workers, cache=cache)
+        batches = easy.matrix.batches(results, m.columns, size=batch_size)
+        write_scores(m, batches, threshold, output, output_headers)
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+def write_scores(model, batches, threshold: float, output: str, write_headers: bool):
+    # one line per message: msgid, score and label (1 sent-by-service)
+    import easy.model
+    if output == 'CSV' and write_headers:
+        sys.stdout.write('msgid,score,label\n')
+    for features, msgids in batches:
+        scores = easy.model.score(model, features)
+        labels = (scores >= threshold).astype(int).tolist()
+        if msgids is None:
+            msgids = [None] * len(scores)
+        match output:
+            case 'JSON':
+                lines = [
+                    json.dumps({'msgid': m, 'score': s, 'label': l}) + '\n'
+                    for m, s, l in zip(msgids, scores.tolist(), labels)
+                ]
+            case 'CSV':
+                lines = [
+                    f'{m or ""},{s:.6f},{l}\n'
+                    for m, s, l in zip(msgids, scores.tolist(), labels)
+                ]
+        sys.stdout.write(''.join(lines))
+
+
+# end of module imports, reported by --timings
+_imported = time.perf_counter()
+
 
-    
 if __name__ == '__main__':
     _cli()
 
@@ -221,4 +891,4 @@ if __name__ == '__main__':
 # mkfeature: EmailMessage -> dict
 # label: dict -> dict
 # train: list[dict] -> weights
-# analyze: (model, weights) -> dict
\ No newline at end of file
+# classify: (model, weights) -> dict
@@ -52,6 +52,29 @@ class UnsafeFileStore:
             data = f.read()
         return base64.b64decode(data.encode())
 
+    def append(self, addr: str, records: collections.abc.Iterable[bytes]):
+        # records added after those of addr, a line each: appending doesn't
+        # rewrite previous ones (see get_records)
+        filename = hashlib.sha256(addr.encode()).hexdigest()
+        filepath = self._datapath / filename
+        lines = ''.join(base64.b64encode(r).decode() + '\n' for r in records)
+        try:
+            with open(filepath, 'a') as f:
+                f.write(lines)
+        except PermissionError:
+            raise PermissionError(f"restricted access: {filepath}")
+        except OSError as e:
+            raise ValueError(f"cannot write {filepath}: {str(e)}")
+
+    def get_records(self, addr) -> list[bytes]:
+        filename = hashlib.sha256(addr.encode()).hexdigest()
+        filepath = self._datapath / filename
+        if not filepath.exists():
+            return []
+        with open(filepath, 'r') as f:
+            # the last line is torn when a write has been interrupted
+            return [base64.b64decode(line) for line in f.read().split('\n')[:-1]]
+
     def delete(self, addr: str):
         filename = hashlib.sha256(addr.encode()).hexdigest()
         filepath = self._datapath / filename
@@ -0,0 +1,553 @@
+import typing
+import collections.abc
+import asyncio
+import contextlib
+import base64
+import re
+import ssl
+import time
+import email.message
+import easy.auth
+import easy.email
+import easy.pending
+
+
+# asyncio IMAP client and inbox, a process syncs many accounts at once.
+# Commands are pipelined: FETCH commands of several batches are in flight on
+# a connection, untagged FETCH responses are matched to commands by UID.
+# Connections to a server and their FETCH rate are bounded by a
+# ConnectionLimiter shared by inboxes of the same provider.
+
+
+class ImapError(Exception):
+    # command completed with NO or BAD, dropped connections raise ConnectionError
+    pass
+
+
+class _Command:
+
+    __slots__ = ('future', 'uids', 'untagged')
+
+    def __init__(self, future: asyncio.Future, uids: set[int] | None):
+        self.future = future
+        # uids of UID FETCH commands
+        self.uids = uids
+        # untagged responses, see AsyncImapClient._read_response
+        self.untagged: list[list] = []
+
+
+_literal = re.compile(rb'\{(\d+)\}$')
+_fetch_response = re.compile(rb'(\d+) FETCH ', re.IGNORECASE)
+_uid = re.compile(rb'UID (\d+)', re.IGNORECASE)
+_uidvalidity = re.compile(rb'\[UIDVALIDITY (\d+)\]', re.IGNORECASE)
+
+
+class AsyncImapClient:
+
+    # Minimal IMAP4rev1 client (RFC 3501): XOAUTH2, EXAMINE, UID SEARCH,
+    # UID FETCH and LOGOUT. Commands may be issued concurrently, they are
+    # sent right away and completed as their tagged responses arrive.
+    # FETCH data is returned in imaplib shape.
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # use connect
+        self._reader = reader
+        self._writer = writer
+        self._tag = 0
+        # tag -> command waiting for completion, in sending order
+        self._commands: dict[bytes, _Command] = {}
+        self._continuation: asyncio.Future | None = None
+        self._reading: asyncio.Task | None = None
+
+    async def _start(self):
+        greeting = await self._read_response()
+        if not greeting[0].startswith(b'* OK'):
+            raise ImapError(f'unexpected greeting: {greeting[0]!r}')
+        self._reading = asyncio.create_task(self._read_responses())
+
+    async def _read_response(self) -> list:
+        # a response with its literals, split as imaplib does:
+        # (text ending with '{n}', literal) tuples, then the remaining text
+        parts = []
+        while True:
+            line = (await self._reader.readuntil(b'\r\n'))[:-2]
+            m = _literal.search(line)
+            if m is None:
+                parts.append(line)
+                return parts
+            literal = await self._reader.readexactly(int(m.group(1)))
+            parts.append((line, literal))
+
+    async def _read_responses(self):
+        # however reading ends, commands waiting for a response fail and the
+        # connection is not used anymore
+        error = ConnectionError('connection closed')
+        try:
+            while True:
+                parts = await self._read_response()
+                text = _text(parts[0])
+                if text.startswith(b'+'):
+                    self._continue()
+                elif text.startswith(b'* '):
+                    self._untagged(parts)
+                else:
+                    self._complete(text)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            # e.g. LimitOverrunError, a response line too long
+            error = ConnectionError(f'unreadable response: {e!r}')
+            error.__cause__ = e
+            self._writer.close()
+        finally:
+            for command in self._commands.values():
+                if not command.future.done():
+                    command.future.set_exception(error)
+            self._commands.clear()
+
+    def _continue(self):
+        if self._continuation is not None and not self._continuation.done():
+            self._continuation.set_result(None)
+        else:
+            # error challenge of a failed authentication, answered empty
+            self._writer.write(b'\r\n')
+
+    def _untagged(self, parts: list):
+        if not self._commands:
+            return
+        first = _text(parts[0])[2:]
+        m = _fetch_response.match(first)
+        command = next(iter(self._commands.values()))
+        if m is not None:
+            # imaplib shape, 'n (UID ...'
+            first = m.group(1) + b' ' + first[m.end():]
+            parts[0] = (first, parts[0][1]) if isinstance(parts[0], tuple) else first
+            uid = _find_uid(parts)
+            for c in self._commands.values():
+                if c.uids is not None and uid in c.uids:
+                    command = c
+                    break
+        elif isinstance(parts[0], tuple):
+            parts[0] = (first, parts[0][1])
+        else:
+            parts[0] = first
+        command.untagged.append(parts)
+
+    def _complete(self, text: bytes):
+        tag, _, rest = text.partition(b' ')
+        command = self._commands.pop(tag, None)
+        if command is None:
+            return
+        status, _, message = rest.partition(b' ')
+        if status.upper() == b'OK':
+            command.future.set_result(command.untagged)
+        else:
+            command.future.set_exception(ImapError(message.decode('ascii', 'replace')))
+
+    async def _command(self, command: str, *, uids: set[int] | None = None) -> list[list]:
+        # untagged responses of the command
+        if self._reading is None or self._reading.done():
+            raise ConnectionError('connection closed')
+        self._tag += 1
+        tag = f'A{self._tag:04d}'.encode()
+        pending = _Command(asyncio.get_running_loop().create_future(), uids)
+        self._commands[tag] = pending
+        self._writer.write(tag + b' ' + command.encode() + b'\r\n')
+        await self._writer.drain()
+        return await pending.future
+
+    async def authenticate_xoauth2(self, auth_string: bytes):
+        self._continuation = asyncio.get_running_loop().create_future()
+        command = asyncio.ensure_future(self._command('AUTHENTICATE XOAUTH2'))
+        await asyncio.wait(
+            [self._continuation, command], return_when=asyncio.FIRST_COMPLETED
+        )
+        if not command.done():
+            self._writer.write(base64.b64encode(auth_string) + b'\r\n')
+        await command
+
+    async def examine(self, folder: str) -> int:
+        # selects folder read-only, returns its UIDVALIDITY
+        untagged = await self._command(f'EXAMINE {_quote(folder)}')
+        for parts in untagged:
+            m = _uidvalidity.search(_text(parts[0]))
+            if m is not None:
+                return int(m.group(1))
+        raise ImapError('UIDVALIDITY missing')
+
+    async def uid_search(self, criteria: str) -> list[bytes]:
+        uids = []
+        for parts in await self._command(f'UID SEARCH {criteria}'):
+            name, _, values = _text(parts[0]).partition(b' ')
+            if name.upper() == b'SEARCH':
+                uids += values.split()
+        return uids
+
+    async def uid_fetch(self, uids: list[bytes], items: str) -> list:
+        # FETCH data as imaplib returns it
+        command = f"UID FETCH {b','.join(uids).decode('ascii')} {items}"
+        untagged = await self._command(command, uids={int(u) for u in uids})
+        return [part for parts in untagged for part in parts]
+
+    async def logout(self):
+        with contextlib.suppress(ConnectionError, ImapError):
+            await self._command('LOGOUT')
+        self._writer.close()
+        with contextlib.suppress(ConnectionError):
+            await self._writer.wait_closed()
+        if self._reading is not None:
+            self._reading.cancel()
+
+
+async def connect(
+    host: str, port: int, *, ssl_context: ssl.SSLContext | bool | None = True
+) -> AsyncImapClient:
+    # ssl_context None for plain connections
+    reader, writer = await asyncio.open_connection(
+        host, port, ssl=ssl_context, limit=1 << 24
+    )
+    client = AsyncImapClient(reader, writer)
+    try:
+        await client._start()
+    except BaseException:
+        writer.close()
+        raise
+    return client
+
+
+def _text(part: tuple[bytes, bytes] | bytes) -> bytes:
+    return part[0] if isinstance(part, tuple) else part
+
+
+def _find_uid(parts: list) -> int | None:
+    for part in parts:
+        m = _uid.search(_text(part))
+        if m is not None:
+            return int(m.group(1))
+    return None
+
+
+def _quote(folder: str) -> str:
+    return '"' + folder.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class ConnectionLimiter:
+
+    # concurrent connections and FETCH commands per second per IMAP server,
+    # shared by the inboxes of accounts on the same provider
+
+    def __init__(
+        self,
+        limits: dict[str, int] | None = None,
+        *,
+        default: int = 4,
+        rates: dict[str, float] | None = None
+    ):
+        # server -> max connections
+        self._limits = limits if limits is not None else {}
+        self._default = default
+        # server -> max FETCH commands per second, unlimited when missing
+        self._rates = rates if rates is not None else {}
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+        # server -> monotonic time of the next FETCH allowed
+        self._next_fetch: dict[str, float] = {}
+
+    def semaphore(self, server: str) -> asyncio.Semaphore:
+        if server not in self._semaphores:
+            self._semaphores[server] = asyncio.Semaphore(
+                self._limits.get(server, self._default)
+            )
+        return self._semaphores[server]
+
+    async def throttle(self, server: str):
+        # waits for the turn of a FETCH command, commands are evenly spaced
+        rate = self._rates.get(server)
+        if not rate:
+            return
+        now = time.monotonic()
+        at = max(now, self._next_fetch.get(server, now))
+        self._next_fetch[server] = at + 1 / rate
+        if at > now:
+            await asyncio.sleep(at - now)
+
+
+class AsyncImapInbox:
+
+    # Counterpart of easy.email.ImapInbox with the same configuration,
+    # credentials and checkpoints, messages are yielded by async generators.
+    # A connection is opened per fetch, extra connections (up to connections)
+    # are opened only when the limiter has free slots, so that inboxes
+    # sharing a server never wait on each other for more than one.
+    # Every connection has up to pipeline FETCH commands in flight.
+    # Dropped connections are replaced as easy.email.ImapInbox does, FETCH
+    # commands in flight on them are sent again on the new one.
+
+    def __init__(
+        self,
+        conf: easy.email.ImapConf,
+        credentials: dict,
+        checkpoints: dict[str, easy.email.ImapCheckpoint] | None = None,
+        *,
+        connections: int = 1,
+        pipeline: int = 4,
+        ordered: bool = True,
+        limiter: ConnectionLimiter | None = None,
+        refresh: collections.abc.Callable[[dict], dict] | None = None,
+        retries: int = 5,
+        backoff: float = 1.0
+    ):
+        self._conf = conf
+        self._credentials = credentials
+        # blocking, as for ImapInbox, run in a thread
+        self._refresh = refresh
+        self._refreshing = asyncio.Lock()
+        self.checkpoints = checkpoints if checkpoints is not None else {}
+        self._connections = connections
+        self._pipeline = pipeline
+        self._ordered = ordered
+        self._limiter = limiter if limiter is not None else ConnectionLimiter()
+        # a dropped connection is replaced up to retries times per batch,
+        # waiting backoff seconds, doubled on every attempt
+        self._retries = retries
+        self._backoff = backoff
+
+    async def _connect(self) -> AsyncImapClient:
+        return await connect(self._conf['imap_server'], self._conf['imap_port'])
+
+    async def _login(self, client: AsyncImapClient):
+        # same flow as easy.email._login_imap, the access token is refreshed
+        # when expired or refused as easy.email.ImapInbox does
+        credentials = self._credentials
+        if credentials['access_token'] is None:
+            raise NotImplementedError("basic login not supported")
+        if self._refresh is not None and credentials.get('refresh_token') \
+        and easy.auth.expired(credentials):
+            credentials = await self._refresh_credentials(credentials)
+        try:
+            await client.authenticate_xoauth2(easy.email._xoauth2_string(credentials))
+        except ImapError:
+            if self._refresh is None or not credentials.get('refresh_token'):
+                raise
+            credentials = await self._refresh_credentials(credentials)
+            await client.authenticate_xoauth2(easy.email._xoauth2_string(credentials))
+
+    async def _refresh_credentials(self, stale: dict) -> dict:
+        # connections of this inbox refresh the token once
+        async with self._refreshing:
+            if self._credentials is stale:
+                self._credentials = await asyncio.to_thread(self._refresh, stale)
+            return self._credentials
+
+    async def fetch_raw(
+        self, *, batch_size=100
+    ) -> collections.abc.AsyncGenerator[bytes, None]:
+        async for _, msgb in self._fetch('(RFC822)', batch_size):
+            yield msgb
+
+    async def fetch_raw_headers(
+        self, *, batch_size=100
+    ) -> collections.abc.AsyncGenerator[bytes, None]:
+        async for _, headersb in self._fetch('(BODY.PEEK[HEADER])', batch_size):
+            yield headersb
+
+    async def fetch(
+        self, *, batch_size=100
+    ) -> collections.abc.AsyncGenerator[email.message.EmailMessage, None]:
+        async for msgb in self.fetch_raw(batch_size=batch_size):
+            yield easy.email._parse_bytes(msgb)
+
+    async def _open(
+        self, stack: contextlib.AsyncExitStack, semaphore: asyncio.Semaphore
+    ) -> AsyncImapClient:
+        # connection holding a limiter slot until stack is closed
+        await semaphore.acquire()
+        stack.callback(semaphore.release)
+        client = await self._connect()
+        stack.push_async_callback(client.logout)
+        await self._login(client)
+        return client
+
+    async def _reopen(
+        self, stack: contextlib.AsyncExitStack, folder: str, uidvalidity: int
+    ) -> AsyncImapClient:
+        # replaces a dropped connection, taking its limiter slot.
+        # Uids must still be valid
+        client = await self._connect()
+        stack.push_async_callback(client.logout)
+        await self._login(client)
+        if await client.examine(folder) != uidvalidity:
+            raise ImapError(f'{folder} UIDVALIDITY changed, uids have been reassigned')
+        return client
+
+    async def invalidated(self) -> list[str]:
+        # checkpointed folders whose uids have been reassigned since their
+        # checkpoint (UIDVALIDITY changed), see easy.email.ImapInbox
+        if not self.checkpoints:
+            return []
+        folders = []
+        semaphore = self._limiter.semaphore(self._conf['imap_server'])
+        async with contextlib.AsyncExitStack() as stack:
+            client = await self._open(stack, semaphore)
+            for folder, checkpoint in self.checkpoints.items():
+                try:
+                    uidvalidity = await client.examine(folder)
+                except ImapError:
+                    continue
+                if uidvalidity != checkpoint['uidvalidity']:
+                    folders.append(folder)
+        return folders
+
+    async def _fetch(
+        self, item: str, batch_size: int
+    ) -> collections.abc.AsyncGenerator[tuple[int, bytes], None]:
+        # yields (uid, item bytes) of every message after the checkpoint
+        folder = 'INBOX'
+        semaphore = self._limiter.semaphore(self._conf['imap_server'])
+        async with contextlib.AsyncExitStack() as stack:
+            client = await self._open(stack, semaphore)
+            uidvalidity = await client.examine(folder)
+            checkpoint = self._checkpoint(folder, uidvalidity)
+            uids = await client.uid_search(f"UID {checkpoint['uid'] + 1}:*")
+            # 'n:*' always matches the highest uid, even when lower than n
+            uids = [u for u in uids if int(u) > checkpoint['uid']]
+            batches = [uids[i:i+batch_size] for i in range(0, len(uids), batch_size)]
+            clients = [client]
+            while len(clients) < min(self._connections, len(batches)) \
+            and not semaphore.locked():
+                extra = await self._open(stack, semaphore)
+                await extra.examine(folder)
+                clients.append(extra)
+            # checkpoint moves forward only when every previous batch is consumed
+            consumed = set()
+            next_batch = 0
+            reopen = lambda: self._reopen(stack, folder, uidvalidity)
+            async for i, msgs in self._fetch_pipelined(clients, batches, item, reopen):
+                for uid, msg in msgs:
+                    yield uid, msg
+                    if i == next_batch:
+                        checkpoint['uid'] = max(checkpoint['uid'], uid)
+                consumed.add(i)
+                while next_batch in consumed:
+                    last_uid = int(batches[next_batch][-1])
+                    checkpoint['uid'] = max(checkpoint['uid'], last_uid)
+                    next_batch += 1
+
+    async def _fetch_pipelined(
+        self,
+        clients: list[AsyncImapClient],
+        batches: list[list[bytes]],
+        item: str,
+        reopen: collections.abc.Callable[[], collections.abc.Awaitable[AsyncImapClient]]
+    ) -> collections.abc.AsyncGenerator[tuple[int, list[tuple[int, bytes]]], None]:
+        # yields (batch index, batch messages), batches are spread across
+        # clients, at most pipeline batches per client are in flight.
+        # clients are replaced in place when dropped
+        max_pending = len(clients) * self._pipeline
+        pending: dict[asyncio.Task, int] = {}
+        replacing = [asyncio.Lock() for _ in clients]
+        try:
+            for i, batch in enumerate(batches):
+                await self._limiter.throttle(self._conf['imap_server'])
+                fetch = self._fetch_resuming(clients, replacing, i % len(clients), batch, item, reopen)
+                pending[asyncio.create_task(fetch)] = i
+                if len(pending) >= max_pending:
+                    yield await self._collect(pending)
+            while pending:
+                yield await self._collect(pending)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _fetch_resuming(
+        self,
+        clients: list[AsyncImapClient],
+        replacing: list[asyncio.Lock],
+        k: int,
+        uids: list[bytes],
+        item: str,
+        reopen: collections.abc.Callable[[], collections.abc.Awaitable[AsyncImapClient]]
+    ) -> list[tuple[int, bytes]]:
+        # fetches a batch on clients[k]. A dropped connection is replaced
+        # once, by the first of its batches failing, the others are sent
+        # again on the new connection: batches already fetched never are
+        for attempt in range(self._retries + 1):
+            client = clients[k]
+            try:
+                return await _fetch_batch(client, uids, item)
+            except ConnectionError:
+                if attempt == self._retries:
+                    raise
+            async with replacing[k]:
+                if clients[k] is not client:
+                    continue
+                await client.logout()
+                await asyncio.sleep(self._backoff * 2 ** attempt)
+                with contextlib.suppress(OSError, asyncio.IncompleteReadError):
+                    # retried with the dropped client otherwise
+                    clients[k] = await reopen()
+
+    async def _collect(
+        self, pending: dict[asyncio.Task, int]
+    ) -> tuple[int, list[tuple[int, bytes]]]:
+        # waits for a batch, see easy.pending
+        task, i = await easy.pending.pop_next_async(pending, self._ordered)
+        return i, task.result()
+
+    def _checkpoint(self, folder: str, uidvalidity: int) -> easy.email.ImapCheckpoint:
+        checkpoint = self.checkpoints.get(folder)
+        if checkpoint is None or checkpoint['uidvalidity'] != uidvalidity:
+            # first sync or uids have been reassigned, full resync
+            checkpoint = {'uidvalidity': uidvalidity, 'uid': 0}
+            self.checkpoints[folder] = checkpoint
+        return checkpoint
+
+
+async def _fetch_batch(
+    client: AsyncImapClient, uids: list[bytes], item: str
+) -> list[tuple[int, bytes]]:
+    # returns (uid, item bytes) sorted by uid
+    data = await client.uid_fetch(uids, item)
+    msgs = [
+        (easy.email._parse_fetch_uid(d[0]), d[1])
+        for d in data if isinstance(d, tuple)
+    ]
+    msgs.sort(key=lambda m: m[0])
+    return msgs
+
+
+K = typing.TypeVar('K')
+
+
+class FetchResult(typing.NamedTuple):
+    # None when every message has been fetched
+    error: BaseException | None
+    # from the start of the inbox job
+    seconds: float
+
+
+async def fetch_many(
+    inboxes: collections.abc.Mapping[K, AsyncImapInbox],
+    consume: collections.abc.Callable[[K, bytes], None],
+    *,
+    batch_size=100,
+    jobs: int | None = None
+) -> dict[K, FetchResult]:
+    # fetches inboxes concurrently, at most jobs at once (all by default),
+    # consume(key, msgb) is called as messages arrive.
+    # An inbox failing doesn't stop the others
+    semaphore = asyncio.Semaphore(jobs or max(len(inboxes), 1))
+
+    async def drain(key: K, inbox: AsyncImapInbox) -> FetchResult:
+        async with semaphore:
+            start = time.monotonic()
+            try:
+                async for msgb in inbox.fetch_raw(batch_size=batch_size):
+                    consume(key, msgb)
+            except Exception as e:
+                return FetchResult(e, time.monotonic() - start)
+            return FetchResult(None, time.monotonic() - start)
+
+    results = await asyncio.gather(
+        *(drain(key, inbox) for key, inbox in inboxes.items())
+    )
+    return dict(zip(inboxes, results))
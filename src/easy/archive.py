@@ -0,0 +1,223 @@
+import array
+import bisect
+import collections.abc
+import lzma
+import mmap
+import os
+import pathlib
+import struct
+import zlib
+import easy.mbox
+
+
+# Compressed archive of messages.
+# Messages are stored as they have been added (bytes unchanged, no escaping)
+# in blocks compressed independently, so that reading a message decompresses
+# its block only. Blocks are only ever appended.
+# Every block starts with a header holding its sizes and messages count:
+# the index (message number -> block) is rebuilt reading headers alone,
+# blocks torn by a crash are detected and dropped.
+# Uncompressed blocks are the lengths of their messages (little endian
+# uint64) followed by the messages.
+
+_block_magic = b'EASYARC1'
+# magic, codec, messages count, compressed size, uncompressed size,
+# crc32 of compressed data
+_block_header = struct.Struct('<8sBIQQI')
+
+CODECS = {'zlib': 1, 'lzma': 2}
+
+
+def is_archive(path: str | pathlib.Path) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(len(_block_magic)) == _block_magic
+
+
+class ArchiveIndex:
+
+    def __init__(self):
+        # offset of block headers
+        self.offsets = array.array('q')
+        # number of the first message of each block
+        self.firsts = array.array('q')
+        # messages in blocks
+        self.count = 0
+        # offset past the last valid block
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def scan(self, data: bytes | mmap.mmap, pos: int = 0):
+        # appends blocks found from pos, stops at the first torn block
+        while pos + _block_header.size <= len(data):
+            magic, codec, count, csize, _, _ = _block_header.unpack_from(data, pos)
+            end = pos + _block_header.size + csize
+            if magic != _block_magic or end > len(data):
+                break
+            self.offsets.append(pos)
+            self.firsts.append(self.count)
+            self.count += count
+            pos = end
+        self.size = pos
+
+    def locate(self, i: int) -> tuple[int, int]:
+        # (block number, message number within the block)
+        block = bisect.bisect_right(self.firsts, i) - 1
+        return block, i - self.firsts[block]
+
+
+def build_index(data: bytes | mmap.mmap) -> ArchiveIndex:
+    index = ArchiveIndex()
+    index.scan(data)
+    return index
+
+
+def read_block(data: bytes | mmap.mmap, offset: int) -> tuple[bytes, list[int]]:
+    # uncompressed block at offset and start of its messages in it,
+    # the end of the block included
+    magic, codec, count, csize, usize, crc = _block_header.unpack_from(data, offset)
+    start = offset + _block_header.size
+    compressed = data[start:start + csize]
+    if zlib.crc32(compressed) != crc:
+        raise ValueError(f'corrupted archive block at offset {offset}')
+    match codec:
+        case 1:
+            block = zlib.decompress(compressed)
+        case 2:
+            block = lzma.decompress(compressed, format=lzma.FORMAT_XZ)
+        case _:
+            raise ValueError(f'unknown archive codec {codec} at offset {offset}')
+    if len(block) != usize:
+        raise ValueError(f'corrupted archive block at offset {offset}')
+    lengths = struct.unpack_from(f'<{count}Q', block)
+    starts = [8 * count]
+    for n in lengths:
+        starts.append(starts[-1] + n)
+    return block, starts
+
+
+class ArchiveReader:
+
+    # Messages of an archive by number. The last block read is kept
+    # decompressed, reading messages in order decompresses every block once.
+
+    def __init__(self, path: str | pathlib.Path):
+        self._map = easy.mbox.open_mmap(pathlib.Path(path))
+        self.index = build_index(self._map)
+        self._block = -1
+        self._data = b''
+        self._starts: list[int] = []
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+
+    def locate(self, i: int) -> tuple[bytes, int, int]:
+        # (uncompressed block, start, stop) of message i
+        block, n = self.index.locate(i)
+        if block != self._block:
+            self._data, self._starts = read_block(self._map, self.index.offsets[block])
+            self._block = block
+        return self._data, self._starts[n], self._starts[n + 1]
+
+
+class ArchiveWriter:
+
+    # Appends RFC822 messages to an archive, creating it if missing.
+    # Messages are compressed a block at a time, a block is written when
+    # its messages exceed block_size bytes. Every sync_every messages the
+    # pending block is written, the file is flushed and fsync'ed, then
+    # on_sync is called: a crash loses at most the messages added after
+    # the last sync. A block torn by a crash is overwritten.
+
+    def __init__(
+        self,
+        path: str | pathlib.Path,
+        *,
+        codec: str = 'zlib',
+        level: int | None = None,
+        block_size: int = 1 << 20,
+        sync_every: int = 100,
+        on_sync: collections.abc.Callable[[], None] | None = None
+    ):
+        if codec not in CODECS:
+            raise ValueError(f'unknown codec {codec}, expected one of {list(CODECS)}')
+        path = pathlib.Path(path)
+        path.touch()
+        data = easy.mbox.open_mmap(path)
+        try:
+            if not _block_magic.startswith(bytes(data[:len(_block_magic)])):
+                raise ValueError(f'{path} is not an archive')
+            size = build_index(data).size
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+        self._file = open(path, 'r+b')
+        self._file.truncate(size)
+        self._file.seek(size)
+        self._codec = codec
+        self._level = level
+        self._block_size = block_size
+        self._sync_every = sync_every
+        self._on_sync = on_sync
+        self._unsynced = 0
+        self._pending: list[bytes] = []
+        self._pending_size = 0
+
+    def add(self, msgb: bytes):
+        # messages added until now are synced before writing a new one,
+        # so that on_sync is called while msgb is not written yet
+        if self._unsynced >= self._sync_every:
+            self.sync()
+        self._pending.append(bytes(msgb))
+        self._pending_size += len(msgb)
+        self._unsynced += 1
+        if self._pending_size >= self._block_size:
+            self._write_block()
+
+    def _write_block(self):
+        if not self._pending:
+            return
+        lengths = struct.pack(f'<{len(self._pending)}Q', *map(len, self._pending))
+        block = b''.join([lengths, *self._pending])
+        if self._codec == 'zlib':
+            compressed = zlib.compress(block, -1 if self._level is None else self._level)
+        else:
+            compressed = lzma.compress(block, format=lzma.FORMAT_XZ, preset=self._level)
+        self._file.write(_block_header.pack(
+            _block_magic,
+            CODECS[self._codec],
+            len(self._pending),
+            len(compressed),
+            len(block),
+            zlib.crc32(compressed)
+        ))
+        self._file.write(compressed)
+        self._pending = []
+        self._pending_size = 0
+
+    def sync(self):
+        self._write_block()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        if self._on_sync:
+            self._on_sync()
+
+    def close(self):
+        if self._file.closed:
+            return
+        try:
+            self.sync()
+        finally:
+            self._file.close()
+
+    def __enter__(self) -> 'ArchiveWriter':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,6 +1,6 @@
 import typing
 import collections.abc
-from requests_oauthlib import OAuth2Session
+import time
 
 class OAuthConf(typing.TypedDict):
     auth_uri: str
@@ -20,8 +20,11 @@ class OauthInteractiveAuthenticator:
     ):
         self._conf = conf
         self._user_prompt = user_prompt
+        # requests_oauthlib is slow to import, it is needed by logins and
+        # token refreshes only
+        import requests_oauthlib
         # TODO here I can pass token state (token=load_...)
-        self._oauth = OAuth2Session(
+        self._oauth = requests_oauthlib.OAuth2Session(
             conf.get('client_id'),
             scope=conf.get('scopes'),
             redirect_uri=conf.get('redirect_uri')
@@ -50,3 +53,24 @@ class OauthInteractiveAuthenticator:
             include_client_id=True
         )
         return token_res
+
+
+def refresh_credentials(conf: OAuthConf, credentials: dict) -> dict:
+    # credentials with a new access token obtained by the refresh token,
+    # which is kept when the server doesn't issue a new one
+    import requests_oauthlib
+    oauth = requests_oauthlib.OAuth2Session(conf.get('client_id'), token=credentials)
+    token_res = oauth.refresh_token(
+        conf.get('refresh_uri') or conf.get('token_uri'),
+        refresh_token=credentials['refresh_token'],
+        client_id=conf.get('client_id'),
+        client_secret=conf.get('client_secret', None)
+    )
+    return {'user': credentials['user']} | token_res
+
+
+def expired(credentials: dict, *, margin: float = 60) -> bool:
+    # whether the access token expires within margin seconds,
+    # False when the expiration is unknown
+    expires_at = credentials.get('expires_at')
+    return expires_at is not None and expires_at - margin < time.time()
@@ -0,0 +1,199 @@
+import typing
+import collections.abc
+import email
+import email.policy
+import hashlib
+import json
+import pathlib
+import sqlite3
+import easy.features
+import easy.profiling
+
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS features (
+    key BLOB NOT NULL,
+    version INTEGER NOT NULL,
+    features TEXT NOT NULL,
+    msgid TEXT,
+    -- increasing with every use, the least recently used entry is the lowest
+    used INTEGER NOT NULL,
+    -- bytes of key, features and msgid
+    size INTEGER NOT NULL,
+    PRIMARY KEY (key, version)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS features_used ON features (used);
+'''
+
+
+class FeatureCache:
+
+    # Features of evaluated messages, stored in sqlite.
+    # Entries are keyed by sha256 of the raw message and by features version
+    # (easy.features.FEATURES_VERSION). Least recently used entries are
+    # evicted beyond max_bytes of entries whenever inserts are committed, and
+    # when the cache is closed, so that interrupted runs keep it bounded as
+    # well. The database file is larger than its entries (sqlite pages and
+    # indexes), and is not shrunk by evictions: freed pages are reused.
+
+    def __init__(
+        self,
+        path: str | pathlib.Path,
+        *,
+        max_bytes: int = 1 << 30,
+        version: int = easy.features.FEATURES_VERSION,
+        commit_every: int = 1000
+    ):
+        self._db = sqlite3.connect(path)
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        self._migrate()
+        self._db.executescript(_schema)
+        self._max_bytes = max_bytes
+        self._version = version
+        self._commit_every = commit_every
+        # entries hit in this run are marked as used in batches, as
+        # (use, key)
+        self._clock = self._db.execute('SELECT COALESCE(MAX(used), 0) FROM features').fetchone()[0]
+        self._used: list[tuple[int, bytes]] = []
+        self._uncommitted = 0
+        self._bytes = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM features').fetchone()[0]
+
+    def _migrate(self):
+        columns = {row[1] for row in self._db.execute('PRAGMA table_info(features)')}
+        if not columns or 'size' in columns:
+            return
+        # caches without sizes, used were timestamps and stay lower than uses
+        self._db.executescript('''
+            ALTER TABLE features ADD COLUMN size INTEGER NOT NULL DEFAULT 0;
+            UPDATE features SET size = length(key) + length(CAST(features AS BLOB))
+                + COALESCE(length(CAST(msgid AS BLOB)), 0);
+        ''')
+        self._db.commit()
+
+    def _use(self) -> int:
+        self._clock += 1
+        return self._clock
+
+    @staticmethod
+    def key(raw: bytes) -> bytes:
+        return hashlib.sha256(raw).digest()
+
+    def get(
+        self, key: bytes
+    ) -> tuple[easy.features.Features, str | None] | None:
+        row = self._db.execute(
+            'SELECT features, msgid FROM features WHERE key = ? AND version = ?',
+            (key, self._version)
+        ).fetchone()
+        if row is None:
+            return None
+        self._used.append((self._use(), key))
+        if len(self._used) >= self._commit_every:
+            self.commit()
+        return json.loads(row[0]), row[1]
+
+    def put(
+        self, key: bytes, features: easy.features.Features, msgid: str | None
+    ):
+        data = json.dumps(features)
+        size = len(key) + len(data.encode()) + (len(msgid.encode()) if msgid is not None else 0)
+        self._db.execute(
+            'INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?, ?)',
+            (key, self._version, data, msgid, self._use(), size)
+        )
+        self._bytes += size
+        self._uncommitted += 1
+        if self._uncommitted >= self._commit_every:
+            self.commit()
+            if self._bytes > self._max_bytes:
+                self.evict()
+
+    def commit(self):
+        self._db.executemany(
+            'UPDATE features SET used = ? WHERE key = ? AND version = ?',
+            ((used, key, self._version) for used, key in self._used)
+        )
+        self._db.commit()
+        self._used = []
+        self._uncommitted = 0
+
+    def __len__(self) -> int:
+        return self._db.execute('SELECT COUNT(*) FROM features').fetchone()[0]
+
+    def evict(self):
+        # least recently used entries first, uses not committed yet included
+        self.commit()
+        self._bytes = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM features').fetchone()[0]
+        if self._bytes <= self._max_bytes:
+            return
+        evicted = []
+        freed = 0
+        for key, version, size in self._db.execute(
+            'SELECT key, version, size FROM features ORDER BY used'
+        ):
+            if self._bytes - freed <= self._max_bytes:
+                break
+            evicted.append((key, version))
+            freed += size
+        self._db.executemany('DELETE FROM features WHERE key = ? AND version = ?', evicted)
+        self._db.commit()
+        self._bytes -= freed
+
+    def clear(self, *, outdated_only: bool = False) -> int:
+        # returns the number of entries removed
+        if outdated_only:
+            cur = self._db.execute(
+                'DELETE FROM features WHERE version != ?', (self._version,)
+            )
+        else:
+            cur = self._db.execute('DELETE FROM features')
+        self._db.commit()
+        self._bytes = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM features').fetchone()[0]
+        self._db.execute('VACUUM')
+        return cur.rowcount
+
+    def close(self):
+        try:
+            self.evict()
+        finally:
+            self._db.close()
+
+    def __enter__(self) -> 'FeatureCache':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def evaluate_cached(
+    raws: collections.abc.Iterable[bytes],
+    cache: FeatureCache | None,
+    *,
+    profiler: easy.profiling.Profiler | None = None
+) -> typing.Generator[tuple[easy.features.Features, str | None], None, None]:
+    # messages found in cache are neither parsed nor evaluated.
+    # Messages failing evaluation are reported as evaluate() does and skipped.
+    for raw in raws:
+        key = None
+        if cache is not None:
+            key = cache.key(raw)
+            hit = cache.get(key)
+            if hit is not None:
+                yield hit
+                continue
+        if profiler is None:
+            msg = email.message_from_bytes(raw, policy=email.policy.default)
+            features = easy.features.evaluate(msg)
+        else:
+            msg, features, error = profiler.evaluate(raw)
+            if error is not None:
+                easy.features.report_error(error, msg.get('message-id'))
+        if features is None:
+            continue
+        msgid = msg.get('message-id')
+        msgid = str(msgid) if msgid is not None else None
+        if cache is not None:
+            cache.put(key, features, msgid)
+        yield features, msgid
+
@@ -5,17 +5,74 @@ import email.message
 import email.policy
 import base64
 import abc
-from requests_oauthlib import OAuth2Session
-import mailbox
 import inspect
+import re
+import queue
+import concurrent.futures
+import copy
+import functools
+import mmap
+import pathlib
+import contextlib
+import threading
+import weakref
+import time
+import datetime
+import email.parser
+import easy.archive
+import easy.auth
+import easy.mbox
+import easy.message
+import easy.pending
+import easy.structure
 
 
 class Inbox(abc.ABC):
 
     @abc.abstractmethod
-    def fetch(self, *, batch_size=100):
+    def fetch_raw(self, *, batch_size=100) -> typing.Generator[bytes, None, None]:
+        # yields messages as RFC822 bytes, as they have been stored
         pass
 
+    def fetch(
+        self, *, batch_size=100
+    ) -> typing.Generator[email.message.EmailMessage, None, None]:
+        for msgb in self.fetch_raw(batch_size=batch_size):
+            yield email.message_from_bytes(msgb, policy=email.policy.default)
+
+    def fetch_raw_headers(
+        self, *, batch_size=100
+    ) -> typing.Generator[bytes, None, None]:
+        # yields messages headers, blank line included.
+        # Inboxes able to skip bodies should override it
+        for msgb in self.fetch_raw(batch_size=batch_size):
+            yield msgb[:_headers_end(msgb, 0, len(msgb))]
+
+    def fetch_headers(
+        self, *, batch_size=100
+    ) -> typing.Generator[email.message.EmailMessage, None, None]:
+        # messages without body
+        for headers in self.fetch_raw_headers(batch_size=batch_size):
+            yield _parse_bytes(headers, headersonly=True)
+
+    def fetch_lazy(
+        self, *, batch_size=100
+    ) -> typing.Generator[easy.message.LazyMessage, None, None]:
+        # messages whose body is loaded on demand.
+        # Inboxes able to skip bodies should override it
+        for msgb in self.fetch_raw(batch_size=batch_size):
+            headers = _parse_bytes(
+                msgb[:_headers_end(msgb, 0, len(msgb))], headersonly=True
+            )
+            yield easy.message.LazyMessage(headers, functools.partial(_parse_bytes, msgb))
+
+    def fetch_structured(
+        self, *, batch_size=100
+    ) -> typing.Generator[easy.message.LazyMessage, None, None]:
+        # lazy messages whose body features are computed from the message
+        # structure, fetching as little as possible (see ImapInbox)
+        yield from self.fetch_lazy(batch_size=batch_size)
+
 
 class ImapConf(typing.TypedDict):
     imap_server: str
@@ -24,45 +81,652 @@ class ImapConf(typing.TypedDict):
     
 _imap_annotations = inspect.get_annotations(ImapConf)
 
+class ImapCheckpoint(typing.TypedDict):
+    uidvalidity: int
+    # highest uid fetched
+    uid: int
+
+
+class SearchFilter(typing.TypedDict, total=False):
+    # received on or after since, before before (IMAP internal date). Local
+    # stores match the Date header of messages imported from files, which
+    # carry no internal date
+    since: datetime.date
+    before: datetime.date
+    # substring of the From header, display names included
+    sender: str
+    # sender domain, subdomains included. IMAP servers match it as a
+    # substring of the From header
+    domain: str
+    # names of headers messages must have, e.g. 'List-Unsubscribe'
+    headers: list[str]
+    # size bounds in bytes, exclusive
+    larger: int
+    smaller: int
+
+
+_imap_months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+
+def search_criteria(search: SearchFilter) -> str:
+    # IMAP SEARCH criteria (RFC 3501) matched by messages passing every
+    # filter, empty when there are none
+    criteria = []
+    if 'since' in search:
+        criteria.append(f"SINCE {_imap_date(search['since'])}")
+    if 'before' in search:
+        criteria.append(f"BEFORE {_imap_date(search['before'])}")
+    if 'sender' in search:
+        criteria.append(f"FROM {_imap_quote(search['sender'])}")
+    if 'domain' in search:
+        criteria.append(f"FROM {_imap_quote(search['domain'])}")
+    for name in search.get('headers', []):
+        # any value, headers missing don't match
+        criteria.append(f'HEADER {_imap_quote(name)} ""')
+    if 'larger' in search:
+        criteria.append(f"LARGER {int(search['larger'])}")
+    if 'smaller' in search:
+        criteria.append(f"SMALLER {int(search['smaller'])}")
+    return ' '.join(criteria)
+
+
+def _imap_date(date: datetime.date) -> str:
+    # e.g. 1-Mar-2024, month names are not localized
+    return f'{date.day}-{_imap_months[date.month - 1]}-{date.year}'
+
+
+def _imap_quote(value: str) -> str:
+    # non-ASCII strings would need a charset and literals
+    if not value.isascii() or '\r' in value or '\n' in value:
+        raise ValueError(f"unsupported search string: {value!r}")
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
 class ImapInbox(Inbox):
 
-    def __init__(self, conf: ImapConf, credentials: dict):
-        self._client = imaplib.IMAP4_SSL(conf['imap_server'], conf['imap_port'])
-        login_fn = _login_imap(credentials)
-        login_fn(self._client)
+    def __init__(
+        self, 
+        conf: ImapConf, 
+        credentials: dict,
+        checkpoints: dict[str, ImapCheckpoint] | None = None,
+        *,
+        connections: int = 1,
+        ordered: bool = True,
+        refresh: collections.abc.Callable[[dict], dict] | None = None,
+        retries: int = 5,
+        backoff: float = 1.0,
+        search: SearchFilter | None = None,
+        folders: collections.abc.Sequence[str] = ('INBOX',),
+        identities: list[str] | None = None
+    ):
+        self._conf = conf
+        self._credentials = credentials
+        # returns credentials with a new access token (see
+        # easy.auth.refresh_credentials), tokens are never refreshed if None
+        self._refresh = refresh
+        self._refreshing = threading.Lock()
+        # a dropped connection is replaced up to retries times per batch,
+        # waiting backoff seconds, doubled on every attempt
+        self._retries = retries
+        self._backoff = backoff
+        # only messages matching are fetched, filtered by the server
+        self._criteria = search_criteria(search) if search else ''
+        # folder names or LIST patterns, e.g. '*' for every folder
+        self._folders = folders
+        # client -> folder selected, clients fetching another folder select
+        # theirs first (see _fetch_resuming)
+        self._selected: weakref.WeakKeyDictionary[imaplib.IMAP4, str] = weakref.WeakKeyDictionary()
+        self._client = self._connect()
+        # folder -> checkpoint, only messages after the checkpoint are fetched.
+        # Checkpoints are updated as messages are consumed.
+        self.checkpoints = checkpoints if checkpoints is not None else {}
+        # identities of messages consumed by fetches of several folders (see
+        # _unseen), messages filed in another folder after they have been
+        # fetched are duplicates in later runs too. Stored along checkpoints,
+        # updated as messages are consumed.
+        self.identities = identities if identities is not None else []
+        # batches are split across connections when > 1,
+        # keep it under the provider limit of concurrent connections.
+        self._connections = connections
+        # messages are yielded by uid, unordered yields batches as they arrive
+        self._ordered = ordered
 
-    def fetch(
+    def _open(self) -> imaplib.IMAP4:
+        return imaplib.IMAP4_SSL(self._conf['imap_server'], self._conf['imap_port'])
+
+    def _connect(self) -> imaplib.IMAP4:
+        # the access token is refreshed when expired, or refused by the server
+        credentials = self._credentials
+        if self._refresh is not None and credentials.get('refresh_token') \
+        and easy.auth.expired(credentials):
+            credentials = self._refresh_credentials(credentials)
+        client = self._open()
+        try:
+            _login_imap(credentials)(client)
+        except imaplib.IMAP4.abort:
+            raise
+        except imaplib.IMAP4.error:
+            if self._refresh is None or not credentials.get('refresh_token'):
+                raise
+            _login_imap(self._refresh_credentials(credentials))(client)
+        return client
+
+    def _refresh_credentials(self, stale: dict) -> dict:
+        # connections of this inbox refresh the token once
+        with self._refreshing:
+            if self._credentials is stale:
+                self._credentials = self._refresh(stale)
+            return self._credentials
+
+    def _reconnect(self, folder: str) -> imaplib.IMAP4:
+        # a new connection having folder selected
+        client = self._connect()
+        try:
+            self._select_checked(client, folder)
+        except imaplib.IMAP4.error:
+            _logout(client)
+            raise
+        return client
+
+    def _select(self, client: imaplib.IMAP4, folder: str) -> tuple[str, list]:
+        status, data = _select(client, folder)
+        if status == 'OK':
+            self._selected[client] = folder
+        else:
+            self._selected.pop(client, None)
+        return status, data
+
+    def _select_checked(self, client: imaplib.IMAP4, folder: str):
+        # selects folder again, uids must still be valid
+        status, _ = self._select(client, folder)
+        typ, data = client.response('UIDVALIDITY')
+        if status != 'OK' or int(data[0]) != self.checkpoints[self._checkpoint_key(folder)]['uidvalidity']:
+            self._selected.pop(client, None)
+            raise imaplib.IMAP4.error(f'{folder} UIDVALIDITY changed, uids have been reassigned')
+
+    def _fetch_resuming(
+        self,
+        client: imaplib.IMAP4,
+        folder: str,
+        fetch_batch: '_FetchBatch',
+        uids: list[bytes]
+    ) -> tuple[imaplib.IMAP4, list[tuple[int, typing.Any]]]:
+        # fetches a batch of folder, returns the client that fetched it
+        # (a new one when client is None).
+        # Dropped connections and expired sessions (BYE) are replaced, the
+        # batch is fetched again: batches already fetched never are
+        main = client is self._client
+        for attempt in range(self._retries + 1):
+            try:
+                if client is None:
+                    client = self._reconnect(folder)
+                    if main:
+                        self._client = client
+                elif self._selected.get(client) != folder:
+                    # e.g. bodies loaded after the main connection moved on
+                    self._select_checked(client, folder)
+                return client, fetch_batch(client, uids)
+            except (imaplib.IMAP4.abort, OSError):
+                if attempt == self._retries:
+                    raise
+                if client is not None:
+                    _shutdown(client)
+                client = None
+                time.sleep(self._backoff * 2 ** attempt)
+
+    def list_folders(self, pattern: str = '*') -> list[str]:
+        # names of selectable folders matching an IMAP LIST pattern
+        typ, data = self._client.list('""', _imap_quote(pattern))
+        if typ != 'OK':
+            return []
+        values = easy.structure.parse_list(data)
+        # (flags, delimiter, name)
+        return [
+            name for flags, _, name in values
+            if not any(f.lower() == '\\noselect' for f in flags)
+        ]
+
+    def folders(self) -> list[str]:
+        # folders fetched, in order, patterns expanded
+        folders = []
+        for f in self._folders:
+            names = self.list_folders(f) if '*' in f or '%' in f else [f]
+            folders += [n for n in names if n not in folders]
+        return folders
+
+    def fetch_raw(
         self, *, batch_size=100
-    ) -> typing.Generator[email.message.EmailMessage, None, None]:
-        # TODO handle exceptions
-        status, data = self._client.select('INBOX', readonly='True')
+    ) -> typing.Generator[bytes, None, None]:
+        for _, _, _, msgb in self._fetch(_fetch_rfc822, batch_size):
+            yield msgb
+
+    def fetch_raw_dated(
+        self, *, batch_size=100
+    ) -> typing.Generator[tuple[int | None, bytes], None, None]:
+        # yields (internal date as POSIX timestamp, message), None when the
+        # server sends no valid date
+        for _, _, _, dated in self._fetch(_fetch_dated, batch_size):
+            yield dated
+
+    def fetch_raw_headers(
+        self, *, batch_size=100
+    ) -> typing.Generator[bytes, None, None]:
+        # headers only, PEEK never sets the \Seen flag
+        for _, _, _, headersb in self._fetch(_fetch_headers, batch_size):
+            yield headersb
+
+    def fetch_lazy(
+        self, *, batch_size=100
+    ) -> typing.Generator[easy.message.LazyMessage, None, None]:
+        # Headers are fetched in batches. Loading a body fetches it along
+        # with bodies of the following messages in the same batch, which
+        # are likely to be needed as well, messages already consumed are
+        # not fetched again.
+        bodies = _Bodies(self)
+        loader = None
+        try:
+            for folder, batch, uid, headersb in self._fetch(_fetch_headers, batch_size):
+                if loader is None or loader.batch is not batch:
+                    loader = _BodyLoader(bodies, folder, batch)
+                headers = _parse_bytes(headersb, headersonly=True)
+                yield easy.message.LazyMessage(headers, functools.partial(loader.load, uid))
+        finally:
+            bodies.close()
+
+    def fetch_structured(
+        self, *, batch_size=100
+    ) -> typing.Generator[easy.message.LazyMessage, None, None]:
+        # Headers and BODYSTRUCTURE are fetched in batches. Body analysis
+        # fetches text parts only, other parts are sized from the structure
+        # (see easy.structure). Messages are loaded as fetch_lazy does.
+        bodies = _Bodies(self)
+        loader = None
+        try:
+            for folder, batch, uid, (headersb, root) in self._fetch(_fetch_structures, batch_size):
+                if loader is None or loader.batch is not batch:
+                    loader = _BodyLoader(bodies, folder, batch)
+                headers = _parse_bytes(headersb, headersonly=True)
+                fetch = functools.partial(bodies.fetch_sections, folder, uid)
+                yield easy.message.LazyMessage(
+                    headers,
+                    functools.partial(loader.load, uid),
+                    functools.partial(easy.structure.analyze, root, headersb, fetch)
+                )
+        finally:
+            bodies.close()
+
+    def _fetch(
+        self, fetch_batch: '_FetchBatch', batch_size: int
+    ) -> typing.Generator[tuple[str, list[bytes], int, typing.Any], None, None]:
+        # yields (folder, batch uids, uid, fetched data) of every message
+        # after the checkpoints, a folder at a time.
+        # Messages found in more than one folder are fetched from the first
+        # one only, duplicates are skipped before fetching (see _unseen)
+        folders = self.folders()
+        seen = set(self.identities) if len(folders) > 1 else None
+        for folder in folders:
+            yield from self._fetch_folder(folder, fetch_batch, batch_size, seen)
+
+    def _fetch_folder(
+        self,
+        folder: str,
+        fetch_batch: '_FetchBatch',
+        batch_size: int,
+        seen: set | None
+    ) -> typing.Generator[tuple[str, list[bytes], int, typing.Any], None, None]:
+        # Batches are fetched resuming (see _fetch_resuming)
+        status, data = self._select(self._client, folder)
         if status != 'OK':
             #print('imap select error')
             return
-        status, data = self._client.search(None, 'ALL')
+        checkpoint = self._checkpoint(folder)
+        status, data = self._client.uid(
+            'SEARCH', None, f"UID {checkpoint['uid'] + 1}:* {self._criteria}".rstrip()
+        )
         if status != 'OK':
             #print('imap search error')
             return
-        ids = data[0].split()
-        for i in range(0, len(ids), batch_size):
-            batch_ids = b','.join(ids[i:i+batch_size]).decode('UTF-8')
-            typ, data = self._client.fetch(batch_ids, '(RFC822)')
-            msgs = map(
-                lambda d: email.message_from_bytes(d[1], policy=email.policy.default), 
-                filter(
-                    lambda d: isinstance(d, tuple), 
-                    data
-                )
+        # 'n:*' always matches the highest uid, even when lower than n
+        uids = [u for u in data[0].split() if int(u) > checkpoint['uid']]
+        last_uid = int(uids[-1]) if uids else 0
+        # uid -> identity, of messages to be fetched
+        identities = {}
+        if seen is not None:
+            uids = self._unseen(folder, uids, batch_size, seen, identities)
+        batches = [uids[i:i+batch_size] for i in range(0, len(uids), batch_size)]
+        if self._connections > 1 and len(batches) > 1:
+            fetched = self._fetch_concurrently(folder, batches, fetch_batch)
+        else:
+            fetched = (
+                (i, self._fetch_resuming(self._client, folder, fetch_batch, b)[1])
+                for i, b in enumerate(batches)
             )
-            for m in msgs:
-                yield m
+        # checkpoint moves forward only when every previous batch is consumed
+        consumed = set()
+        next_batch = 0
+        for i, msgs in fetched:
+            for uid, msg in msgs:
+                yield folder, batches[i], uid, msg
+                if uid in identities:
+                    self.identities.append(identities[uid])
+                if i == next_batch:
+                    checkpoint['uid'] = max(checkpoint['uid'], uid)
+            consumed.add(i)
+            while next_batch in consumed:
+                checkpoint['uid'] = max(checkpoint['uid'], int(batches[next_batch][-1]))
+                next_batch += 1
+        # duplicates after the last message fetched
+        checkpoint['uid'] = max(checkpoint['uid'], last_uid)
+
+    def _unseen(
+        self, folder: str, uids: list[bytes], batch_size: int, seen: set, unseen_identities: dict
+    ) -> list[bytes]:
+        # uids of messages not in seen, whose identities are added to it
+        # and to unseen_identities (by uid).
+        # Identities are fetched in batches, bodies never are: X-GM-MSGID
+        # on Gmail, Message-ID and size elsewhere. Messages without one
+        # are never duplicates.
+        if 'X-GM-EXT-1' in self._client.capabilities:
+            fetch_identities = _fetch_gmail_ids
+        else:
+            fetch_identities = _fetch_message_ids
+        unseen = []
+        for i in range(0, len(uids), batch_size):
+            batch = uids[i:i + batch_size]
+            _, identities = self._fetch_resuming(self._client, folder, fetch_identities, batch)
+            identities = dict(identities)
+            for u in batch:
+                identity = identities.get(int(u))
+                if identity is None:
+                    unseen.append(u)
+                    continue
+                # strings, stored as JSON
+                identity = f'X-GM-MSGID {identity}' if isinstance(identity, int) else f'{identity[1]} {identity[0]}'
+                if identity not in seen:
+                    seen.add(identity)
+                    unseen_identities[int(u)] = identity
+                    unseen.append(u)
+        return unseen
+
+    def _fetch_concurrently(
+        self, folder: str, batches: list[list[bytes]], fetch_batch: '_FetchBatch'
+    ) -> typing.Generator[tuple[int, list[tuple[int, typing.Any]]], None, None]:
+        # yields (batch index, batch messages).
+        # Every connection fetches a batch at a time, at most 2 batches
+        # per connection are waiting to be consumed.
+        connections = min(self._connections, len(batches))
+        clients = queue.Queue()
+        clients.put(self._client)
+        try:
+            for _ in range(connections - 1):
+                client = self._connect()
+                clients.put(client)
+                self._select(client, folder)
+
+            def fetch(uids: list[bytes]) -> list[tuple[int, bytes]]:
+                client = clients.get()
+                try:
+                    client, msgs = self._fetch_resuming(client, folder, fetch_batch, uids)
+                    return msgs
+                finally:
+                    clients.put(client)
+
+            max_pending = connections * 2
+            with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as pool:
+                pending: dict[concurrent.futures.Future, int] = {}
+                for i, batch in enumerate(batches):
+                    pending[pool.submit(fetch, batch)] = i
+                    if len(pending) >= max_pending:
+                        yield self._collect(pending)
+                while pending:
+                    yield self._collect(pending)
+        finally:
+            # connections may have been replaced, the main one included
+            while not clients.empty():
+                client = clients.get_nowait()
+                if client is not self._client:
+                    _logout(client)
+
+    def _collect(
+        self, pending: dict[concurrent.futures.Future, int]
+    ) -> tuple[int, list[tuple[int, bytes]]]:
+        # waits for a batch, see easy.pending
+        future, i = easy.pending.pop_next(pending, self._ordered)
+        return i, future.result()
+
+    def _checkpoint(self, folder: str) -> ImapCheckpoint:
+        # folder must be selected
+        typ, data = self._client.response('UIDVALIDITY')
+        uidvalidity = int(data[0])
+        key = self._checkpoint_key(folder)
+        checkpoint = self.checkpoints.get(key)
+        if checkpoint is None or checkpoint['uidvalidity'] != uidvalidity:
+            # first sync or uids have been reassigned, full resync
+            checkpoint = {'uidvalidity': uidvalidity, 'uid': 0}
+            self.checkpoints[key] = checkpoint
+        return checkpoint
+
+    def invalidated(self) -> list[str]:
+        # folders whose uids have been reassigned since their checkpoint
+        # (UIDVALIDITY changed), they would be fetched again from the start
+        folders = []
+        for folder in self.folders():
+            checkpoint = self.checkpoints.get(self._checkpoint_key(folder))
+            if checkpoint is None or self._select(self._client, folder)[0] != 'OK':
+                continue
+            typ, data = self._client.response('UIDVALIDITY')
+            if int(data[0]) != checkpoint['uidvalidity']:
+                folders.append(folder)
+        return folders
+
+    def _checkpoint_key(self, folder: str) -> str:
+        # filtered fetches are checkpointed apart, the folder checkpoint
+        # never moves past messages not matched
+        return f'{folder} {self._criteria}' if self._criteria else folder
+
+
+class _Bodies:
+
+    # connection loading bodies of lazy messages, which may be loaded once
+    # the iteration has moved to another folder. The main connection when
+    # it is the only one, otherwise concurrent fetches use it and bodies
+    # get their own. Folders are selected again when needed, fetches are
+    # resumed as batches are (see ImapInbox._fetch_resuming).
+
+    def __init__(self, inbox: ImapInbox):
+        self._inbox = inbox
+        # opened on first use
+        self._client: imaplib.IMAP4 | None = None
+
+    def fetch(self, folder: str, fetch_batch: '_FetchBatch', uids: list[bytes]) -> list:
+        inbox = self._inbox
+        if inbox._connections == 1:
+            return inbox._fetch_resuming(inbox._client, folder, fetch_batch, uids)[1]
+        self._client, data = inbox._fetch_resuming(self._client, folder, fetch_batch, uids)
+        return data
+
+    def fetch_sections(
+        self, folder: str, uid: int, sections: list[easy.structure.Section]
+    ) -> dict[easy.structure.Section, bytes]:
+        fetch = lambda client, uids: _fetch_sections(client, uid, sections)
+        return self.fetch(folder, fetch, [str(uid).encode()])
+
+    def close(self):
+        if self._client is not None:
+            _logout(self._client)
+            self._client = None
+
+
+class _BodyLoader:
+
+    # bodies of a batch of messages, fetched on demand
+
+    def __init__(self, bodies: _Bodies, folder: str, batch: list[bytes]):
+        self._connection = bodies
+        self._folder = folder
+        self.batch = batch
+        self._bodies: dict[int, bytes] = {}
+        self._fetched: set[int] = set()
+
+    def load(self, uid: int) -> email.message.EmailMessage:
+        if uid not in self._bodies:
+            uids = [
+                u for u in self.batch
+                if int(u) >= uid and int(u) not in self._fetched
+            ]
+            self._fetched.update(int(u) for u in uids)
+            self._bodies.update(self._connection.fetch(self._folder, _fetch_batch, uids))
+        # a body is loaded once, LazyMessage keeps it
+        return _parse_bytes(self._bodies.pop(uid))
+
+
+def _select(client: imaplib.IMAP4, folder: str) -> tuple[str, list]:
+    # read-only, names are quoted (e.g. '[Gmail]/All Mail')
+    return client.select(_imap_quote(folder), readonly='True')
+
+
+def _logout(client: imaplib.IMAP4):
+    with contextlib.suppress(imaplib.IMAP4.error, OSError):
+        client.logout()
+
+
+def _shutdown(client: imaplib.IMAP4):
+    # dropped connections can't log out
+    with contextlib.suppress(OSError):
+        client.shutdown()
+
+
+def _fetch_batch(
+    client: imaplib.IMAP4, uids: list[bytes], item: str = '(RFC822)'
+) -> list[tuple[int, bytes]]:
+    # returns (uid, item bytes) sorted by uid
+    batch_uids = b','.join(uids).decode('UTF-8')
+    typ, data = client.uid('FETCH', batch_uids, item)
+    msgs = [
+        (_parse_fetch_uid(d[0]), d[1]) 
+        for d in data if isinstance(d, tuple)
+    ]
+    msgs.sort(key=lambda m: m[0])
+    return msgs
+
+
+# (uid, fetched data) sorted by uid
+_FetchBatch = collections.abc.Callable[
+    [imaplib.IMAP4, list[bytes]], list[tuple[int, typing.Any]]
+]
+
+_fetch_rfc822 = functools.partial(_fetch_batch, item='(RFC822)')
+_fetch_headers = functools.partial(_fetch_batch, item='(BODY.PEEK[HEADER])')
+
+
+def _fetch_structures(
+    client: imaplib.IMAP4, uids: list[bytes]
+) -> list[tuple[int, tuple[bytes, easy.structure.Part]]]:
+    # returns (uid, (headers, structure)) sorted by uid
+    batch_uids = b','.join(uids).decode('UTF-8')
+    typ, data = client.uid('FETCH', batch_uids, '(BODY.PEEK[HEADER] BODYSTRUCTURE)')
+    msgs = [
+        (items['UID'], (items['BODY[HEADER]'], easy.structure.parse_bodystructure(items['BODYSTRUCTURE'])))
+        for _, items in easy.structure.parse_fetch(data)
+    ]
+    msgs.sort(key=lambda m: m[0])
+    return msgs
+
+
+def _fetch_dated(
+    client: imaplib.IMAP4, uids: list[bytes]
+) -> list[tuple[int, tuple[int | None, bytes]]]:
+    # returns (uid, (internal date, message)) sorted by uid
+    batch_uids = b','.join(uids).decode('UTF-8')
+    typ, data = client.uid('FETCH', batch_uids, '(INTERNALDATE RFC822)')
+    msgs = [
+        (items['UID'], (_internal_date(items.get('INTERNALDATE')), items['RFC822']))
+        for _, items in easy.structure.parse_fetch(data)
+    ]
+    msgs.sort(key=lambda m: m[0])
+    return msgs
+
+
+def _internal_date(value: bytes | None) -> int | None:
+    # e.g. b'17-Jul-1996 02:44:25 -0700', the day may be space padded
+    try:
+        date, time, zone = bytes(value).decode('ascii').split()
+        day, month, year = date.split('-')
+        hours, minutes, seconds = (int(t) for t in time.split(':'))
+        offset = datetime.timedelta(hours=int(zone[1:3]), minutes=int(zone[3:5]))
+        return int(datetime.datetime(
+            int(year), _imap_months.index(month.capitalize()) + 1, int(day),
+            hours, minutes, seconds,
+            tzinfo=datetime.timezone(-offset if zone[0] == '-' else offset)
+        ).timestamp())
+    except (TypeError, ValueError):
+        return None
+
+
+def _fetch_gmail_ids(
+    client: imaplib.IMAP4, uids: list[bytes]
+) -> list[tuple[int, int]]:
+    # returns (uid, X-GM-MSGID), the same in every folder
+    batch_uids = b','.join(uids).decode('UTF-8')
+    typ, data = client.uid('FETCH', batch_uids, '(X-GM-MSGID)')
+    return [
+        (items['UID'], items['X-GM-MSGID'])
+        for _, items in easy.structure.parse_fetch(data)
+    ]
+
+
+def _fetch_message_ids(
+    client: imaplib.IMAP4, uids: list[bytes]
+) -> list[tuple[int, tuple[str, int] | None]]:
+    # returns (uid, (Message-ID, size)), None without a Message-ID
+    batch_uids = b','.join(uids).decode('UTF-8')
+    typ, data = client.uid('FETCH', batch_uids, '(RFC822.SIZE BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])')
+    identities = []
+    for _, items in easy.structure.parse_fetch(data):
+        # servers may quote field names in the response
+        fields = next((v for k, v in items.items() if k.startswith('BODY[HEADER.FIELDS')), None)
+        headers = _parse_bytes(bytes(fields or b''), headersonly=True)
+        msgid = str(headers.get('message-id', '')).strip()
+        identities.append((items['UID'], (msgid, items['RFC822.SIZE']) if msgid else None))
+    return identities
+
+
+def _fetch_sections(
+    client: imaplib.IMAP4, uid: int, sections: list[easy.structure.Section]
+) -> dict[easy.structure.Section, bytes]:
+    # body sections of a message, fetched at once
+    items = []
+    for section, partial in sections:
+        item = f'BODY.PEEK[{section}]'
+        if partial is not None:
+            item += f'<{partial[0]}.{partial[1]}>'
+        items.append(item)
+    typ, data = client.uid('FETCH', str(uid), f"({' '.join(items)})")
+    fetched = {}
+    for _, response in easy.structure.parse_fetch(data):
+        for section, partial in sections:
+            key = f'BODY[{section}]'
+            if partial is not None:
+                key += f'<{partial[0]}>'
+            if key.upper() in response:
+                # empty sections may be NIL
+                fetched[(section, partial)] = bytes(response[key.upper()] or b'')
+    return fetched
+
+
+def _parse_fetch_uid(fetch_info: bytes) -> int:
+    # e.g. b'12 (UID 1042 RFC822 {3421}'
+    match = re.search(rb'UID (\d+)', fetch_info)
+    if not match:
+        raise ValueError(f"uid missing in fetch response: {fetch_info}")
+    return int(match.group(1))
 
 
 def _login_imap(credentials: dict) -> collections.abc.Callable[[imaplib.IMAP4], None]:
 
     def _login_oauth(client: imaplib.IMAP4):
-        auth_string = f"user={credentials['user']}\x01auth=Bearer {credentials['access_token']}\x01\x01"
-        authobject = lambda b: auth_string.encode()
+        auth_string = _xoauth2_string(credentials)
+        authobject = lambda b: auth_string
         client.authenticate('XOAUTH2', authobject)
 
     def _login_basic(client: imaplib.IMAP4):
@@ -74,23 +738,182 @@ def _login_imap(credentials: dict) -> collections.abc.Callable[[imaplib.IMAP4],
     return _login_basic
 
 
-class MboxConf(typing.TypedDict):
-    path: str
+def _xoauth2_string(credentials: dict) -> bytes:
+    # SASL XOAUTH2 initial client response, not yet base64 encoded
+    return f"user={credentials['user']}\x01auth=Bearer {credentials['access_token']}\x01\x01".encode()
 
-_mbox_annotations = inspect.get_annotations(MboxConf)
 
+class LocalInbox(Inbox):
+
+    # Messages of a local file read by number, subclasses locate them
+    # (get_raw, get_raw_headers) and set _range, the numbers of messages
+    # in the file included in this view.
+
+    _range: collections.abc.Sequence[int]
+
+    @abc.abstractmethod
+    def get_raw(self, i: int) -> memoryview:
+        # view of message i bytes
+        pass
+
+    @abc.abstractmethod
+    def get_raw_headers(self, i: int) -> memoryview:
+        # view of message i headers, blank line included
+        pass
+
+    def __len__(self) -> int:
+        return len(self._range)
+
+    def slice(self, start: int | None, stop: int | None) -> 'LocalInbox':
+        # view of messages [start, stop), sharing the file
+        view = copy.copy(self)
+        view._range = self._range[start:stop]
+        return view
 
-class LocalMbox(Inbox):
+    def subset(self, numbers: collections.abc.Sequence[int]) -> 'LocalInbox':
+        # view of messages numbers of this view, in the given order
+        view = copy.copy(self)
+        view._range = [self._range[n] for n in numbers]
+        return view
 
-    def __init__(self, conf: MboxConf):
-        self._mailbox = mailbox.mbox(conf['path'])
+    def get(self, i: int) -> email.message.EmailMessage:
+        with self.get_raw(i) as msgv:
+            return _parse_bytes(msgv)
+
+    def fetch_raw(
+        self, *, batch_size=1
+    ) -> typing.Generator[bytes, None, None]:
+        for i in range(len(self)):
+            with self.get_raw(i) as msgv:
+                msgb = bytes(msgv)
+            yield msgb
 
     def fetch(
         self, *, batch_size=1
     ) -> typing.Generator[email.message.EmailMessage, None, None]:
-        for msg in self._mailbox.itervalues():
-            msgb = msg.as_bytes()
-            yield email.message_from_bytes(msgb, policy=email.policy.default)
+        for i in range(len(self)):
+            yield self.get(i)
+
+    def fetch_raw_headers(
+        self, *, batch_size=1
+    ) -> typing.Generator[bytes, None, None]:
+        for i in range(len(self)):
+            with self.get_raw_headers(i) as headersv:
+                headersb = bytes(headersv)
+            yield headersb
+
+    def fetch_headers(
+        self, *, batch_size=1
+    ) -> typing.Generator[email.message.EmailMessage, None, None]:
+        for i in range(len(self)):
+            with self.get_raw_headers(i) as headersv:
+                headers = _parse_bytes(headersv, headersonly=True)
+            yield headers
+
+    def fetch_lazy(
+        self, *, batch_size=1
+    ) -> typing.Generator[easy.message.LazyMessage, None, None]:
+        for i in range(len(self)):
+            with self.get_raw_headers(i) as headersv:
+                headers = _parse_bytes(headersv, headersonly=True)
+            yield easy.message.LazyMessage(headers, functools.partial(self.get, i))
+
+
+class MboxConf(typing.TypedDict):
+    path: str
+
+_mbox_annotations = inspect.get_annotations(MboxConf)
+
+
+class LocalMbox(LocalInbox):
+
+    # The mbox file is memory mapped and messages are located through an
+    # index of byte offsets (see easy.mbox), each message is parsed once
+    # straight from the mapped bytes.
+    # Messages are read as mboxrd, escaped '>From ' lines are copied unescaped.
+    # save_index stores the index next to the mbox (<path>.idx), it is reused
+    # as long as the mbox is unchanged or only appended to.
+
+    def __init__(self, conf: MboxConf, *, save_index: bool = False):
+        path = pathlib.Path(conf['path'])
+        self._map = easy.mbox.open_mmap(path)
+        self._index = easy.mbox.build_index(path, self._map, save=save_index)
+        self._range = range(len(self._index))
+
+    def get_raw(self, i: int) -> memoryview:
+        # view of message i bytes, 'From ' line excluded.
+        # zero-copy unless there are lines to unescape
+        n = self._range[i]
+        start, stop = self._index.starts[n], self._index.stops[n]
+        body_start = self._map.find(b'\n', start, stop) + 1
+        if body_start == 0:
+            body_start = stop
+        msgv = memoryview(self._map)[body_start:stop]
+        msgb = easy.mbox.unescape(msgv)
+        if msgb is msgv:
+            return msgv
+        msgv.release()
+        return memoryview(msgb)
+
+    def get_raw_headers(self, i: int) -> memoryview:
+        # view of message i headers, bodies are never touched
+        n = self._range[i]
+        start, stop = self._index.starts[n], self._index.stops[n]
+        headers_start = self._map.find(b'\n', start, stop) + 1
+        if headers_start == 0:
+            headers_start = stop
+        headers_end = _headers_end(self._map, headers_start, stop)
+        return memoryview(self._map)[headers_start:headers_end]
+
+
+class ArchiveConf(typing.TypedDict):
+    path: str
+
+
+class LocalArchive(LocalInbox):
+
+    # Messages of a compressed archive (see easy.archive), read as
+    # LocalMbox reads a mbox. Reading in order decompresses every block
+    # once, random access decompresses the block of the message.
+
+    def __init__(self, conf: ArchiveConf):
+        self._reader = easy.archive.ArchiveReader(conf['path'])
+        self._range = range(len(self._reader))
+
+    def get_raw(self, i: int) -> memoryview:
+        # view of message i bytes in its uncompressed block
+        block, start, stop = self._reader.locate(self._range[i])
+        return memoryview(block)[start:stop]
+
+    def get_raw_headers(self, i: int) -> memoryview:
+        block, start, stop = self._reader.locate(self._range[i])
+        return memoryview(block)[start:_headers_end(block, start, stop)]
+
+
+def _headers_end(data: bytes | mmap.mmap, start: int, stop: int) -> int:
+    # offset after the blank line ending headers in data[start:stop],
+    # stop when there is no body
+    if data[start:start + 1] == b'\n' or data[start:start + 2] == b'\r\n':
+        # no headers at all
+        return start
+    ends = [
+        i for i in (data.find(b'\n\n', start, stop), data.find(b'\n\r\n', start, stop))
+        if i != -1
+    ]
+    if not ends:
+        return stop
+    i = min(ends)
+    return i + (2 if data[i + 1:i + 2] == b'\n' else 3)
+
+
+def _parse_bytes(
+    msgb: bytes | memoryview, *, headersonly: bool = False
+) -> email.message.EmailMessage:
+    # same as email.message_from_bytes, which does not accept memoryviews
+    text = str(msgb, 'ASCII', 'surrogateescape')
+    return email.parser.Parser(policy=email.policy.default).parsestr(
+        text, headersonly=headersonly
+    )
 
 
 
@@ -1,8 +1,17 @@
 import typing
+import collections.abc
+import time
 import email.message
 import email.utils
 import re
 import html.parser
+import easy.message
+import easy.sizing
+
+# bump whenever features are added, removed or computed differently,
+# features stored by previous versions are outdated (see easy.cache)
+FEATURES_VERSION = 1
+
 
 class Features(typing.TypedDict):
     has_list_unsubscribe: typing.Literal[0, 1]
@@ -15,44 +24,154 @@ class Features(typing.TypedDict):
     is_replyto_equal_from: typing.Literal[0, 1]
     recipients_count: int
     media_html_ratio: float
+    html_style_ratio: float
     self_ref_links_count: int
     has_attachment: typing.Literal[0, 1]
 
-# TODO all features that require 'walking' the body parts
-#   can be written better to improve performance.
-#   Right now every evaluation 'walks' making the process inefficient.
+# Body parts are walked and decoded once (see _analyze_body), every body
+# feature is then computed on the resulting analysis.
+
+PartKind = typing.Literal['html', 'html_as_text', 'text', 'binary']
+
+
+class BodyPart(typing.TypedDict):
+    kind: PartKind
+    content_type: str
+    charset: str | None
+    # bytes accounted by media_html_ratio
+    size: int
+    # html parts only, zero/empty otherwise
+    style_size: int
+    links: list[str]
+
+
+class BodyAnalysis(typing.TypedDict):
+    parts: list[BodyPart]
+    has_attachment: bool
+
 
+# messages are either parsed as a whole or lazy (see easy.message),
+# body features load lazy messages bodies
+Message = email.message.EmailMessage | easy.message.LazyMessage
 
-def evaluate(msg: email.message.EmailMessage) -> Features | None:
+
+def evaluate(
+    msg: Message,
+    features: collections.abc.Collection[str] | None = None
+) -> Features | None:
+    # features, when given, are the only ones evaluated
     if msg is None:
         return None
     try:
-        features: Features = {}
-        # headers presence features
-        features['has_list_unsubscribe'] = 1 if msg.get('list-unsubscribe') else 0
-        features['has_list_id'] = 1 if msg.get('list-id') else 0
-        features['has_precedence'] = 1 if msg.get('precedence') else 0
-        features['has_feedback_id'] = 1 if msg.get('feedback-id') \
-                                        or msg.get('x-feedback-id') else 0
-        features['has_mailer'] = 1 if msg.get('x-mailer') else 0
-        features['has_campaign'] = 1 if msg.get('x-campaign') else 0
-        features['has_csa_complaints'] = 1 if msg.get('x-csa-complaints') else 0
-        # headers value features
-        features['is_replyto_equal_from'] = 1 if _equals_replyto_from(msg) else 0
-        features['recipients_count'] = _count_recipients(msg)
-        # body value features
-        features['media_html_ratio'] = _calculate_media_html_ratio(msg)
-        features['html_style_ratio'] = _calculate_html_style_ratio(msg)
-        features['self_ref_links_count'] = _count_self_ref_links(msg)
-        features['has_attachment'] = 1 if _has_attachment(msg) else 0
-        return features
+        return _evaluate(msg, features=features)
     except Exception as e:
-        print('error:', e)
-        print('caused by msg:', msg.get('message-id'))
-        # TODO log
+        report_error(e, msg.get('message-id'))
         return None
 
 
+def report_error(e: Exception | str, msgid: str | None):
+    print('error:', e)
+    print('caused by msg:', msgid)
+    # TODO log
+
+
+def _evaluate(
+    msg: Message,
+    profile: dict[str, float] | None = None,
+    *,
+    features: collections.abc.Collection[str] | None = None
+) -> Features:
+    # profile, when given, is filled with seconds spent on every feature
+    # and on the body analysis shared by body features
+    header_features, body_features = _select(features)
+    if profile is not None:
+        return _evaluate_profiled(msg, profile, header_features, body_features)
+    result: Features = {}
+    for name, fn in header_features.items():
+        result[name] = fn(msg)
+    if body_features:
+        body = _body_analysis(msg)
+        for name, fn in body_features.items():
+            result[name] = fn(msg, body)
+    return result
+
+
+def _evaluate_profiled(
+    msg: Message,
+    profile: dict[str, float],
+    header_features: dict,
+    body_features: dict
+) -> Features:
+    result: Features = {}
+    for name, fn in header_features.items():
+        t = time.perf_counter()
+        result[name] = fn(msg)
+        profile[name] = time.perf_counter() - t
+    if body_features:
+        # loading lazy messages is accounted as body analysis
+        t = time.perf_counter()
+        body = _body_analysis(msg)
+        profile['body_analysis'] = time.perf_counter() - t
+        for name, fn in body_features.items():
+            t = time.perf_counter()
+            result[name] = fn(msg, body)
+            profile[name] = time.perf_counter() - t
+    return result
+
+
+def _select(
+    features: collections.abc.Collection[str] | None
+) -> tuple[dict, dict]:
+    # header and body features tables restricted to features, in Features order
+    if features is None:
+        return _header_features, _body_features
+    unknown = set(features) - Features.__annotations__.keys()
+    if unknown:
+        raise ValueError(f"unknown features: {', '.join(sorted(unknown))}")
+    return (
+        {n: fn for n, fn in _header_features.items() if n in features},
+        {n: fn for n, fn in _body_features.items() if n in features},
+    )
+
+
+def _body_analysis(msg: Message) -> BodyAnalysis:
+    # lazy messages may be analyzed without loading them
+    if isinstance(msg, easy.message.LazyMessage) and msg.analyze_body is not None:
+        body = msg.analyze_body()
+        if body is not None:
+            return body
+    return _analyze_body(easy.message.load(msg))
+
+
+_header_features: dict[
+    str, collections.abc.Callable[[email.message.EmailMessage], int]
+] = {
+    # headers presence features
+    'has_list_unsubscribe': lambda msg: 1 if msg.get('list-unsubscribe') else 0,
+    'has_list_id': lambda msg: 1 if msg.get('list-id') else 0,
+    'has_precedence': lambda msg: 1 if msg.get('precedence') else 0,
+    'has_feedback_id': lambda msg: 1 if msg.get('feedback-id') \
+                                        or msg.get('x-feedback-id') else 0,
+    'has_mailer': lambda msg: 1 if msg.get('x-mailer') else 0,
+    'has_campaign': lambda msg: 1 if msg.get('x-campaign') else 0,
+    'has_csa_complaints': lambda msg: 1 if msg.get('x-csa-complaints') else 0,
+    # headers value features
+    'is_replyto_equal_from': lambda msg: 1 if _equals_replyto_from(msg) else 0,
+    'recipients_count': lambda msg: _count_recipients(msg),
+}
+
+
+_body_features: dict[
+    str, collections.abc.Callable[[Message, BodyAnalysis], int | float]
+] = {
+    # body value features
+    'media_html_ratio': lambda msg, body: _calculate_media_html_ratio(body),
+    'html_style_ratio': lambda msg, body: _calculate_html_style_ratio(body),
+    'self_ref_links_count': lambda msg, body: _count_self_ref_links(msg, body),
+    'has_attachment': lambda msg, body: 1 if _has_attachment(body) else 0,
+}
+
+
 def _equals_replyto_from(msg: email.message.EmailMessage) -> bool:
     # RFC6854 allows group syntax
     from_addresses = email.utils.getaddresses(msg.get_all('from', []))
@@ -86,12 +205,45 @@ def _count_recipients(msg: email.message.EmailMessage) -> int:
     return len(email.utils.getaddresses(tos + ccs + resent_tos + resent_ccs))
 
 
-class HtmlValidator(html.parser.HTMLParser):
+class HtmlCollector:
+
+    # Receives events from HtmlScanner, a collector extracts only what a
+    # feature needs so that every html payload is tokenized once.
+
+    def handle_starttag(self, tag, attrs):
+        pass
+
+    def handle_endtag(self, tag):
+        pass
+
+    def handle_data(self, data):
+        pass
+
+
+class HtmlScanner(html.parser.HTMLParser):
+
+    def __init__(self, collectors: list[HtmlCollector]):
+        super().__init__()
+        self._collectors = collectors
+
+    def handle_starttag(self, tag, attrs):
+        for c in self._collectors:
+            c.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        for c in self._collectors:
+            c.handle_endtag(tag)
+
+    def handle_data(self, data):
+        for c in self._collectors:
+            c.handle_data(data)
+
+
+class HtmlValidator(HtmlCollector):
 
     _tags = ['html', 'head', 'body']
 
     def __init__(self):
-        super().__init__()
         # valid html stack would be:
         # [ html, head, head, body, body, html ]
         self._stack: list[str] = []
@@ -108,68 +260,16 @@ class HtmlValidator(html.parser.HTMLParser):
         return self._stack == ['html', 'head', 'head', 'body', 'body', 'html']
 
 
-import math
-def _calculate_media_html_ratio(
-    msg: email.message.EmailMessage, 
-    threshold: float = 0.2,
-    steepness: float = 15
-) -> float:
-    # return a value between 0..1 (i.e html_only...media_only)
-    media_bytes = 0
-    html_bytes = 0
-    # multipart can be laid out hierarchically
-    for p in msg.walk():
-        if p.is_multipart():
-            continue
-        elif p.get_content_maintype() == 'text' \
-        and 'html' in p.get_content_subtype():
-            html_bytes += _size_bytes(p.get_content(), p.get_content_charset())
-        elif isinstance(p.get_content(), bytes):
-            media_bytes += len(p.get_content())
-        else:
-            # prevent html declared as plain text
-            html_validator = HtmlValidator()
-            html_validator.feed(p.get_content())
-            if html_validator.is_valid():
-                html_bytes += _size_bytes(p.get_content(), p.get_content_charset())
-            else:
-                # any content-type that is text but not html 
-                media_bytes += _size_bytes(
-                    clean_text(p.get_content()), 
-                    p.get_content_charset()
-                )
-    sum_bytes = media_bytes + html_bytes
-    if sum_bytes == 0:
-        raise ValueError("unexpected body content")
-    ratio = media_bytes / sum_bytes
-    if ratio == 0 or ratio == 1:
-        return ratio
-    # Apply sigmoid scaling to polarize middle values
-    return 1 / (1 + math.exp(-steepness * (ratio - threshold)))
-
-
-def _size_bytes(s: str, charset: str | None = None) -> int:
-    if charset is None:
-        charset = 'utf-8'
-    return len(s.encode(charset))
+class StyleBytesCounter(HtmlCollector):
 
+    # counts utf-8 bytes of style attributes and <style> elements content
 
-def clean_text(text: str) -> str:
-    # replace all whitespace (spaces, newlines, tabs) with a single space
-    text = re.sub(r'\s+', ' ', text.strip())
-    return text
-
-
-class StyleContentFinder(html.parser.HTMLParser):
-    
     def __init__(self):
-        super().__init__()
-        self._content: str = ''
+        self.size: int = 0
         self._style_data_next: bool = False
 
     def handle_starttag(self, tag, attrs):
-        a_content = self._extract_style_attribute_content(attrs)
-        self._content += a_content
+        self.size += easy.sizing.text_size(self._extract_style_attribute_content(attrs))
         if not tag == 'style':
             return
         self._style_data_next = True
@@ -186,43 +286,142 @@ class StyleContentFinder(html.parser.HTMLParser):
         if tag == 'style':
             self._style_data_next = False
 
-    def handle_data(self, data) -> bool:
+    def handle_data(self, data):
         if not self._style_data_next:
             return
-        self._content += data
+        self.size += easy.sizing.text_size(data)
 
-    def get_content(self) -> str:
-        return self._content
-        
 
-# TODO avoid duplicating code, think about a valid abstraction.
-#   right now performance can be improved a lot
-def _calculate_html_style_ratio(
-    msg: email.message.EmailMessage, 
-    exponent: float = 0.3
-) -> float:
-    # return a value between 0..1 (i.e no-html/html_only...style_only)
-    html_bytes = 0
+class LinkCollector(HtmlCollector):
+
+    # collects <a> hrefs, except mailto: ones
+
+    def __init__(self):
+        self.links: list[str] = []
+
+    def handle_starttag(self, tag, attrs):
+        if not tag == 'a':
+            return
+        for a, v in attrs:
+            if not a == 'href' or v.startswith('mailto:'):
+                continue
+            self.links.append(v)
+
+
+# html skeleton can't be valid without an <html> tag,
+# plain text lacking it is not tokenized at all.
+_html_marker = re.compile(r'<html', re.IGNORECASE)
+
+
+def _analyze_body(msg: email.message.EmailMessage) -> BodyAnalysis:
+    # walks the message once, every leaf part is decoded and classified once
+    parts: list[BodyPart] = []
+    has_attachment = False
     # multipart can be laid out hierarchically
-    style_finder = StyleContentFinder()
     for p in msg.walk():
+        disposition = p.get_content_disposition()
+        if disposition and disposition.startswith('attachment'):
+            has_attachment = True
         if p.is_multipart():
             continue
-        elif p.get_content_maintype() == 'text' \
-        and 'html' in p.get_content_subtype():
-            html_bytes += _size_bytes(p.get_content(), p.get_content_charset())
-            style_finder.feed(p.get_content())
-        elif isinstance(p.get_content(), bytes):
-            continue
+        parts.append(_analyze_part(p))
+    return {'parts': parts, 'has_attachment': has_attachment}
+
+
+def _analyze_part(p: email.message.EmailMessage) -> BodyPart:
+    # binary payloads are sized without being decoded (see easy.sizing)
+    charset = p.get_content_charset()
+    part: BodyPart = {
+        'kind': 'text',
+        'content_type': p.get_content_type(),
+        'charset': charset,
+        'size': 0,
+        'style_size': 0,
+        'links': []
+    }
+    if p.get_content_maintype() in easy.sizing.BINARY_MAINTYPES:
+        part['kind'] = 'binary'
+        part['size'] = easy.sizing.payload_size(p)
+        return part
+    content = p.get_content()
+    if p.get_content_maintype() == 'text' \
+    and 'html' in p.get_content_subtype():
+        part['kind'] = 'html'
+        part['size'] = easy.sizing.text_size(content, charset)
+        _scan_html(content, part)
+    elif isinstance(content, bytes):
+        part['kind'] = 'binary'
+        part['size'] = len(content)
+    # prevent html declared as plain text
+    elif _html_marker.search(content) and _scan_html(content, part):
+        part['kind'] = 'html_as_text'
+        part['size'] = easy.sizing.text_size(content, charset)
+    else:
+        # any content-type that is text but not html,
+        # discard whatever the scanner collected
+        part['style_size'] = 0
+        part['links'] = []
+        part['size'] = easy.sizing.clean_text_size(content, charset)
+    return part
+
+
+def _scan_html(content: str, part: BodyPart) -> bool:
+    # tokenizes content once, fills html fields of part.
+    # returns whether content has a valid html skeleton
+    validator = HtmlValidator()
+    style_counter = StyleBytesCounter()
+    link_collector = LinkCollector()
+    scanner = HtmlScanner([validator, style_counter, link_collector])
+    scanner.feed(content)
+    part['style_size'] = style_counter.size
+    part['links'] = link_collector.links
+    return validator.is_valid()
+
+
+def _html_parts(body: BodyAnalysis) -> typing.Iterator[BodyPart]:
+    return (p for p in body['parts'] if p['kind'] in ('html', 'html_as_text'))
+
+
+import math
+def _calculate_media_html_ratio(
+    body: BodyAnalysis,
+    threshold: float = 0.2,
+    steepness: float = 15
+) -> float:
+    # return a value between 0..1 (i.e html_only...media_only)
+    media_bytes = 0
+    html_bytes = 0
+    for p in body['parts']:
+        if p['kind'] in ('html', 'html_as_text'):
+            html_bytes += p['size']
         else:
-            # prevent html declared as plain text
-            html_validator = HtmlValidator()
-            html_validator.feed(p.get_content())
-            if not html_validator.is_valid():
-                continue
-            html_bytes += _size_bytes(p.get_content(), p.get_content_charset())
-            style_finder.feed(p.get_content())
-    style_bytes = _size_bytes(style_finder.get_content())
+            media_bytes += p['size']
+    sum_bytes = media_bytes + html_bytes
+    if sum_bytes == 0:
+        raise ValueError("unexpected body content")
+    ratio = media_bytes / sum_bytes
+    if ratio == 0 or ratio == 1:
+        return ratio
+    # Apply sigmoid scaling to polarize middle values
+    return 1 / (1 + math.exp(-steepness * (ratio - threshold)))
+
+
+def clean_text(text: str) -> str:
+    # replace all whitespace (spaces, newlines, tabs) with a single space
+    text = re.sub(r'\s+', ' ', text.strip())
+    return text
+
+
+def _calculate_html_style_ratio(
+    body: BodyAnalysis,
+    exponent: float = 0.3
+) -> float:
+    # return a value between 0..1 (i.e no-html/html_only...style_only)
+    html_bytes = 0
+    style_bytes = 0
+    for p in _html_parts(body):
+        html_bytes += p['size']
+        style_bytes += p['style_size']
     sum_bytes = style_bytes + html_bytes
     if sum_bytes == 0:
         # no html, content is only 'media'
@@ -232,35 +431,20 @@ def _calculate_html_style_ratio(
     return ratio ** exponent
 
 
-class SelfRefLinkCounter(html.parser.HTMLParser):
-
-    def __init__(self, domain):
-        super().__init__()
-        self.domain = domain
-        self.domain_links_count = 0
-
-    def handle_starttag(self, tag, attrs):
-        if not tag == 'a':
-            return
-        for a, v in attrs:
-            if not a == 'href' or v.startswith('mailto:'):
-                continue
-            if self.domain in v:
-                self.domain_links_count += 1
-
-
-def _count_self_ref_links(msg: email.message.EmailMessage) -> int:
+def _count_self_ref_links(
+    msg: Message,
+    body: BodyAnalysis
+) -> int:
     from_email = email.utils.getaddresses(msg.get_all('from', []))[0][1]
     domain = _extract_email_second_lvl_domain(from_email)
-    parser = SelfRefLinkCounter(domain)
-    for p in msg.walk():
-        # TODO html may be hidden as plain text,
-        #   'walking' the body parts should be encapsulated somewhere.
-        # 
-        if not p.get_content_type() == 'text/html':
+    count = 0
+    for p in body['parts']:
+        # TODO html may be hidden as plain text too ('html_as_text' parts),
+        #   counting is kept on declared text/html only.
+        if not p['content_type'] == 'text/html':
             continue
-        parser.feed(p.get_content())
-    return parser.domain_links_count
+        count += sum(1 for link in p['links'] if domain in link)
+    return count
 
 
 def _extract_email_second_lvl_domain(address: str) -> str:
@@ -268,8 +452,9 @@ def _extract_email_second_lvl_domain(address: str) -> str:
     # output    domain.
     root_domain_pattern = r'@([^@]+)$'
     match = re.search(root_domain_pattern, address)
-    if match:
-        root_domain = match.group(1)
+    if not match:
+        raise ValueError(f"cannot parse email address: {address}")
+    root_domain = match.group(1)
     second_lvl_domain_pattern = r'([^.]+\.)([^.]+)$'
     match = re.search(second_lvl_domain_pattern, root_domain)
     if match:
@@ -277,10 +462,5 @@ def _extract_email_second_lvl_domain(address: str) -> str:
     raise ValueError(f"cannot parse email address: {address}")
 
 
-def _has_attachment(msg: email.message.EmailMessage) -> bool:
-    for p in msg.walk():
-        if not p.get_content_disposition():
-            continue
-        elif p.get_content_disposition().startswith('attachment'):
-            return True
-    return False
\ No newline at end of file
+def _has_attachment(body: BodyAnalysis) -> bool:
+    return body['has_attachment']
@@ -0,0 +1,93 @@
+import typing
+import collections.abc
+import numpy as np
+import easy.features
+
+
+# Features as a matrix, one row per message and one column per feature.
+# Stored as npz: 'features' matrix, 'columns' names and optional 'msgids'.
+
+
+class FeatureMatrix(typing.NamedTuple):
+    features: np.ndarray
+    columns: list[str]
+    msgids: list[str] | None
+
+
+class MatrixBuilder:
+
+    # Rows are copied into fixed-size chunks, chunks are joined on build()
+
+    def __init__(
+        self,
+        columns: collections.abc.Sequence[str],
+        *,
+        chunk_size: int = 65536,
+        dtype: np.dtype = np.float64
+    ):
+        self.columns = list(columns)
+        self._chunk_size = chunk_size
+        self._dtype = dtype
+        self._chunks: list[np.ndarray] = []
+        self._chunk = self._new_chunk()
+        self._rows = 0
+        self._msgids: list[str] = []
+
+    def _new_chunk(self) -> np.ndarray:
+        return np.empty((self._chunk_size, len(self.columns)), dtype=self._dtype)
+
+    def append(self, features: easy.features.Features, msgid: str | None = None):
+        if self._rows == self._chunk_size:
+            self._chunks.append(self._chunk)
+            self._chunk = self._new_chunk()
+            self._rows = 0
+        self._chunk[self._rows] = [features[c] for c in self.columns]
+        self._rows += 1
+        if msgid is not None:
+            self._msgids.append(msgid)
+
+    def __len__(self) -> int:
+        return len(self._chunks) * self._chunk_size + self._rows
+
+    def build(self) -> FeatureMatrix:
+        features = np.concatenate(self._chunks + [self._chunk[:self._rows]])
+        # msgids are kept only if every row has one
+        msgids = self._msgids if len(self._msgids) == len(features) else None
+        return FeatureMatrix(features, self.columns, msgids)
+
+
+def batches(
+    rows: collections.abc.Iterable[tuple[easy.features.Features, str | None]],
+    columns: collections.abc.Sequence[str],
+    *,
+    size: int = 4096,
+    dtype: np.dtype = np.float64
+) -> typing.Generator[tuple[np.ndarray, list[str | None]], None, None]:
+    # (features, msgid) rows as matrices of (at most) size rows
+    batch = np.empty((size, len(columns)), dtype=dtype)
+    msgids: list[str | None] = []
+    for features, msgid in rows:
+        batch[len(msgids)] = [features[c] for c in columns]
+        msgids.append(msgid)
+        if len(msgids) == size:
+            yield batch, msgids
+            batch = np.empty((size, len(columns)), dtype=dtype)
+            msgids = []
+    if msgids:
+        yield batch[:len(msgids)], msgids
+
+
+def save(file: typing.BinaryIO | str, matrix: FeatureMatrix):
+    arrays = {
+        'features': matrix.features,
+        'columns': np.array(matrix.columns, dtype=str)
+    }
+    if matrix.msgids is not None:
+        arrays['msgids'] = np.array(matrix.msgids, dtype=str)
+    np.savez(file, **arrays)
+
+
+def load(file: typing.BinaryIO | str) -> FeatureMatrix:
+    with np.load(file) as data:
+        msgids = data['msgids'].tolist() if 'msgids' in data else None
+        return FeatureMatrix(data['features'], data['columns'].tolist(), msgids)
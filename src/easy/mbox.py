@@ -0,0 +1,226 @@
+import array
+import collections.abc
+import hashlib
+import mmap
+import os
+import pathlib
+import re
+import struct
+import time
+
+
+# Index of messages in a mbox file, as byte offsets.
+# Messages are delimited the same way mailbox.mbox does: a message starts
+# at every line beginning with 'From ', a blank line preceding it is not
+# part of the previous message.
+
+_index_magic = b'EASYIDX2'
+# magic, mbox size, mbox mtime_ns, messages count, tail digest
+_index_header = struct.Struct('=8sqqq32s')
+
+
+class MboxIndex:
+
+    def __init__(self):
+        # offset of 'From ' lines
+        self.starts = array.array('q')
+        # offset past the last byte of each message
+        self.stops = array.array('q')
+        self.size = 0
+        self.mtime_ns = 0
+        # sha256 of the last message indexed, up to size (see tail_digest)
+        self.digest = b''
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def scan(self, data: bytes | mmap.mmap, pos: int = 0):
+        # appends messages found from pos (beginning of a line) to the end of data
+        size = len(data)
+        if data[pos:pos+5] == b'From ':
+            line_pos = pos
+        else:
+            line_pos = data.find(b'\nFrom ', pos)
+            line_pos = line_pos + 1 if line_pos != -1 else -1
+        while line_pos != -1:
+            self.starts.append(line_pos)
+            nxt = data.find(b'\nFrom ', line_pos)
+            if nxt == -1:
+                self.stops.append(size - 1 if data[-2:] == b'\n\n' else size)
+                break
+            # blank line before the next 'From ' belongs to the separator
+            self.stops.append(nxt if data[nxt-1:nxt+1] == b'\n\n' else nxt + 1)
+            line_pos = nxt + 1
+        self.size = size
+
+    def rescan_tail(self, data: bytes | mmap.mmap):
+        # data has been appended to the mbox, last message may have grown
+        if len(self) == 0:
+            self.scan(data)
+            return
+        last_start = self.starts.pop()
+        self.stops.pop()
+        self.scan(data, last_start)
+
+    def tail_digest(self, data: bytes | mmap.mmap) -> bytes:
+        # bytes of the last message indexed are unchanged when the mbox has
+        # only been appended to
+        start = self.starts[-1] if len(self) else 0
+        return hashlib.sha256(data[start:self.size]).digest()
+
+    def save(self, path: pathlib.Path):
+        # native byte order, the index is a local cache of the mbox
+        with open(path, 'wb') as f:
+            f.write(_index_header.pack(
+                _index_magic, self.size, self.mtime_ns, len(self), self.digest
+            ))
+            self.starts.tofile(f)
+            self.stops.tofile(f)
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> 'MboxIndex | None':
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(_index_header.size)
+                if len(header) != _index_header.size:
+                    return None
+                magic, size, mtime_ns, count, digest = _index_header.unpack(header)
+                if magic != _index_magic:
+                    return None
+                index = cls()
+                index.size = size
+                index.mtime_ns = mtime_ns
+                index.digest = digest
+                index.starts.fromfile(f, count)
+                index.stops.fromfile(f, count)
+                return index
+        except (FileNotFoundError, EOFError):
+            return None
+
+
+def index_path(mbox_path: pathlib.Path) -> pathlib.Path:
+    return mbox_path.with_name(mbox_path.name + '.idx')
+
+
+def build_index(
+    mbox_path: pathlib.Path,
+    data: bytes | mmap.mmap,
+    *,
+    save: bool = False
+) -> MboxIndex:
+    # reuses the stored index when the mbox is unchanged or has only been
+    # appended to, the index is rebuilt otherwise
+    stat = os.stat(mbox_path)
+    idx_path = index_path(mbox_path)
+    index = MboxIndex.load(idx_path)
+    if index is not None and index.size == stat.st_size \
+    and index.mtime_ns == stat.st_mtime_ns:
+        return index
+    if index is not None and _is_appended(index, data):
+        index.rescan_tail(data)
+    else:
+        index = MboxIndex()
+        index.scan(data)
+    index.size = len(data)
+    index.mtime_ns = stat.st_mtime_ns
+    index.digest = index.tail_digest(data)
+    if save:
+        index.save(idx_path)
+    return index
+
+
+def _is_appended(index: MboxIndex, data: bytes | mmap.mmap) -> bool:
+    # a mbox rewritten to the same size or larger is told apart by the
+    # bytes of the last message indexed
+    if index.size > len(data):
+        return False
+    return index.tail_digest(data) == index.digest
+
+
+def open_mmap(path: pathlib.Path) -> bytes | mmap.mmap:
+    # empty files can't be mapped
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+# mboxrd: lines starting with 'From ', after any number of '>',
+# get one more '>' when written and one less when read.
+_from_escaped = re.compile(rb'^>(>*From )', re.MULTILINE)
+_from_unescaped = re.compile(rb'^(>*From )', re.MULTILINE)
+
+
+def unescape(msgb: bytes | memoryview) -> bytes | memoryview:
+    # returns msgb itself when there's nothing to unescape
+    if not _from_escaped.search(msgb):
+        return msgb
+    return _from_escaped.sub(rb'\1', bytes(msgb))
+
+
+class MboxWriter:
+
+    # Appends RFC822 messages to a mbox file as they are, except for line
+    # endings normalized to '\n' and mboxrd escaping.
+    # Writes are buffered, every sync_every messages the file is flushed and
+    # fsync'ed, then on_sync is called: a crash loses at most the messages
+    # added after the last sync.
+
+    def __init__(
+        self,
+        path: str | pathlib.Path,
+        *,
+        sync_every: int = 100,
+        buffer_size: int = 1 << 20,
+        on_sync: collections.abc.Callable[[], None] | None = None
+    ):
+        self._file = open(path, 'ab', buffering=buffer_size)
+        if self._file.tell() > 0 and not _ends_with_newline(path):
+            # 'From ' line must be at the beginning of a line
+            self._file.write(b'\n')
+        self._sync_every = sync_every
+        self._on_sync = on_sync
+        self._unsynced = 0
+
+    def add(self, msgb: bytes):
+        # messages added until now are synced before writing a new one,
+        # so that on_sync is called while msgb is not written yet
+        if self._unsynced >= self._sync_every:
+            self.sync()
+        msgb = msgb.replace(b'\r\n', b'\n')
+        msgb = _from_unescaped.sub(rb'>\1', msgb)
+        from_line = b'From MAILER-DAEMON ' + time.asctime(time.gmtime()).encode()
+        self._file.write(from_line + b'\n')
+        self._file.write(msgb)
+        if not msgb.endswith(b'\n'):
+            self._file.write(b'\n')
+        # blank line separating messages
+        self._file.write(b'\n')
+        self._unsynced += 1
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        if self._on_sync:
+            self._on_sync()
+
+    def close(self):
+        if self._file.closed:
+            return
+        try:
+            self.sync()
+        finally:
+            self._file.close()
+
+    def __enter__(self) -> 'MboxWriter':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _ends_with_newline(path: str | pathlib.Path) -> bool:
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
@@ -0,0 +1,62 @@
+import collections.abc
+import email.message
+
+
+class LazyMessage:
+
+    # Headers are available right away, the whole message is loaded on first
+    # access to message (see easy.email.Inbox.fetch_lazy).
+    # Headers are read as from an EmailMessage, features reading headers
+    # only never load the body.
+    # analyze_body, when given, computes the body analysis of body features
+    # (see easy.features.BodyAnalysis) without loading the whole message,
+    # returning None when it can't.
+
+    def __init__(
+        self,
+        headers: email.message.EmailMessage,
+        load: collections.abc.Callable[[], email.message.EmailMessage],
+        analyze_body: collections.abc.Callable[[], dict | None] | None = None
+    ):
+        self.headers = headers
+        self._load = load
+        self._message: email.message.EmailMessage | None = None
+        self.analyze_body = analyze_body
+
+    @property
+    def loaded(self) -> bool:
+        return self._message is not None
+
+    @property
+    def message(self) -> email.message.EmailMessage:
+        if self._message is None:
+            self._message = self._load()
+            self._load = None
+        return self._message
+
+    def get(self, name: str, failobj=None):
+        return self.headers.get(name, failobj)
+
+    def get_all(self, name: str, failobj=None):
+        return self.headers.get_all(name, failobj)
+
+    def __getitem__(self, name: str):
+        return self.headers[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.headers
+
+    def keys(self) -> list[str]:
+        return self.headers.keys()
+
+    def items(self) -> list[tuple[str, str]]:
+        return self.headers.items()
+
+
+def load(
+    msg: email.message.EmailMessage | LazyMessage
+) -> email.message.EmailMessage:
+    # the whole message, loaded if lazy
+    if isinstance(msg, LazyMessage):
+        return msg.message
+    return msg
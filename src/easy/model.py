@@ -0,0 +1,247 @@
+import typing
+import collections.abc
+import itertools
+import pathlib
+import numpy as np
+import easy.features
+import easy.matrix
+
+
+# Logistic regression classifying messages as sent-by-human (0) or
+# sent-by-service (1), trained by mini-batch gradient descent.
+# Labeled feature files are features (as output by mkfeatures) with a 'label'
+# column: CSV files are read in chunks, npz files are loaded as a whole.
+# Models are stored as npz.
+
+LABEL = 'label'
+
+# (features, labels) of a chunk of rows
+Chunk = tuple[np.ndarray, np.ndarray]
+Chunks = collections.abc.Callable[[], collections.abc.Iterable[Chunk]]
+
+
+class Model(typing.NamedTuple):
+    columns: list[str]
+    # standardization, applied to features before weights
+    mean: np.ndarray
+    scale: np.ndarray
+    weights: np.ndarray
+    bias: float
+    # easy.features.FEATURES_VERSION the model has been trained on
+    version: int
+
+
+def labeled_chunks(
+    path: str | pathlib.Path, *, chunk_size: int = 65536
+) -> tuple[list[str], Chunks]:
+    # returns the feature columns found in path and a function reading chunks
+    # of them, every call reads path from the beginning
+    path = pathlib.Path(path)
+    names = _names(path)
+    if LABEL not in names:
+        raise ValueError(f"missing '{LABEL}' column")
+    columns = [c for c in easy.features.Features.__annotations__ if c in names]
+    if not columns:
+        raise ValueError('no feature columns')
+
+    def chunks() -> typing.Generator[Chunk, None, None]:
+        for rows, _ in _read(path, columns + [LABEL], chunk_size):
+            yield rows[:, :-1], rows[:, -1]
+
+    return columns, chunks
+
+
+def feature_chunks(
+    path: str | pathlib.Path,
+    columns: list[str],
+    *,
+    chunk_size: int = 65536
+) -> typing.Generator[tuple[np.ndarray, list[str] | None], None, None]:
+    # features of path in columns order, with msgids when path has them
+    path = pathlib.Path(path)
+    missing = set(columns) - set(_names(path))
+    if missing:
+        raise ValueError(f"missing columns: {', '.join(sorted(missing))}")
+    yield from _read(path, columns, chunk_size)
+
+
+def _names(path: pathlib.Path) -> list[str]:
+    if path.suffix == '.npz':
+        with np.load(path) as data:
+            return data['columns'].tolist()
+    with open(path) as fp:
+        return fp.readline().rstrip('\n').split(',')
+
+
+def _read(
+    path: pathlib.Path, columns: list[str], chunk_size: int
+) -> typing.Generator[tuple[np.ndarray, list[str] | None], None, None]:
+    if path.suffix == '.npz':
+        yield from _read_npz(path, columns, chunk_size)
+    else:
+        yield from _read_csv(path, columns, chunk_size)
+
+
+def _read_csv(
+    path: pathlib.Path, columns: list[str], chunk_size: int
+) -> typing.Generator[tuple[np.ndarray, list[str] | None], None, None]:
+    with open(path) as fp:
+        header = fp.readline().rstrip('\n').split(',')
+        usecols = [header.index(c) for c in columns]
+        msgid = header.index('msgid') if 'msgid' in header else None
+        while lines := list(itertools.islice(fp, chunk_size)):
+            rows = np.loadtxt(
+                lines, delimiter=',', usecols=usecols, ndmin=2, dtype=np.float32
+            )
+            msgids = None
+            if msgid is not None:
+                msgids = [line.rstrip('\n').split(',')[msgid] for line in lines]
+            yield rows, msgids
+
+
+def _read_npz(
+    path: pathlib.Path, columns: list[str], chunk_size: int
+) -> typing.Generator[tuple[np.ndarray, list[str] | None], None, None]:
+    matrix = easy.matrix.load(path)
+    rows = matrix.features[:, [matrix.columns.index(c) for c in columns]]
+    rows = rows.astype(np.float32)
+    for i in range(0, len(rows), chunk_size):
+        msgids = None
+        if matrix.msgids is not None:
+            msgids = matrix.msgids[i:i + chunk_size]
+        yield rows[i:i + chunk_size], msgids
+
+
+def fit(
+    chunks: Chunks,
+    columns: list[str],
+    *,
+    epochs: int = 10,
+    batch_size: int = 1024,
+    learning_rate: float = 0.5,
+    l2: float = 1e-4,
+    seed: int = 0,
+    max_memory: int = 1 << 29,
+    on_epoch: collections.abc.Callable[[int, float], None] | None = None
+) -> Model:
+    # Standardization is computed in a first pass over chunks. Chunks read in
+    # that pass are kept (standardized) for the next epochs when they fit
+    # in max_memory bytes, otherwise they are read again on every epoch.
+    # on_epoch is called with the epoch number and its mean log loss.
+    rng = np.random.default_rng(seed)
+    mean, scale, kept = _standardization(chunks, len(columns), max_memory)
+    if kept is not None:
+        for features, _ in kept:
+            features -= mean
+            features /= scale
+        standardized = lambda: kept
+    else:
+        standardized = lambda: (
+            ((features - mean) / scale, labels) for features, labels in chunks()
+        )
+    weights = np.zeros(len(columns), dtype=np.float32)
+    bias = np.float32(0)
+    for epoch in range(epochs):
+        # decaying step size
+        lr = np.float32(learning_rate / (1 + epoch))
+        loss = 0.0
+        count = 0
+        for features, labels in standardized():
+            order = rng.permutation(len(features))
+            for i in range(0, len(order), batch_size):
+                batch = order[i:i + batch_size]
+                x = features[batch]
+                y = labels[batch]
+                p = _sigmoid(x @ weights + bias)
+                error = p - y
+                weights -= lr * (x.T @ error / len(batch) + l2 * weights)
+                bias -= lr * error.mean()
+                loss += _log_loss(p, y)
+                count += len(batch)
+        if on_epoch is not None:
+            on_epoch(epoch, loss / max(count, 1))
+    return Model(
+        columns,
+        mean.astype(np.float64),
+        scale.astype(np.float64),
+        weights.astype(np.float64),
+        float(bias),
+        easy.features.FEATURES_VERSION
+    )
+
+
+def _standardization(
+    chunks: Chunks, width: int, max_memory: int
+) -> tuple[np.ndarray, np.ndarray, list[Chunk] | None]:
+    # per column mean and standard deviation, chunks statistics are merged
+    # as in Chan et al. parallel variance
+    count = 0
+    mean = np.zeros(width)
+    m2 = np.zeros(width)
+    kept: list[Chunk] | None = []
+    size = 0
+    for features, labels in chunks():
+        n = len(features)
+        if n == 0:
+            continue
+        chunk_mean = features.mean(axis=0, dtype=np.float64)
+        chunk_m2 = ((features - chunk_mean) ** 2).sum(axis=0)
+        delta = chunk_mean - mean
+        total = count + n
+        mean += delta * n / total
+        m2 += chunk_m2 + delta ** 2 * count * n / total
+        count = total
+        if kept is not None:
+            size += features.nbytes + labels.nbytes
+            if size <= max_memory:
+                kept.append((features, labels))
+            else:
+                kept = None
+    if count == 0:
+        raise ValueError('no labeled rows')
+    scale = np.sqrt(m2 / count)
+    # constant columns are left as they are
+    scale[scale == 0] = 1
+    return mean.astype(np.float32), scale.astype(np.float32), kept
+
+
+def score(model: Model, features: np.ndarray) -> np.ndarray:
+    # probability of rows (in model.columns order) being sent by a service.
+    # Standardization is folded into weights, rows are scored by a single
+    # matrix-vector product.
+    weights = model.weights / model.scale
+    bias = model.bias - model.mean @ weights
+    return _sigmoid(features @ weights.astype(features.dtype) + bias)
+
+
+def _sigmoid(z: np.ndarray) -> np.ndarray:
+    return 1 / (1 + np.exp(-np.clip(z, -30, 30)))
+
+
+def _log_loss(p: np.ndarray, y: np.ndarray) -> float:
+    p = np.clip(p, 1e-7, 1 - 1e-7)
+    return float(-(y * np.log(p) + (1 - y) * np.log(1 - p)).sum())
+
+
+def save(file: typing.BinaryIO | str | pathlib.Path, model: Model):
+    np.savez(
+        file,
+        columns=np.array(model.columns, dtype=str),
+        mean=model.mean,
+        scale=model.scale,
+        weights=model.weights,
+        bias=np.array(model.bias),
+        version=np.array(model.version)
+    )
+
+
+def load(file: typing.BinaryIO | str | pathlib.Path) -> Model:
+    with np.load(file) as data:
+        return Model(
+            data['columns'].tolist(),
+            data['mean'],
+            data['scale'],
+            data['weights'],
+            float(data['bias']),
+            int(data['version'])
+        )
@@ -0,0 +1,138 @@
+import typing
+import collections.abc
+import concurrent.futures
+import itertools
+import email
+import email.policy
+import easy.cache
+import easy.pending
+import easy.features
+import easy.profiling
+
+
+# (features, msgid, error), exactly one of features and error is None
+_ChunkResult = list[tuple[easy.features.Features | None, str | None, str | None]]
+
+
+class _Chunk(typing.NamedTuple):
+    # messages keys and cached results by position, None when not cached
+    # or without a cache. Messages not cached are evaluated by the future.
+    keys: list[bytes] | None
+    hits: list[tuple[easy.features.Features, str | None] | None] | None
+
+
+def evaluate_parallel(
+    raws: collections.abc.Iterable[bytes],
+    *,
+    workers: int,
+    chunk_size: int = 64,
+    ordered: bool = True,
+    cache: easy.cache.FeatureCache | None = None,
+    profiler: easy.profiling.Profiler | None = None
+) -> typing.Generator[tuple[easy.features.Features, str | None], None, None]:
+    # Raw messages are sent to a process pool in chunks, parsing and evaluation
+    # happen in the workers. At most 2 chunks per worker are in flight, raws
+    # are not consumed any further until a chunk completes (backpressure).
+    # Messages failing evaluation are reported as evaluate() does and skipped.
+    # Messages found in cache are not sent to workers, the cache is only
+    # accessed by this process. Workers profile their messages when a
+    # profiler is given, records are merged into it.
+    max_pending = workers * 2
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        pending: dict[concurrent.futures.Future, _Chunk] = {}
+        for chunk in _chunks(raws, chunk_size):
+            future, c = _submit(pool, chunk, cache, profiler is not None)
+            pending[future] = c
+            if len(pending) >= max_pending:
+                yield from _collect(pending, ordered, cache, profiler)
+        while pending:
+            yield from _collect(pending, ordered, cache, profiler)
+
+
+def _chunks(
+    iterable: collections.abc.Iterable, size: int
+) -> typing.Generator[list, None, None]:
+    it = iter(iterable)
+    while chunk := list(itertools.islice(it, size)):
+        yield chunk
+
+
+def _submit(
+    pool: concurrent.futures.Executor,
+    raws: list[bytes],
+    cache: easy.cache.FeatureCache | None,
+    profile: bool
+) -> tuple[concurrent.futures.Future, _Chunk]:
+    if cache is None:
+        return pool.submit(_evaluate_chunk, raws, profile), _Chunk(None, None)
+    keys = [cache.key(raw) for raw in raws]
+    hits = [cache.get(key) for key in keys]
+    misses = [raw for raw, hit in zip(raws, hits) if hit is None]
+    if misses:
+        future = pool.submit(_evaluate_chunk, misses, profile)
+    else:
+        future = concurrent.futures.Future()
+        future.set_result(([], None))
+    return future, _Chunk(keys, hits)
+
+
+def _collect(
+    pending: dict[concurrent.futures.Future, _Chunk],
+    ordered: bool,
+    cache: easy.cache.FeatureCache | None,
+    profiler: easy.profiling.Profiler | None
+) -> typing.Generator[tuple[easy.features.Features, str | None], None, None]:
+    # waits for a chunk (see easy.pending) and yields its features
+    future, chunk = easy.pending.pop_next(pending, ordered)
+    results, chunk_profiler = future.result()
+    if chunk_profiler is not None:
+        profiler.merge(chunk_profiler)
+    results = iter(results)
+    if chunk.keys is None:
+        merged = results
+    else:
+        merged = _merge_hits(chunk, results, cache)
+    for features, msgid, error in merged:
+        if error is not None:
+            easy.features.report_error(error, msgid)
+            continue
+        yield features, msgid
+
+
+def _merge_hits(
+    chunk: _Chunk,
+    results: collections.abc.Iterator,
+    cache: easy.cache.FeatureCache
+) -> typing.Generator[tuple, None, None]:
+    # restores chunk order, evaluated messages are stored in cache
+    for key, hit in zip(chunk.keys, chunk.hits):
+        if hit is not None:
+            yield hit[0], hit[1], None
+            continue
+        features, msgid, error = next(results)
+        if error is None:
+            cache.put(key, features, msgid)
+        yield features, msgid, error
+
+
+def _evaluate_chunk(
+    raws: list[bytes], profile: bool = False
+) -> tuple[_ChunkResult, easy.profiling.Profiler | None]:
+    # runs in worker processes, exceptions are sent back as strings
+    # since they may not be picklable
+    results = []
+    profiler = easy.profiling.Profiler() if profile else None
+    for raw in raws:
+        if profiler is not None:
+            msg, features, error = profiler.evaluate(raw)
+        else:
+            msg = email.message_from_bytes(raw, policy=email.policy.default)
+            features = error = None
+            try:
+                features = easy.features._evaluate(msg)
+            except Exception as e:
+                error = e
+        msgid = msg.get('message-id')
+        msgid = str(msgid) if msgid is not None else None
+        results.append((features, msgid, str(error) if error is not None else None))
+    return results, profiler
@@ -0,0 +1,37 @@
+import typing
+import concurrent.futures
+
+
+# Batches in flight, as {future: batch} dicts in submission order, consumed
+# in submission order (ordered) or as they complete.
+
+T = typing.TypeVar('T')
+
+
+def pop_next(
+    pending: dict[concurrent.futures.Future, T], ordered: bool
+) -> tuple[concurrent.futures.Future, T]:
+    # waits for a future (the oldest one if ordered), removed from pending
+    if ordered:
+        future = next(iter(pending))
+        concurrent.futures.wait([future])
+    else:
+        done, _ = concurrent.futures.wait(
+            pending,
+            return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        future = done.pop()
+    return future, pending.pop(future)
+
+
+async def pop_next_async(pending: dict, ordered: bool) -> tuple:
+    # same as pop_next, for asyncio tasks
+    # asyncio is needed by easy.aioimap only
+    import asyncio
+    if ordered:
+        task = next(iter(pending))
+        await asyncio.wait([task])
+    else:
+        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        task = done.pop()
+    return task, pending.pop(task)
@@ -0,0 +1,104 @@
+import array
+import email
+import email.message
+import email.policy
+import heapq
+import statistics
+import time
+import easy.features
+
+
+class Profiler:
+
+    # Records parse time, time spent on every feature and size of evaluated
+    # messages. Times are kept per feature (for percentiles), messages only
+    # for the slowest ones.
+
+    def __init__(self, *, slowest: int = 10):
+        # 'parse', feature names, 'body_analysis', 'total' -> seconds
+        self.times: dict[str, array.array] = {}
+        self.sizes = array.array('q')
+        self._slowest_count = slowest
+        # min-heap of (total seconds, msgid, size)
+        self._slowest: list[tuple[float, str, int]] = []
+
+    def evaluate(
+        self, raw: bytes
+    ) -> tuple[
+        email.message.EmailMessage, easy.features.Features | None, Exception | None
+    ]:
+        # parses and evaluates raw, features are None when evaluation fails
+        t = time.perf_counter()
+        msg = email.message_from_bytes(raw, policy=email.policy.default)
+        profile = {'parse': time.perf_counter() - t}
+        features = error = None
+        try:
+            features = easy.features._evaluate(msg, profile)
+        except Exception as e:
+            error = e
+        self.record(msg.get('message-id'), len(raw), profile)
+        return msg, features, error
+
+    def record(self, msgid: str | None, size: int, profile: dict[str, float]):
+        self.sizes.append(size)
+        total = 0.0
+        for name, seconds in profile.items():
+            self.times.setdefault(name, array.array('d')).append(seconds)
+            total += seconds
+        self.times.setdefault('total', array.array('d')).append(total)
+        item = (total, str(msgid) if msgid is not None else '', size)
+        if len(self._slowest) < self._slowest_count:
+            heapq.heappush(self._slowest, item)
+        else:
+            heapq.heappushpop(self._slowest, item)
+
+    def merge(self, other: 'Profiler'):
+        for name, times in other.times.items():
+            self.times.setdefault(name, array.array('d')).extend(times)
+        self.sizes.extend(other.sizes)
+        for item in other._slowest:
+            if len(self._slowest) < self._slowest_count:
+                heapq.heappush(self._slowest, item)
+            else:
+                heapq.heappushpop(self._slowest, item)
+
+    def slowest(self) -> list[tuple[float, str, int]]:
+        return sorted(self._slowest, reverse=True)
+
+    def summary(self) -> str:
+        count = len(self.sizes)
+        if count == 0:
+            return 'no messages evaluated'
+        total = sum(self.times['total'])
+        lines = [
+            f'{count} messages, {sum(self.sizes) / 1e6:.1f} MB, '
+            f'{total:.2f}s ({count / total:.1f} msgs/s)',
+            f"{'':>24} {'total':>9} {'share':>6} {'mean':>9} {'p50':>9} "
+            f"{'p90':>9} {'p99':>9} {'max':>9}"
+        ]
+        for name, times in sorted(self.times.items(), key=lambda i: -sum(i[1])):
+            if name == 'total':
+                continue
+            lines.append(
+                f'{name:>24} {sum(times):8.2f}s {sum(times) / total:6.1%} '
+                + ' '.join(_ms(t) for t in _stats(times))
+            )
+        lines.append(f'{"size":>24} {"":>16} ' + ' '.join(
+            f'{s / 1e3:7.1f}KB' for s in _stats(self.sizes)
+        ))
+        lines.append('slowest messages:')
+        for seconds, msgid, size in self.slowest():
+            lines.append(f'{_ms(seconds)} {size / 1e3:9.1f}KB {msgid}')
+        return '\n'.join(lines)
+
+
+def _stats(values) -> list[float]:
+    # mean, p50, p90, p99, max
+    if len(values) == 1:
+        return [values[0]] * 5
+    q = statistics.quantiles(values, n=100, method='inclusive')
+    return [statistics.fmean(values), q[49], q[89], q[98], max(values)]
+
+
+def _ms(seconds: float) -> str:
+    return f'{seconds * 1e3:7.2f}ms'
@@ -0,0 +1,206 @@
+import typing
+import collections.abc
+import datetime
+import email.message
+import email.utils
+import heapq
+import easy.features
+
+
+# Messages aggregated by sender domain, to find out which services send us
+# emails. Only headers are read.
+# At most max_domains domains are tracked: beyond that the least frequent
+# domain is replaced by the new one (Space-Saving), so that the most frequent
+# domains are kept with overestimated counts. A domain count is overestimated
+# by at most its error. Domains are exact as long as max_domains is not
+# exceeded.
+
+# Domains are registrable domains: the public suffix and the label before it,
+# e.g. news.bbc.co.uk -> bbc.co.uk, amazon.de and amazon.com apart.
+# Public suffixes of more than one label are those of PUBLIC_SUFFIXES, a
+# subset of the Public Suffix List covering the most common ones; other
+# domains are taken as having a single label suffix (the TLD).
+PUBLIC_SUFFIXES = frozenset([
+    'co.uk', 'org.uk', 'me.uk', 'ltd.uk', 'plc.uk', 'net.uk', 'ac.uk', 'gov.uk', 'nhs.uk',
+    'com.au', 'net.au', 'org.au', 'edu.au', 'gov.au',
+    'co.nz', 'org.nz', 'net.nz', 'govt.nz',
+    'co.jp', 'ne.jp', 'or.jp', 'ac.jp', 'go.jp',
+    'co.kr', 'or.kr', 'ne.kr',
+    'co.in', 'net.in', 'org.in', 'gov.in', 'ac.in',
+    'co.za', 'org.za', 'gov.za',
+    'co.il', 'org.il', 'ac.il',
+    'co.id', 'or.id', 'ac.id',
+    'co.th', 'in.th', 'ac.th',
+    'com.br', 'net.br', 'org.br', 'gov.br',
+    'com.ar', 'com.mx', 'com.co', 'com.pe', 'com.ve', 'com.uy', 'com.ec',
+    'com.cn', 'net.cn', 'org.cn', 'gov.cn', 'edu.cn',
+    'com.hk', 'org.hk', 'com.tw', 'org.tw', 'com.sg', 'org.sg', 'edu.sg',
+    'com.my', 'org.my', 'com.ph', 'com.vn', 'com.pk', 'com.bd',
+    'com.tr', 'org.tr', 'gen.tr', 'com.ua', 'org.ua', 'com.pl', 'net.pl', 'org.pl',
+    'com.gr', 'com.cy', 'com.mt', 'co.at', 'or.at', 'com.es', 'org.es', 'com.pt',
+    'com.ru', 'org.ru', 'com.eg', 'com.sa', 'com.ng', 'co.ke',
+])
+
+# service signals counted per domain, computed as header features
+SIGNALS = [
+    'has_list_unsubscribe',
+    'has_list_id',
+    'has_precedence',
+    'has_feedback_id',
+    'has_mailer',
+    'has_campaign',
+    'has_csa_complaints',
+]
+
+
+class DomainStats(typing.TypedDict):
+    domain: str
+    count: int
+    # count overestimation, 0 unless domains have been replaced
+    error: int
+    # ISO dates, None when no message has a valid date
+    first_seen: str | None
+    last_seen: str | None
+    # signals counts, one key per SIGNALS name
+    has_list_unsubscribe: int
+    has_list_id: int
+    has_precedence: int
+    has_feedback_id: int
+    has_mailer: int
+    has_campaign: int
+    has_csa_complaints: int
+
+
+class _Counter:
+
+    __slots__ = ('count', 'error', 'first_seen', 'last_seen', 'signals')
+
+    def __init__(self, error: int):
+        self.count = error
+        self.error = error
+        # POSIX timestamps
+        self.first_seen: float | None = None
+        self.last_seen: float | None = None
+        self.signals = [0] * len(SIGNALS)
+
+
+class ServiceAggregator:
+
+    def __init__(self, *, max_domains: int = 100_000):
+        self._max_domains = max_domains
+        self._counters: dict[str, _Counter] = {}
+        # min-heap of (count, domain), one entry per tracked domain.
+        # Counts only grow, entries are refreshed lazily when popped
+        self._heap: list[tuple[int, str]] = []
+        self.messages = 0
+        # messages without a parsable sender
+        self.skipped = 0
+        self.replaced = 0
+
+    def add(self, msg: email.message.EmailMessage):
+        self.messages += 1
+        try:
+            sender = email.utils.getaddresses(msg.get_all('from', []))[0][1]
+            domain = registrable_domain(sender.rsplit('@', 1)[1])
+        except (IndexError, ValueError):
+            self.skipped += 1
+            return
+        counter = self._counters.get(domain)
+        if counter is None:
+            counter = self._track(domain)
+        counter.count += 1
+        seen = _timestamp(msg)
+        if seen is not None:
+            if counter.first_seen is None or seen < counter.first_seen:
+                counter.first_seen = seen
+            if counter.last_seen is None or seen > counter.last_seen:
+                counter.last_seen = seen
+        for i, name in enumerate(SIGNALS):
+            counter.signals[i] += easy.features._header_features[name](msg)
+
+    def _track(self, domain: str) -> _Counter:
+        error = 0
+        if len(self._counters) >= self._max_domains:
+            error = self._pop_min()
+            self.replaced += 1
+        counter = _Counter(error)
+        self._counters[domain] = counter
+        # pushed with the count it will have once the message is added
+        heapq.heappush(self._heap, (error + 1, domain))
+        return counter
+
+    def _pop_min(self) -> int:
+        # removes the least frequent domain and returns its count
+        while True:
+            count, domain = heapq.heappop(self._heap)
+            actual = self._counters[domain].count
+            if actual == count:
+                del self._counters[domain]
+                return count
+            heapq.heappush(self._heap, (actual, domain))
+
+    def __len__(self) -> int:
+        return len(self._counters)
+
+    def top(self, n: int | None = None) -> list[DomainStats]:
+        # most frequent domains first
+        counters = heapq.nlargest(
+            n if n is not None else len(self._counters),
+            self._counters.items(),
+            key=lambda i: i[1].count
+        )
+        return [_stats(domain, counter) for domain, counter in counters]
+
+
+def aggregate(
+    msgs: collections.abc.Iterable[email.message.EmailMessage],
+    *,
+    max_domains: int = 100_000
+) -> ServiceAggregator:
+    aggregator = ServiceAggregator(max_domains=max_domains)
+    for msg in msgs:
+        aggregator.add(msg)
+    return aggregator
+
+
+def registrable_domain(domain: str) -> str:
+    # e.g. news.bbc.co.uk -> bbc.co.uk, mail.shop.com -> shop.com
+    labels = domain.strip().rstrip('.').lower().split('.')
+    if len(labels) < 2 or not all(labels):
+        raise ValueError(f'not a domain: {domain}')
+    n = 3 if '.'.join(labels[-2:]) in PUBLIC_SUFFIXES else 2
+    if len(labels) < n:
+        # a public suffix alone
+        raise ValueError(f'not a registrable domain: {domain}')
+    return '.'.join(labels[-n:])
+
+
+def _timestamp(msg: email.message.EmailMessage) -> float | None:
+    try:
+        date = msg.get('date')
+        if date is None or date.datetime is None:
+            return None
+        return date.datetime.timestamp()
+    except (TypeError, ValueError, AttributeError, OverflowError):
+        # unparsable dates are defects, datetime is missing
+        return None
+
+
+def _iso(timestamp: float | None) -> str | None:
+    if timestamp is None:
+        return None
+    return datetime.datetime.fromtimestamp(
+        timestamp, datetime.timezone.utc
+    ).isoformat()
+
+
+def _stats(domain: str, counter: _Counter) -> DomainStats:
+    stats = {
+        'domain': domain,
+        'count': counter.count,
+        'error': counter.error,
+        'first_seen': _iso(counter.first_seen),
+        'last_seen': _iso(counter.last_seen),
+    }
+    stats.update(zip(SIGNALS, counter.signals))
+    return stats
@@ -0,0 +1,99 @@
+import codecs
+import binascii
+import re
+import email.message
+
+
+# Sizes of part contents, as len() of what email would decode or encode,
+# computed without making whole copies of them.
+# Payloads are sized from their transfer-encoded text: base64 from its
+# length, quoted-printable decoded a chunk of lines at a time. Text is encoded
+# a chunk at a time, ASCII text is not encoded at all.
+# Whatever can't be sized this way (invalid encodings, 8bit payloads) is
+# decoded as email does, sizes are always exact.
+
+# characters of text or lines of payload encoded or decoded at once
+CHUNK = 1 << 16
+
+# maintypes email decodes to bytes (see email.contentmanager.raw_data_manager)
+BINARY_MAINTYPES = ('audio', 'image', 'video', 'application')
+
+# valid base64 as email decodes it: line breaks are dropped, any other
+# character makes it fall back to lenient decoding
+_base64 = re.compile(r'[A-Za-z0-9+/\r\n]*(?:=[\r\n]*){0,2}')
+_whitespace = re.compile(r'\s+')
+
+
+def payload_size(p: email.message.Message) -> int:
+    # len(p.get_payload(decode=True)) of non-multipart parts
+    payload = p.get_payload()
+    # transfer encodings are ASCII, other payloads have been decoded
+    # (8bit ones, see email.message.Message.get_payload)
+    if not isinstance(payload, str) or not payload.isascii():
+        return len(p.get_payload(decode=True))
+    cte = str(p.get('content-transfer-encoding', '')).lower()
+    size = None
+    if cte == 'base64':
+        size = _base64_size(payload)
+    elif cte == 'quoted-printable':
+        size = _quoted_printable_size(payload)
+    elif cte not in ('x-uuencode', 'uuencode', 'uue', 'x-uue'):
+        # not decoded at all
+        size = len(payload)
+    if size is None:
+        return len(p.get_payload(decode=True))
+    return size
+
+
+def _base64_size(payload: str) -> int | None:
+    if _base64.fullmatch(payload) is None:
+        return None
+    chars = len(payload) - payload.count('\r') - payload.count('\n')
+    if chars % 4:
+        # padding is fixed by email
+        return None
+    return chars // 4 * 3 - payload.count('=')
+
+
+def _quoted_printable_size(payload: str) -> int:
+    # soft line breaks and escapes don't span lines, chunks end with a line
+    size = 0
+    start = 0
+    while start < len(payload):
+        end = payload.find('\n', start + CHUNK)
+        end = len(payload) if end == -1 else end + 1
+        size += len(binascii.a2b_qp(payload[start:end].encode('ascii')))
+        start = end
+    return size
+
+
+def text_size(s: str, charset: str | None = None) -> int:
+    # len(s.encode(charset)), charset defaults to utf-8
+    name = codecs.lookup(charset or 'utf-8').name
+    if s.isascii() and _ascii_compatible(name):
+        return len(s)
+    # incremental encoders keep state across chunks (BOMs, shift sequences)
+    encoder = codecs.getincrementalencoder(name)()
+    size = sum(
+        len(encoder.encode(s[i:i + CHUNK])) for i in range(0, len(s), CHUNK)
+    )
+    return size + len(encoder.encode('', final=True))
+
+
+def clean_text_size(s: str, charset: str | None = None) -> int:
+    # text_size(easy.features.clean_text(s), charset): whitespace runs are
+    # counted as a single space, leading and trailing ones are stripped
+    name = codecs.lookup(charset or 'utf-8').name
+    if not s.isascii() or not _ascii_compatible(name):
+        return text_size(_whitespace.sub(' ', s.strip()), name)
+    size = len(s)
+    for m in _whitespace.finditer(s):
+        size -= m.end() - m.start()
+        if m.start() > 0 and m.end() < len(s):
+            size += 1
+    return size
+
+
+def _ascii_compatible(name: str) -> bool:
+    # codecs encoding ASCII characters as themselves, one byte each
+    return name in ('utf-8', 'ascii') or name.startswith(('iso8859-', 'cp125'))
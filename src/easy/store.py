@@ -0,0 +1,293 @@
+import collections.abc
+import datetime
+import email.message
+import email.parser
+import email.policy
+import email.utils
+import hashlib
+import pathlib
+import sqlite3
+import easy.archive
+import easy.email
+
+
+# Local store of messages: a compressed archive (see easy.archive) and a
+# sqlite index of it, in a directory.
+# Messages are added once (same bytes, same message) and numbered in the
+# order they have been added. They are indexed by Message-ID, date, From
+# header, sender address and domain, size and names of their headers, so
+# that messages matching a search (easy.email.SearchFilter) are read without
+# scanning the archive. Searches match as IMAP SEARCH does: dates are
+# internal dates when messages are added along with theirs (downloads),
+# Date headers otherwise (imported files carry none).
+# Index rows are committed once their messages are synced to the archive,
+# messages synced but not indexed (a crash in between) are indexed when the
+# store is opened for writing again.
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS messages (
+    -- message number in the archive
+    id INTEGER PRIMARY KEY,
+    -- sha256 of the message
+    key BLOB NOT NULL UNIQUE,
+    msgid TEXT,
+    -- Date header, POSIX timestamp
+    date INTEGER,
+    -- searched by since and before: IMAP internal date when known, date
+    -- otherwise
+    received INTEGER,
+    -- lowercase From header, display names included, searched by sender
+    from_header TEXT,
+    -- lowercase From address and its domain, domain labels reversed
+    -- (e.g. com.example.news.) to match subdomains with a range of the index
+    sender TEXT,
+    domain TEXT,
+    rdomain TEXT,
+    size INTEGER NOT NULL,
+    list_id TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_msgid ON messages (msgid);
+CREATE INDEX IF NOT EXISTS messages_received ON messages (received);
+CREATE INDEX IF NOT EXISTS messages_rdomain_received ON messages (rdomain, received);
+CREATE INDEX IF NOT EXISTS messages_size ON messages (size);
+CREATE TABLE IF NOT EXISTS header_names (
+    -- lowercase
+    name TEXT NOT NULL,
+    message INTEGER NOT NULL,
+    PRIMARY KEY (name, message)
+) WITHOUT ROWID;
+'''
+
+# PRAGMA user_version, stores of previous versions are migrated when opened
+_version = 1
+
+_parser = email.parser.BytesParser(policy=email.policy.compat32)
+
+
+class MessageStore:
+
+    def __init__(
+        self,
+        path: str | pathlib.Path,
+        *,
+        codec: str = 'zlib',
+        sync_every: int = 100,
+        on_sync: collections.abc.Callable[[], None] | None = None
+    ):
+        path = pathlib.Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        self._archive_path = path / 'messages.arc'
+        self._archive_path.touch()
+        self._db = sqlite3.connect(path / 'index.sqlite')
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        self._migrate()
+        self._db.executescript(_schema)
+        self._db.execute(f'PRAGMA user_version = {_version}')
+        self._codec = codec
+        self._sync_every = sync_every
+        self._on_sync = on_sync
+        # opened by the first add
+        self._writer: easy.archive.ArchiveWriter | None = None
+        self._next = 0
+
+    def __len__(self) -> int:
+        return self._db.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+    def _migrate(self):
+        columns = {row[1] for row in self._db.execute('PRAGMA table_info(messages)')}
+        if not columns or 'received' in columns:
+            return
+        # version 0: no received and from_header, filled from the archive
+        self._db.executescript('''
+            ALTER TABLE messages ADD COLUMN received INTEGER;
+            ALTER TABLE messages ADD COLUMN from_header TEXT;
+            DROP INDEX IF EXISTS messages_date;
+            DROP INDEX IF EXISTS messages_rdomain;
+        ''')
+        reader = easy.archive.ArchiveReader(self._archive_path)
+        try:
+            for (i,) in self._db.execute('SELECT id FROM messages').fetchall():
+                block, start, stop = reader.locate(i)
+                headers = _headers(block[start:stop])
+                self._db.execute(
+                    'UPDATE messages SET received = date, from_header = ? WHERE id = ?',
+                    (_from_header(headers), i)
+                )
+        finally:
+            reader.close()
+        self._db.commit()
+
+    def add(self, msgb: bytes, *, received: int | None = None) -> bool:
+        # False when the message is already stored.
+        # received is the IMAP internal date (POSIX timestamp) if known
+        if self._writer is None:
+            self._open_writer()
+        key = hashlib.sha256(msgb).digest()
+        if self._db.execute('SELECT 1 FROM messages WHERE key = ?', (key,)).fetchone():
+            return False
+        # messages added until now may be synced, and committed, first
+        self._writer.add(msgb)
+        self._index(self._next, key, msgb, received)
+        self._next += 1
+        return True
+
+    def _open_writer(self):
+        self._writer = easy.archive.ArchiveWriter(
+            self._archive_path,
+            codec=self._codec,
+            sync_every=self._sync_every,
+            on_sync=self._synced
+        )
+        self._next = self._db.execute('SELECT COALESCE(MAX(id) + 1, 0) FROM messages').fetchone()[0]
+        reader = easy.archive.ArchiveReader(self._archive_path)
+        try:
+            for i in range(self._next, len(reader)):
+                block, start, stop = reader.locate(i)
+                msgb = block[start:stop]
+                self._index(i, hashlib.sha256(msgb).digest(), msgb)
+            self._next = max(self._next, len(reader))
+        finally:
+            reader.close()
+        self._db.commit()
+
+    def _index(self, i: int, key: bytes, msgb: bytes, received: int | None = None):
+        headers = _headers(msgb)
+        sender, domain = _sender(headers)
+        date = _date(headers)
+        self._db.execute(
+            'INSERT INTO messages '
+            '(id, key, msgid, date, received, from_header, sender, domain, rdomain, size, list_id) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (
+                i,
+                key,
+                _header(headers, 'message-id'),
+                date,
+                received if received is not None else date,
+                _from_header(headers),
+                sender,
+                domain,
+                _reversed(domain) if domain else None,
+                len(msgb),
+                _header(headers, 'list-id')
+            )
+        )
+        self._db.executemany(
+            'INSERT OR IGNORE INTO header_names VALUES (?, ?)',
+            ((name.lower(), i) for name in headers.keys())
+        )
+
+    def _synced(self):
+        self._db.commit()
+        if self._on_sync:
+            self._on_sync()
+
+    def query(self, search: easy.email.SearchFilter | None = None) -> list[int]:
+        # numbers of messages matching search, in the order they have been added
+        conditions, params = _conditions(search or {})
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        return [
+            row[0] for row in self._db.execute(f'SELECT id FROM messages {where} ORDER BY id', params)
+        ]
+
+    def inbox(self, search: easy.email.SearchFilter | None = None) -> easy.email.LocalArchive:
+        # messages matching search, read in archive order.
+        # Messages added are synced first, to be read back
+        if self._writer is not None:
+            self._writer.sync()
+        archive = easy.email.LocalArchive(easy.email.ArchiveConf(path=str(self._archive_path)))
+        return archive.subset(self.query(search))
+
+    def close(self):
+        try:
+            if self._writer is not None:
+                self._writer.close()
+                # statistics of indexes, for the query planner
+                self._db.execute('PRAGMA optimize')
+            self._db.commit()
+        finally:
+            self._db.close()
+
+    def __enter__(self) -> 'MessageStore':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _headers(msgb: bytes) -> email.message.Message:
+    return _parser.parsebytes(
+        msgb[:easy.email._headers_end(msgb, 0, len(msgb))], headersonly=True
+    )
+
+
+def _from_header(headers: email.message.Message) -> str | None:
+    # all From headers, lowercase
+    values = headers.get_all('from')
+    return '\n'.join(str(v) for v in values).lower() if values else None
+
+
+def _header(headers: email.message.Message, name: str) -> str | None:
+    value = headers.get(name)
+    return str(value).strip() if value is not None else None
+
+
+def _date(headers: email.message.Message) -> int | None:
+    try:
+        date = email.utils.parsedate_to_datetime(str(headers.get('date', '')))
+    except (TypeError, ValueError, IndexError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return int(date.timestamp())
+
+
+def _sender(headers: email.message.Message) -> tuple[str | None, str | None]:
+    # From address and its domain, lowercase
+    addresses = email.utils.getaddresses([str(v) for v in headers.get_all('from', [])])
+    if not addresses or '@' not in addresses[0][1]:
+        return None, None
+    sender = addresses[0][1].lower()
+    return sender, sender.rsplit('@', 1)[1].rstrip('.')
+
+
+def _reversed(domain: str) -> str:
+    # e.g. news.example.com -> com.example.news.
+    return '.'.join(reversed(domain.split('.'))) + '.'
+
+
+def _timestamp(date: datetime.date) -> int:
+    # midnight UTC
+    return int(datetime.datetime.combine(date, datetime.time(), datetime.timezone.utc).timestamp())
+
+
+def _conditions(search: easy.email.SearchFilter) -> tuple[list[str], list]:
+    # SQL conditions on messages matched by search, and their parameters
+    conditions = []
+    params = []
+    if 'since' in search:
+        conditions.append('received >= ?')
+        params.append(_timestamp(search['since']))
+    if 'before' in search:
+        conditions.append('received < ?')
+        params.append(_timestamp(search['before']))
+    if 'sender' in search:
+        conditions.append("from_header LIKE ? ESCAPE '\\'")
+        escaped = search['sender'].lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        params.append(f'%{escaped}%')
+    if 'domain' in search:
+        # the domain and its subdomains, '/' follows '.'
+        rdomain = _reversed(search['domain'].lower().strip('.'))
+        conditions.append('rdomain >= ? AND rdomain < ?')
+        params += [rdomain, rdomain[:-1] + '/']
+    for name in search.get('headers', []):
+        conditions.append('id IN (SELECT message FROM header_names WHERE name = ?)')
+        params.append(name.lower())
+    if 'larger' in search:
+        conditions.append('size > ?')
+        params.append(search['larger'])
+    if 'smaller' in search:
+        conditions.append('size < ?')
+        params.append(search['smaller'])
+    return conditions, params
@@ -0,0 +1,336 @@
+import typing
+import collections.abc
+import re
+import email.message
+import email.parser
+import email.policy
+import easy.features
+
+
+# IMAP FETCH and LIST responses, BODYSTRUCTURE (RFC 3501).
+# Body features are computed from the structure of a message: text parts are
+# fetched and analyzed as evaluate does, sizes of other parts come from the
+# structure. Decoded sizes of base64 parts are derived from their first and
+# last bytes, assuming lines are wrapped at a fixed length, as encoders do.
+# Whatever can't be sized exactly is fetched.
+
+# bytes fetched from both ends of base64 parts
+EDGE = 256
+
+
+class Part(typing.TypedDict):
+    # section number, e.g. '2.1', empty for the body of non-multipart messages
+    section: str
+    # lowercase 'type/subtype'
+    content_type: str
+    # lowercase names
+    params: dict[str, str]
+    # lowercase transfer encoding, empty for multiparts
+    encoding: str
+    # encoded size in bytes
+    size: int
+    # lowercase disposition type
+    disposition: str | None
+    # multipart subparts
+    parts: list['Part']
+
+
+# section and optional (start, length) of a partial fetch
+Section = tuple[str, tuple[int, int] | None]
+Fetch = collections.abc.Callable[[list[Section]], dict[Section, bytes]]
+
+
+_tokens = re.compile(
+    rb'(?P<open>\()|(?P<close>\))|(?P<literal>\{\d+\}$)'
+    rb'|"(?P<quoted>(?:[^"\\]|\\.)*)"'
+    rb'|(?P<section>[A-Za-z0-9.]+\[[^\]]*\](?:<\d+>)?)'
+    rb'|(?P<atom>[^\s()"]+)'
+)
+
+
+def parse_fetch(data: list) -> list[tuple[int, dict[str, typing.Any]]]:
+    # imaplib FETCH response data as (message sequence number, items).
+    # Literals are split by imaplib as (text ending with '{n}', literal)
+    values = _parse_values(_tokenize(data))
+    responses = []
+    for i in range(0, len(values) - 1, 2):
+        seq, items = values[i], values[i + 1]
+        responses.append((seq, {
+            items[j].decode().upper(): items[j + 1] for j in range(0, len(items) - 1, 2)
+        }))
+    return responses
+
+
+def parse_list(data: list) -> list[tuple[list[str], str | None, str]]:
+    # imaplib LIST response data as (flags, hierarchy delimiter, name).
+    # Names are left in modified UTF-7
+    values = _parse_values(_tokenize(data))
+    return [
+        ([_str(f) for f in values[i]], _str(values[i + 1]) or None, _name(values[i + 2]))
+        for i in range(0, len(values) - 2, 3)
+    ]
+
+
+def _name(value) -> str:
+    # numeric names are tokenized as numbers
+    return str(value) if isinstance(value, int) else _str(value)
+
+
+def _tokenize(data: list) -> list:
+    tokens = []
+    for d in data:
+        text, literal = (d[0], d[1]) if isinstance(d, tuple) else (d, None)
+        if text is None:
+            continue
+        for m in _tokens.finditer(text):
+            match m.lastgroup:
+                case 'open':
+                    tokens.append('(')
+                case 'close':
+                    tokens.append(')')
+                case 'literal':
+                    tokens.append(literal)
+                case 'quoted':
+                    tokens.append(re.sub(rb'\\(.)', rb'\1', m.group('quoted')))
+                case 'section' | 'atom':
+                    atom = m.group()
+                    if atom.upper() == b'NIL':
+                        tokens.append(None)
+                    elif atom.isdigit():
+                        tokens.append(int(atom))
+                    else:
+                        tokens.append(_Atom(atom))
+    return tokens
+
+
+class _Atom(bytes):
+    # unquoted strings, told apart from quoted ones and literals
+    pass
+
+
+def _parse_values(tokens: list) -> list:
+    # nested lists of values
+    stack: list[list] = [[]]
+    for t in tokens:
+        if t == '(':
+            stack.append([])
+        elif t == ')':
+            values = stack.pop()
+            stack[-1].append(values)
+        else:
+            stack[-1].append(t)
+    return stack[0]
+
+
+def parse_bodystructure(value: list, section: str = '') -> Part:
+    if isinstance(value[0], list):
+        # multipart: parts, subtype, [params, disposition, ...]
+        parts = []
+        i = 0
+        while isinstance(value[i], list):
+            child = f'{section}.{i + 1}' if section else str(i + 1)
+            parts.append(parse_bodystructure(value[i], child))
+            i += 1
+        ext = value[i + 1:]
+        return {
+            'section': section,
+            'content_type': 'multipart/' + _str(value[i]).lower(),
+            'params': _params(ext[0] if len(ext) > 0 else None),
+            'encoding': '',
+            'size': 0,
+            'disposition': _disposition(ext[1] if len(ext) > 1 else None),
+            'parts': parts,
+        }
+    # type, subtype, params, id, description, encoding, size, ...
+    content_type = f'{_str(value[0])}/{_str(value[1])}'.lower()
+    ext = value[7:]
+    if content_type == 'message/rfc822':
+        # envelope, body, lines
+        ext = ext[3:]
+    elif content_type.startswith('text/'):
+        # lines
+        ext = ext[1:]
+    return {
+        'section': section,
+        'content_type': content_type,
+        'params': _params(value[2]),
+        'encoding': (_str(value[5]) or '7bit').lower(),
+        'size': value[6] or 0,
+        # md5, disposition, ...
+        'disposition': _disposition(ext[1] if len(ext) > 1 else None),
+        'parts': [],
+    }
+
+
+def _str(value) -> str:
+    if value is None:
+        return ''
+    return bytes(value).decode('ascii', 'replace')
+
+
+def _params(value: list | None) -> dict[str, str]:
+    if not value:
+        return {}
+    return {
+        _str(value[i]).lower(): _str(value[i + 1])
+        for i in range(0, len(value) - 1, 2)
+    }
+
+
+def _disposition(value: list | None) -> str | None:
+    if not value:
+        return None
+    return _str(value[0]).lower()
+
+
+def _walk(part: Part) -> typing.Iterator[Part]:
+    # same order as email.message.Message.walk
+    yield part
+    for p in part['parts']:
+        yield from _walk(p)
+
+
+def analyze(
+    root: Part, headers: bytes, fetch: Fetch
+) -> easy.features.BodyAnalysis | None:
+    # body analysis of the message having structure root and headers,
+    # as easy.features._analyze_body would compute on the whole message.
+    # Needed sections are fetched at once, parts that can't be sized from
+    # their edges are fetched afterwards.
+    # None when the structure is not supported, the whole message is needed
+    strategies = [(p, _strategy(p)) for p in _walk(root)]
+    if any(s == 'unsupported' for _, s in strategies):
+        return None
+    fetched = _fetch(fetch, [s for p, strategy in strategies for s in _sections(p, strategy)])
+    parts: list[easy.features.BodyPart] = []
+    has_attachment = False
+    # base64 parts not sized from edges, by index in parts
+    irregular: dict[int, Part] = {}
+    for p, strategy in strategies:
+        if p['disposition'] and p['disposition'].startswith('attachment'):
+            has_attachment = True
+        match strategy:
+            case 'analyze':
+                parts.append(_analyze_section(p, headers, fetched))
+            case 'message':
+                inner = _parse(fetched[(_body(p), None)])
+                body = easy.features._analyze_body(inner)
+                parts += body['parts']
+                has_attachment = has_attachment or body['has_attachment']
+            case 'edges':
+                size = _base64_size(p, *(fetched[s] for s in _sections(p, strategy)))
+                if size is None:
+                    irregular[len(parts)] = p
+                parts.append(_binary_part(p, size))
+            case 'sized':
+                parts.append(_binary_part(p, p['size']))
+    if irregular:
+        fetched = _fetch(fetch, [s for p in irregular.values() for s in _sections(p, 'analyze')])
+        for i, p in irregular.items():
+            parts[i] = _analyze_section(p, headers, fetched)
+    return {'parts': parts, 'has_attachment': has_attachment}
+
+
+def _fetch(fetch: Fetch, sections: list[Section]) -> dict[Section, bytes]:
+    return fetch(sections) if sections else {}
+
+
+def _strategy(p: Part) -> str:
+    maintype = p['content_type'].split('/')[0]
+    if maintype == 'multipart':
+        return 'container'
+    if p['content_type'] == 'message/delivery-status':
+        # parsed by the email package as a list of header blocks
+        return 'unsupported'
+    if maintype == 'message':
+        # walked by evaluate as a whole message
+        return 'message'
+    if maintype == 'text':
+        return 'analyze'
+    if p['encoding'] in ('7bit', '8bit', 'binary'):
+        # not decoded at all
+        return 'sized'
+    if p['encoding'] == 'base64' and p['section'] and p['size'] > 2 * EDGE:
+        return 'edges'
+    return 'analyze'
+
+
+def _sections(p: Part, strategy: str) -> list[Section]:
+    # sections fetched by strategy
+    match strategy:
+        case 'analyze' if p['section']:
+            return [(_mime(p), None), (_body(p), None)]
+        case 'analyze':
+            # message headers are known
+            return [(_body(p), None)]
+        case 'message':
+            return [(_body(p), None)]
+        case 'edges':
+            return [(p['section'], (0, EDGE)), (p['section'], (p['size'] - EDGE, EDGE))]
+    return []
+
+
+def _mime(p: Part) -> str:
+    # headers of a part, headers of the message for the body of
+    # non-multipart messages
+    return f"{p['section']}.MIME" if p['section'] else 'HEADER'
+
+
+def _body(p: Part) -> str:
+    return p['section'] or 'TEXT'
+
+
+def _base64_size(p: Part, head: bytes, tail: bytes) -> int | None:
+    # decoded size when lines have the same length (but the last one),
+    # None otherwise. Whitespace is skipped by decoders.
+    # Lines are checked where they are known: the full lines of head and
+    # tail must all have the length of the first one
+    lines = head.split(b'\n')[:-1]
+    if len(lines) < 2:
+        return None
+    newline = 2 if lines[0].endswith(b'\r') else 1
+    line = len(lines[0]) + 1 - newline
+    data = tail.rstrip()
+    tail_lines = data.split(b'\n')
+    # the first one is cut by the fetch
+    known = lines + tail_lines[1:-1]
+    if line == 0 or len(tail_lines) < 3:
+        return None
+    if any(len(l) != len(lines[0]) or l.endswith(b'\r') != (newline == 2) for l in known):
+        return None
+    last_line = len(tail_lines[-1])
+    if not 0 < last_line <= line:
+        return None
+    # content up to the last line, made of full lines only
+    full = p['size'] - (len(tail) - len(data)) - last_line
+    if full % (line + newline):
+        return None
+    chars = full // (line + newline) * line + last_line
+    if chars % 4:
+        return None
+    padding = len(data) - len(data.rstrip(b'='))
+    return chars // 4 * 3 - padding
+
+
+def _binary_part(p: Part, size: int | None) -> easy.features.BodyPart:
+    return {
+        'kind': 'binary',
+        'content_type': p['content_type'],
+        'charset': p['params'].get('charset', '').lower() or None,
+        'size': size or 0,
+        'style_size': 0,
+        'links': []
+    }
+
+
+def _parse(msgb: bytes) -> email.message.EmailMessage:
+    text = str(msgb, 'ASCII', 'surrogateescape')
+    return email.parser.Parser(policy=email.policy.default).parsestr(text)
+
+
+def _analyze_section(
+    p: Part, headers: bytes, fetched: dict[Section, bytes]
+) -> easy.features.BodyPart:
+    # part rebuilt from its headers and body, analyzed as evaluate does
+    mime = fetched[(_mime(p), None)] if p['section'] else headers
+    return easy.features._analyze_part(_parse(mime + fetched[(_body(p), None)]))
@@ -0,0 +1,419 @@
+import re
+import datetime
+import fnmatch
+import hashlib
+import asyncio
+import base64
+import imaplib
+import email
+import email.message
+import email.policy
+import email.utils
+import easy.email
+
+
+# In-memory stand-in of imaplib.IMAP4 serving INBOX and optionally other
+# folders, and a local IMAP server serving one of them per user (INBOX only).
+# Gmail ones identify messages by X-GM-MSGID, the same in every folder.
+# Responses are shaped as imaplib returns them, literals included.
+# MIME parts are split on raw bytes, so that section sizes and contents
+# are exactly those a server would report.
+
+
+class FakeImapClient:
+
+    def __init__(
+        self,
+        msgs: dict[int, bytes],
+        *,
+        uidvalidity: int = 1,
+        tokens: set[str] | None = None,
+        folders: dict[str, dict[int, bytes]] | None = None,
+        gmail: bool = False
+    ):
+        # uid -> raw message of the selected folder, CRLF line endings
+        self.msgs = msgs
+        # folder -> messages, INBOX included
+        self.folders = {'INBOX': msgs} | (folders or {})
+        self.capabilities = ('IMAP4REV1', 'AUTH=XOAUTH2') + (('X-GM-EXT-1',) if gmail else ())
+        self.uidvalidity = uidvalidity
+        # access tokens accepted, any when None
+        self.tokens = tokens
+        # FETCH commands received, as (uids, items)
+        self.fetches: list[tuple[str, str]] = []
+        # numbers of FETCH commands (from 1) failing as dropped connections
+        self.drop_at: set[int] = set()
+        # bytes of literals sent
+        self.sent = 0
+
+    def authenticate(self, mechanism, authobject):
+        token = _xoauth2_fields(authobject(b'')).get('auth', '').removeprefix('Bearer ')
+        if self.tokens is not None and token not in self.tokens:
+            raise imaplib.IMAP4.error('AUTHENTICATE failed')
+        return 'OK', [b'']
+
+    def shutdown(self):
+        pass
+
+    def select(self, folder, readonly=False):
+        name = folder[1:-1] if folder.startswith('"') else folder
+        if name not in self.folders:
+            return 'NO', [b'no such folder']
+        self.msgs = self.folders[name]
+        return 'OK', [str(len(self.msgs)).encode()]
+
+    def list(self, directory='""', pattern='*'):
+        # hierarchy delimiter '/', '%' matches it as '*' does
+        pattern = pattern.strip('"').replace('%', '*')
+        return 'OK', [
+            f'(\\HasNoChildren) "/" {_quote(name)}'.encode()
+            for name in self.folders if fnmatch.fnmatchcase(name, pattern)
+        ]
+
+    def response(self, code):
+        return code, [str(self.uidvalidity).encode()]
+
+    def logout(self):
+        return 'BYE', [b'']
+
+    def uid(self, command, *args):
+        match command:
+            case 'SEARCH':
+                return 'OK', [self._search(args[1])]
+            case 'FETCH':
+                self.fetches.append((args[0], args[1]))
+                if len(self.fetches) in self.drop_at:
+                    raise imaplib.IMAP4.abort('socket error: EOF')
+                return 'OK', self._fetch(args[0], args[1])
+        raise NotImplementedError(command)
+
+    def _search(self, criteria: str) -> bytes:
+        # 'UID n:*' followed by SINCE, BEFORE, FROM, HEADER, LARGER and
+        # SMALLER criteria. Internal dates are Date headers
+        tokens = [
+            q.replace('\\"', '"').replace('\\\\', '\\') if q or not a else a
+            for q, a in re.findall(r'"((?:[^"\\]|\\.)*)"|(\S+)', criteria)
+        ]
+        uids = sorted(self.msgs)
+        found = set(uids)
+        while tokens:
+            key = tokens.pop(0).upper()
+            match key:
+                case 'UID':
+                    low = int(tokens.pop(0).removesuffix(':*'))
+                    # n:* always matches the highest uid
+                    found &= set(u for u in uids if u >= low) | set(uids[-1:])
+                case 'SINCE' | 'BEFORE':
+                    date = datetime.datetime.strptime(tokens.pop(0), '%d-%b-%Y').date()
+                    found &= {
+                        u for u in found
+                        if (d := _date(self.msgs[u])) is not None
+                        and (d >= date if key == 'SINCE' else d < date)
+                    }
+                case 'FROM':
+                    value = tokens.pop(0).lower()
+                    found &= {u for u in found if value in _header(self.msgs[u], 'from').lower()}
+                case 'HEADER':
+                    name, value = tokens.pop(0), tokens.pop(0).lower()
+                    found &= {
+                        u for u in found
+                        if _headers(_split(self.msgs[u])[0]).get(name) is not None
+                        and value in _header(self.msgs[u], name).lower()
+                    }
+                case 'LARGER':
+                    size = int(tokens.pop(0))
+                    found &= {u for u in found if len(self.msgs[u]) > size}
+                case 'SMALLER':
+                    size = int(tokens.pop(0))
+                    found &= {u for u in found if len(self.msgs[u]) < size}
+                case _:
+                    raise NotImplementedError(key)
+        return b' '.join(str(u).encode() for u in sorted(found))
+
+    def _fetch(self, uids: str, items: str) -> list:
+        data = []
+        for seq, uid in enumerate(int(u) for u in uids.split(',')):
+            text = f'{seq + 1} (UID {uid}'.encode()
+            for name, value in _items(self.msgs[uid], items):
+                if isinstance(value, bytes):
+                    self.sent += len(value)
+                    data.append((text + f' {name} {{{len(value)}}}'.encode(), value))
+                    text = b''
+                else:
+                    text += f' {name} {value}'.encode()
+            data.append(text + b')')
+        return data
+
+
+class FakeImapServer:
+
+    # IMAP server on localhost over plain TCP, users log in with XOAUTH2 and
+    # get their own mailbox (a FakeImapClient). Commands are answered in
+    # order, each delay seconds after its arrival, so that pipelined
+    # commands overlap as they would over a network.
+    # FETCH commands numbered in the drop_at of a mailbox close the
+    # connection (BYE) instead of being answered.
+
+    def __init__(
+        self,
+        mailboxes: dict[str, dict[int, bytes]],
+        *,
+        uidvalidity: int = 1,
+        delay: float = 0.0
+    ):
+        self.mailboxes = {
+            user: FakeImapClient(msgs, uidvalidity=uidvalidity)
+            for user, msgs in mailboxes.items()
+        }
+        self.delay = delay
+        self.port: int | None = None
+        self.connections = 0
+        self.max_connections = 0
+        # commands received and not answered yet, highest seen
+        self.max_inflight = 0
+        self._inflight = 0
+
+    async def __aenter__(self) -> 'FakeImapServer':
+        self._server = await asyncio.start_server(self._serve, '127.0.0.1', 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *exc):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        self.max_connections = max(self.max_connections, self.connections)
+        responses = asyncio.Queue()
+        sending = asyncio.create_task(self._send(responses, writer))
+        mailbox = None
+        writer.write(b'* OK fake IMAP ready\r\n')
+        try:
+            while line := await reader.readline():
+                tag, command, args = (line.decode().rstrip('\r\n').split(' ', 2) + ['', ''])[:3]
+                command = command.upper()
+                if command == 'AUTHENTICATE':
+                    # first command, nothing pending
+                    writer.write(b'+ \r\n')
+                    mailbox = self._login(await reader.readline())
+                    status = 'OK' if mailbox is not None else 'NO'
+                    writer.write(f'{tag} {status} AUTHENTICATE\r\n'.encode())
+                    continue
+                self._inflight += 1
+                self.max_inflight = max(self.max_inflight, self._inflight)
+                responses.put_nowait(asyncio.create_task(
+                    self._respond(mailbox, tag, command, args)
+                ))
+                if command == 'LOGOUT':
+                    break
+            responses.put_nowait(None)
+            await sending
+        finally:
+            self.connections -= 1
+            sending.cancel()
+            writer.close()
+
+    def _login(self, line: bytes) -> FakeImapClient | None:
+        fields = _xoauth2_fields(base64.b64decode(line))
+        mailbox = self.mailboxes.get(fields.get('user'))
+        if mailbox is None or not fields.get('auth', '').startswith('Bearer '):
+            return None
+        token = fields['auth'].removeprefix('Bearer ')
+        if mailbox.tokens is not None and token not in mailbox.tokens:
+            return None
+        return mailbox
+
+    async def _send(self, responses: asyncio.Queue, writer: asyncio.StreamWriter):
+        while (response := await responses.get()) is not None:
+            data = await response
+            self._inflight -= 1
+            writer.write(data)
+            if data is _dropped:
+                # commands in flight are never answered
+                writer.close()
+                return
+            await writer.drain()
+
+    async def _respond(
+        self, mailbox: FakeImapClient | None, tag: str, command: str, args: str
+    ) -> bytes:
+        await asyncio.sleep(self.delay)
+        if command == 'CAPABILITY':
+            return f'* CAPABILITY IMAP4rev1 AUTH=XOAUTH2\r\n{tag} OK CAPABILITY\r\n'.encode()
+        if command == 'LOGOUT':
+            return f'* BYE\r\n{tag} OK LOGOUT\r\n'.encode()
+        if command == 'NOOP':
+            return f'{tag} OK NOOP\r\n'.encode()
+        if mailbox is None:
+            return f'{tag} NO not authenticated\r\n'.encode()
+        if command in ('SELECT', 'EXAMINE'):
+            if args.strip('"') not in mailbox.folders:
+                return f'{tag} NO no such folder\r\n'.encode()
+            return (
+                f'* {len(mailbox.msgs)} EXISTS\r\n'
+                f'* OK [UIDVALIDITY {mailbox.uidvalidity}] UIDs valid\r\n'
+                f'{tag} OK {command}\r\n'
+            ).encode()
+        name, _, args = args.partition(' ')
+        if command == 'UID' and name.upper() == 'SEARCH':
+            _, uids = mailbox.uid('SEARCH', None, args)
+            return b'* SEARCH ' + uids[0] + f'\r\n{tag} OK SEARCH\r\n'.encode()
+        if command == 'UID' and name.upper() == 'FETCH':
+            uids, _, items = args.partition(' ')
+            mailbox.fetches.append((uids, items))
+            if len(mailbox.fetches) in mailbox.drop_at:
+                return _dropped
+            data = b''
+            for seq, uid in enumerate(int(u) for u in uids.split(',')):
+                data += f'* {seq + 1} FETCH (UID {uid}'.encode()
+                for name, value in _items(mailbox.msgs[uid], items):
+                    if isinstance(value, bytes):
+                        mailbox.sent += len(value)
+                        data += f' {name} {{{len(value)}}}\r\n'.encode() + value
+                    else:
+                        data += f' {name} {value}'.encode()
+                data += b')\r\n'
+            return data + f'{tag} OK FETCH\r\n'.encode()
+        return f'{tag} BAD {command}\r\n'.encode()
+
+
+_dropped = b'* BYE connection dropped\r\n'
+
+
+def _xoauth2_fields(auth_string: bytes) -> dict[str, str]:
+    # 'user=...^Aauth=Bearer ...^A^A'
+    return dict(f.split('=', 1) for f in auth_string.decode().split('\x01') if '=' in f)
+
+
+def _items(raw: bytes, items: str) -> list[tuple[str, bytes | str]]:
+    return [
+        _item(raw, item)
+        for item in re.findall(r'BODY\.PEEK\[[^\]]*\](?:<\d+\.\d+>)?|[A-Z0-9.-]+', items)
+    ]
+
+
+def _item(raw: bytes, item: str) -> tuple[str, bytes | str]:
+    if item == 'RFC822':
+        return 'RFC822', raw
+    if item == 'RFC822.SIZE':
+        return item, str(len(raw))
+    if item == 'INTERNALDATE':
+        # the Date header, as searched
+        value = _headers(_split(raw)[0]).get('date')
+        date = email.utils.parsedate_to_datetime(value) if value else datetime.datetime.fromtimestamp(0, datetime.timezone.utc)
+        return item, f'"{date:%d-%b-%Y %H:%M:%S %z}"'
+    if item == 'BODYSTRUCTURE':
+        return item, _bodystructure(raw)
+    if item == 'X-GM-MSGID':
+        return item, str(int.from_bytes(hashlib.sha1(raw).digest()[:8]))
+    m = re.fullmatch(r'BODY\.PEEK\[([^\]]*)\](?:<(\d+)\.(\d+)>)?', item)
+    section, start, length = m.groups()
+    data = _section(raw, section)
+    if start is None:
+        return f'BODY[{section}]', data
+    start, length = int(start), int(length)
+    return f'BODY[{section}]<{start}>', data[start:start + length]
+
+
+def _split(raw: bytes) -> tuple[bytes, bytes]:
+    # headers (blank line included) and body
+    end = easy.email._headers_end(raw, 0, len(raw))
+    return raw[:end], raw[end:]
+
+
+def _headers(headers: bytes) -> email.message.Message:
+    return email.message_from_bytes(headers, policy=email.policy.compat32)
+
+
+def _header(raw: bytes, name: str) -> str:
+    return str(_headers(_split(raw)[0]).get(name, ''))
+
+
+def _date(raw: bytes) -> datetime.date | None:
+    value = _headers(_split(raw)[0]).get('date')
+    return email.utils.parsedate_to_datetime(value).date() if value else None
+
+
+def _subparts(body: bytes, boundary: str) -> list[bytes]:
+    # parts between delimiters, the line break before a delimiter belongs to it
+    delimiter = re.compile(
+        rb'(?:^|\r?\n)--' + re.escape(boundary.encode()) + rb'(--)?[ \t]*(?:\r?\n|$)',
+        re.MULTILINE
+    )
+    parts = []
+    start = None
+    for m in delimiter.finditer(body):
+        if start is not None:
+            parts.append(body[start:m.start()])
+        if m.group(1):
+            break
+        start = m.end()
+    return parts
+
+
+def _section(raw: bytes, section: str) -> bytes:
+    headers, body = _split(raw)
+    if section == 'HEADER':
+        return headers
+    if m := re.fullmatch(r'HEADER\.FIELDS \(([^)]*)\)', section):
+        # matching lines of the headers, folded ones included
+        names = m.group(1).lower().split()
+        lines = re.findall(rb'[^ \t\r\n][^\r\n]*\r?\n(?:[ \t][^\r\n]*\r?\n)*', headers)
+        return b''.join(
+            line for line in lines if line.split(b':')[0].decode().lower() in names
+        ) + b'\r\n'
+    if section == 'TEXT':
+        return body
+    path = section.removesuffix('.MIME')
+    part = raw
+    for n in path.split('.'):
+        headers, body = _split(part)
+        part = _subparts(body, _headers(headers).get_boundary())[int(n) - 1]
+    headers, body = _split(part)
+    return headers if section.endswith('.MIME') else body
+
+
+def _quote(value: str | None) -> str:
+    if value is None:
+        return 'NIL'
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _params(params: list[tuple[str, str]]) -> str:
+    if not params:
+        return 'NIL'
+    return '(' + ' '.join(f'{_quote(k)} {_quote(v)}' for k, v in params) + ')'
+
+
+def _disposition(msg: email.message.Message) -> str:
+    value = msg.get('content-disposition')
+    if value is None:
+        return 'NIL'
+    params = msg.get_params(header='content-disposition')
+    return f'({_quote(params[0][0])} {_params(params[1:])})'
+
+
+def _bodystructure(raw: bytes) -> str:
+    headers, body = _split(raw)
+    msg = _headers(headers)
+    maintype, subtype = msg.get_content_maintype(), msg.get_content_subtype()
+    params = (msg.get_params() or [])[1:]
+    if maintype == 'multipart':
+        parts = ''.join(
+            _bodystructure(p) for p in _subparts(body, msg.get_boundary())
+        )
+        return f'({parts} {_quote(subtype)} {_params(params)} {_disposition(msg)} NIL NIL)'
+    if not params and maintype == 'text':
+        params = [('charset', 'us-ascii')]
+    fields = (
+        f'{_quote(maintype)} {_quote(subtype)} {_params(params)} NIL NIL '
+        f"{_quote(msg.get('content-transfer-encoding', '7bit'))} {len(body)}"
+    )
+    lines = body.count(b'\n')
+    if maintype == 'text':
+        fields += f' {lines}'
+    elif (maintype, subtype) == ('message', 'rfc822'):
+        envelope = '(' + ' '.join(['NIL'] * 10) + ')'
+        fields += f' {envelope} {_bodystructure(body)} {lines}'
+    return f'({fields} NIL {_disposition(msg)} NIL NIL)'
@@ -0,0 +1,186 @@
+import unittest
+import asyncio
+import easy.aioimap
+import tests.fakeimap
+
+
+def _messages(user: str, n: int) -> dict[int, bytes]:
+    return {
+        uid: f'Message-ID: <{uid}@{user}>\r\n\r\nbody {uid}\r\n'.encode()
+        for uid in range(1, n + 1)
+    }
+
+
+class Inbox(easy.aioimap.AsyncImapInbox):
+
+    async def _connect(self):
+        return await easy.aioimap.connect(
+            self._conf['imap_server'], self._conf['imap_port'], ssl_context=None
+        )
+
+
+class TestAsyncImapInbox(unittest.IsolatedAsyncioTestCase):
+
+    def inbox(self, server, user: str, **kwargs) -> Inbox:
+        conf = {'imap_server': '127.0.0.1', 'imap_port': server.port}
+        credentials = {'user': user, 'access_token': 'token'}
+        return Inbox(conf, credentials, **kwargs)
+
+    async def testFetchRaw_pipelined_serverOrder(self):
+        msgs = _messages('a.xyz', 10)
+        async with tests.fakeimap.FakeImapServer({'a@a.xyz': msgs}, delay=0.01) as server:
+            inbox = self.inbox(server, 'a@a.xyz', pipeline=4)
+            fetched = [m async for m in inbox.fetch_raw(batch_size=2)]
+        self.assertEqual(fetched, list(msgs.values()))
+        self.assertGreater(server.max_inflight, 1)
+        self.assertEqual(inbox.checkpoints['INBOX'], {'uidvalidity': 1, 'uid': 10})
+
+    async def testFetchRaw_checkpoint_onlyNewer(self):
+        msgs = _messages('a.xyz', 5)
+        async with tests.fakeimap.FakeImapServer({'a@a.xyz': msgs}) as server:
+            inbox = self.inbox(
+                server, 'a@a.xyz', checkpoints={'INBOX': {'uidvalidity': 1, 'uid': 3}}
+            )
+            fetched = [m async for m in inbox.fetch_raw()]
+            again = [m async for m in inbox.fetch_raw()]
+        self.assertEqual(fetched, [msgs[4], msgs[5]])
+        self.assertEqual(again, [])
+
+    async def testFetchMany_limiter_boundsConnections(self):
+        mailboxes = {f'{u}@a.xyz': _messages(u, 20) for u in 'abcd'}
+        async with tests.fakeimap.FakeImapServer(mailboxes, delay=0.005) as server:
+            limiter = easy.aioimap.ConnectionLimiter({'127.0.0.1': 2})
+            inboxes = {
+                user: self.inbox(server, user, connections=2, ordered=False, limiter=limiter)
+                for user in mailboxes
+            }
+            fetched = {user: [] for user in mailboxes}
+            results = await easy.aioimap.fetch_many(
+                inboxes, lambda user, msgb: fetched[user].append(msgb), batch_size=3
+            )
+        self.assertEqual([r.error for r in results.values()], [None] * len(mailboxes))
+        for user, msgs in mailboxes.items():
+            self.assertCountEqual(fetched[user], msgs.values())
+        self.assertLessEqual(server.max_connections, 2)
+
+    async def testFetchMany_unknownUser_othersFetched(self):
+        async with tests.fakeimap.FakeImapServer({'a@a.xyz': _messages('a', 3)}) as server:
+            inboxes = {user: self.inbox(server, user) for user in ('a@a.xyz', 'b@a.xyz')}
+            fetched = []
+            results = await easy.aioimap.fetch_many(
+                inboxes, lambda user, msgb: fetched.append(msgb)
+            )
+        self.assertIsNone(results['a@a.xyz'].error)
+        self.assertIsInstance(results['b@a.xyz'].error, easy.aioimap.ImapError)
+        self.assertEqual(len(fetched), 3)
+
+    async def testFetchMany_jobs_boundsAccounts(self):
+        mailboxes = {f'{u}@a.xyz': _messages(u, 5) for u in 'abcde'}
+        async with tests.fakeimap.FakeImapServer(mailboxes, delay=0.005) as server:
+            inboxes = {user: self.inbox(server, user) for user in mailboxes}
+            results = await easy.aioimap.fetch_many(
+                inboxes, lambda user, msgb: None, batch_size=1, jobs=2
+            )
+        self.assertEqual(server.max_connections, 2)
+        self.assertTrue(all(r.error is None for r in results.values()))
+
+    async def testFetchRaw_refusedToken_refreshedOnce(self):
+        async with tests.fakeimap.FakeImapServer({'a@a.xyz': _messages('a', 6)}) as server:
+            server.mailboxes['a@a.xyz'].tokens = {'new'}
+            refreshed = []
+
+            def refresh(credentials):
+                refreshed.append(credentials['access_token'])
+                return credentials | {'access_token': 'new'}
+
+            conf = {'imap_server': '127.0.0.1', 'imap_port': server.port}
+            credentials = {'user': 'a@a.xyz', 'access_token': 'old', 'refresh_token': 'r'}
+            inbox = Inbox(conf, credentials, connections=3, refresh=refresh)
+            fetched = [m async for m in inbox.fetch_raw(batch_size=2)]
+        self.assertEqual(len(fetched), 6)
+        self.assertEqual(refreshed, ['old'])
+
+    async def testFetchRaw_droppedConnection_pipelinedBatchesResent(self):
+        msgs = _messages('a.xyz', 12)
+        async with tests.fakeimap.FakeImapServer({'a@a.xyz': msgs}, delay=0.005) as server:
+            mailbox = server.mailboxes['a@a.xyz']
+            mailbox.drop_at = {2, 8}
+            inbox = self.inbox(server, 'a@a.xyz', pipeline=3, backoff=0)
+            fetched = [m async for m in inbox.fetch_raw(batch_size=2)]
+        self.assertEqual(fetched, list(msgs.values()))
+        self.assertEqual(inbox.checkpoints['INBOX'], {'uidvalidity': 1, 'uid': 12})
+        # the dropped batch and those in flight with it are sent again
+        fetches = [uids for uids, _ in mailbox.fetches]
+        self.assertEqual(fetches[:5], ['1,2', '3,4', '5,6', '3,4', '5,6'])
+        self.assertEqual(sorted(set(fetches)), sorted(f'{u},{u + 1}' for u in range(1, 12, 2)))
+
+    async def testFetchRaw_retriesExhausted_raises(self):
+        async with tests.fakeimap.FakeImapServer({'a@a.xyz': _messages('a', 4)}) as server:
+            server.mailboxes['a@a.xyz'].drop_at = {2, 3, 4}
+            inbox = self.inbox(server, 'a@a.xyz', pipeline=1, retries=2, backoff=0)
+            fetched = []
+            with self.assertRaises(ConnectionError):
+                async for m in inbox.fetch_raw(batch_size=2):
+                    fetched.append(m)
+        self.assertEqual(len(fetched), 2)
+        self.assertEqual(inbox.checkpoints['INBOX']['uid'], 2)
+
+    async def testFetchRaw_uidvalidityChanged_raises(self):
+        async with tests.fakeimap.FakeImapServer({'a@a.xyz': _messages('a', 4)}) as server:
+            mailbox = server.mailboxes['a@a.xyz']
+            mailbox.drop_at = {2}
+            inbox = self.inbox(server, 'a@a.xyz', pipeline=1, backoff=0)
+            with self.assertRaisesRegex(easy.aioimap.ImapError, 'UIDVALIDITY'):
+                async for m in inbox.fetch_raw(batch_size=2):
+                    mailbox.uidvalidity = 2
+
+    async def testInvalidated_uidvalidityChanged_folderReported(self):
+        async with tests.fakeimap.FakeImapServer({'a@a.xyz': _messages('a', 3)}, uidvalidity=2) as server:
+            cases = [
+                ({}, []),
+                ({'INBOX': {'uidvalidity': 2, 'uid': 3}}, []),
+                ({'INBOX': {'uidvalidity': 1, 'uid': 3}, 'Missing': {'uidvalidity': 1, 'uid': 1}}, ['INBOX']),
+            ]
+            for checkpoints, expected in cases:
+                with self.subTest(checkpoints=checkpoints):
+                    inbox = self.inbox(server, 'a@a.xyz', checkpoints=checkpoints)
+                    self.assertEqual(await inbox.invalidated(), expected)
+
+    async def testFetchMany_examineRejected_errorReported(self):
+        async with tests.fakeimap.FakeImapServer({'a@a.xyz': _messages('a', 3)}) as server:
+            del server.mailboxes['a@a.xyz'].folders['INBOX']
+            results = await easy.aioimap.fetch_many(
+                {'a@a.xyz': self.inbox(server, 'a@a.xyz')}, lambda user, msgb: None
+            )
+        self.assertIsInstance(results['a@a.xyz'].error, easy.aioimap.ImapError)
+
+    async def testCommand_unreadableResponse_failsPending(self):
+        async def serve(reader, writer):
+            writer.write(b'* OK ready\r\n')
+            await reader.readline()
+            writer.write(b'* ' + b'x' * 100 + b'\r\n')
+            await reader.read()
+            writer.close()
+
+        server = await asyncio.start_server(serve, '127.0.0.1', 0)
+        async with server:
+            reader, writer = await asyncio.open_connection(
+                '127.0.0.1', server.sockets[0].getsockname()[1], limit=32
+            )
+            client = easy.aioimap.AsyncImapClient(reader, writer)
+            await client._start()
+            with self.assertRaises(ConnectionError):
+                await asyncio.wait_for(client.examine('INBOX'), 1)
+            await client.logout()
+
+    async def testThrottle_rate_spacesFetches(self):
+        limiter = easy.aioimap.ConnectionLimiter(rates={'imap.a.xyz': 100})
+        start = asyncio.get_running_loop().time()
+        for _ in range(6):
+            await limiter.throttle('imap.a.xyz')
+            await limiter.throttle('imap.b.xyz')
+        self.assertGreaterEqual(asyncio.get_running_loop().time() - start, 0.045)
+
+
+if __name__ == '__main__':
+    unittest.main()
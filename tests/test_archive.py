@@ -0,0 +1,79 @@
+import unittest
+import pathlib
+import tempfile
+import easy.archive
+import easy.email
+
+
+def _msgs(start: int, n: int) -> list[bytes]:
+    return [
+        f'Message-ID: <{i}@a.xyz>\r\nSubject: {i}\r\n\r\nFrom here\r\n{"body " * i}\r\n'.encode()
+        for i in range(start, start + n)
+    ]
+
+
+class TestArchive(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self._tmpdir.name) / 'test.arc'
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def write(self, msgs: list[bytes], **kwargs):
+        with easy.archive.ArchiveWriter(self.path, block_size=200, **kwargs) as writer:
+            for m in msgs:
+                writer.add(m)
+
+    def testAdd_codecs_readBackUnchanged(self):
+        for codec in easy.archive.CODECS:
+            with self.subTest(codec=codec):
+                self.path.unlink(missing_ok=True)
+                msgs = _msgs(0, 20)
+                self.write(msgs, codec=codec)
+                inbox = easy.email.LocalArchive({'path': str(self.path)})
+                self.assertGreater(len(inbox._reader.index.offsets), 1)
+                self.assertEqual(list(inbox.fetch_raw()), msgs)
+                self.assertEqual(bytes(inbox.get_raw(7)), msgs[7])
+                self.assertEqual(bytes(inbox.get_raw(2)), msgs[2])
+
+    def testFetchHeaders_headersOnly(self):
+        self.write(_msgs(0, 3))
+        inbox = easy.email.LocalArchive({'path': str(self.path)})
+        self.assertEqual(
+            list(inbox.fetch_raw_headers()),
+            [m[:m.index(b'\r\n\r\n') + 4] for m in _msgs(0, 3)]
+        )
+        self.assertEqual([h['subject'] for h in inbox.slice(1, None).fetch_headers()], ['1', '2'])
+
+    def testAdd_appended_previousMessagesKept(self):
+        self.write(_msgs(0, 5), codec='lzma')
+        self.write(_msgs(5, 5))
+        inbox = easy.email.LocalArchive({'path': str(self.path)})
+        self.assertEqual(list(inbox.fetch_raw()), _msgs(0, 10))
+
+    def testAdd_tornBlock_droppedAndOverwritten(self):
+        self.write(_msgs(0, 5))
+        size = self.path.stat().st_size
+        self.write(_msgs(5, 1))
+        # crash while writing the last block
+        with open(self.path, 'r+b') as f:
+            f.truncate(self.path.stat().st_size - 3)
+        inbox = easy.email.LocalArchive({'path': str(self.path)})
+        self.assertEqual(list(inbox.fetch_raw()), _msgs(0, 5))
+        self.write(_msgs(6, 1))
+        self.assertGreater(self.path.stat().st_size, size)
+        inbox = easy.email.LocalArchive({'path': str(self.path)})
+        self.assertEqual(list(inbox.fetch_raw()), _msgs(0, 5) + _msgs(6, 1))
+
+    def testIsArchive_mboxIsNot(self):
+        self.write(_msgs(0, 1))
+        self.assertTrue(easy.archive.is_archive(self.path))
+        mbox = self.path.with_name('test.mbox')
+        mbox.write_bytes(b'From a@a.xyz Fri Mar  1 10:15:00 2024\n\nbody\n')
+        self.assertFalse(easy.archive.is_archive(mbox))
+
+
+if __name__ == '__main__':
+    unittest.main()
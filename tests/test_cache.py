@@ -0,0 +1,83 @@
+import unittest
+import json
+import sqlite3
+import pathlib
+import tempfile
+import easy.cache
+
+
+_features = {'has_list_unsubscribe': 1, 'media_html_ratio': 0.5}
+
+
+class TestFeatureCache(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self._tmpdir.name) / 'cache.sqlite'
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def testGet_afterPut_sameFeatures(self):
+        with easy.cache.FeatureCache(self.path) as cache:
+            key = cache.key(b'raw message')
+            cache.put(key, _features, '<1@a.xyz>')
+        with easy.cache.FeatureCache(self.path) as cache:
+            self.assertEqual(cache.get(key), (_features, '<1@a.xyz>'))
+
+    def testGet_otherVersion_miss(self):
+        with easy.cache.FeatureCache(self.path, version=1) as cache:
+            key = cache.key(b'raw message')
+            cache.put(key, _features, None)
+        with easy.cache.FeatureCache(self.path, version=2) as cache:
+            self.assertIsNone(cache.get(key))
+            self.assertEqual(cache.clear(outdated_only=True), 1)
+
+    def entry_size(self) -> int:
+        return 32 + len(json.dumps(_features))
+
+    def testClose_exceedingSize_leastRecentlyUsedEvicted(self):
+        keys = [easy.cache.FeatureCache.key(bytes([i])) for i in range(5)]
+        with easy.cache.FeatureCache(self.path, max_bytes=2 * self.entry_size()) as cache:
+            for key in keys:
+                cache.put(key, _features, None)
+            # used after every other entry, within the same run
+            cache.get(keys[0])
+        with easy.cache.FeatureCache(self.path) as cache:
+            self.assertEqual(len(cache), 2)
+            self.assertIsNotNone(cache.get(keys[0]))
+            self.assertIsNotNone(cache.get(keys[4]))
+
+    def testPut_exceedingSize_evictedBeforeClose(self):
+        cache = easy.cache.FeatureCache(self.path, max_bytes=2 * self.entry_size(), commit_every=2)
+        try:
+            for i in range(6):
+                cache.put(cache.key(bytes([i])), _features, None)
+            self.assertEqual(len(cache), 2)
+        finally:
+            cache._db.close()
+
+    def testOpen_previousVersion_sizesComputed(self):
+        # caches of previous versions: no size column, used as timestamps
+        db = sqlite3.connect(self.path)
+        db.executescript('''
+            CREATE TABLE features (
+                key BLOB NOT NULL, version INTEGER NOT NULL, features TEXT NOT NULL,
+                msgid TEXT, used INTEGER NOT NULL, PRIMARY KEY (key, version)
+            ) WITHOUT ROWID;
+        ''')
+        key = easy.cache.FeatureCache.key(b'raw message')
+        db.execute('INSERT INTO features VALUES (?, 1, ?, NULL, 1700000000)', (key, json.dumps(_features)))
+        db.commit()
+        db.close()
+        with easy.cache.FeatureCache(self.path, version=1, max_bytes=self.entry_size()) as cache:
+            cache.put(cache.key(b'other message'), _features, None)
+            # uses follow timestamps
+            self.assertEqual(cache.get(key), (_features, None))
+        with easy.cache.FeatureCache(self.path, version=1) as cache:
+            self.assertEqual(len(cache), 1)
+            self.assertIsNotNone(cache.get(key))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import unittest
+import unittest.mock
+import json
+import os
+import pathlib
+import tempfile
+import click
+import cli.main
+import cli.userdata
+
+
+_conf = {
+    'client_id': 'id',
+    'auth_uri': 'https://auth.xyz/auth',
+    'token_uri': 'https://auth.xyz/token',
+    'redirect_uri': 'https://localhost',
+    'scopes': ['mail'],
+    'imap_server': 'imap.a.xyz',
+    'imap_port': 993,
+    'domains': ['a.xyz', 'b.xyz']
+}
+
+
+class TestProviderConfs(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        tmp = pathlib.Path(self._tmpdir.name)
+        self._env = unittest.mock.patch.dict(
+            os.environ, {'XDG_CONFIG_HOME': str(tmp / 'config'), 'XDG_DATA_HOME': str(tmp / 'data')}
+        )
+        self._env.start()
+        self.conf_path = tmp / 'config' / 'easy' / 'a-conf.json'
+        self.conf_path.parent.mkdir(parents=True)
+        self.conf_path.write_text(json.dumps(_conf))
+
+    def tearDown(self):
+        self._env.stop()
+        self._tmpdir.cleanup()
+
+    def testMapByDomain_unchangedConfs_cacheReused(self):
+        self.assertEqual(cli.main.map_provider_conf_by_domain()['b.xyz'], _conf)
+        with unittest.mock.patch.object(cli.main, 'load_provider_confs') as load:
+            self.assertEqual(cli.main.map_provider_conf_by_domain()['a.xyz'], _conf)
+            load.assert_not_called()
+
+    def testMapByDomain_changedConf_rebuilt(self):
+        cli.main.map_provider_conf_by_domain()
+        self.conf_path.write_text(json.dumps(_conf | {'domains': ['c.xyz']}))
+        self.assertEqual(list(cli.main.map_provider_conf_by_domain()), ['c.xyz'])
+        self.conf_path.with_name('b-conf.json').write_text(json.dumps(_conf | {'domains': ['d.xyz']}))
+        self.assertEqual(sorted(cli.main.map_provider_conf_by_domain()), ['c.xyz', 'd.xyz'])
+
+    def testMapByDomain_missingKeys_raises(self):
+        self.conf_path.write_text(json.dumps({'domains': ['a.xyz']}))
+        with self.assertRaisesRegex(click.ClickException, 'a-conf.json: missing auth_uri'):
+            cli.main.map_provider_conf_by_domain()
+
+
+class TestRotateOutput(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self._tmpdir.name) / 'a.mbox'
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def testRotateOutput_download_movedWithIndex(self):
+        self.path.write_bytes(b'From a@a.xyz Fri Mar  1 10:15:00 2024\n\nbody\n')
+        self.path.with_name('a.mbox.idx').write_bytes(b'index')
+        rotated = cli.main.rotate_output(self.path)
+        self.assertFalse(self.path.exists())
+        self.assertTrue(rotated.name.startswith('a.mbox.'))
+        self.assertEqual(rotated.with_name(rotated.name + '.idx').read_bytes(), b'index')
+
+    def testRotateOutput_missingOrEmpty_kept(self):
+        self.assertIsNone(cli.main.rotate_output(self.path))
+        self.path.touch()
+        self.assertIsNone(cli.main.rotate_output(self.path))
+        self.assertTrue(self.path.exists())
+
+    def testOpenWriter_existingFile_appendedOrRefused(self):
+        with cli.main.open_writer(self.path, None) as writer:
+            writer.add(b'Message-ID: <1@a.xyz>\r\n\r\nbody\r\n')
+        with cli.main.open_writer(self.path, None) as writer:
+            writer.add(b'Message-ID: <2@a.xyz>\r\n\r\nbody\r\n')
+        self.assertEqual(self.path.read_bytes().count(b'Message-ID'), 2)
+        with self.assertRaises(click.UsageError):
+            cli.main.open_writer(self.path, 'zlib')
+
+
+class TestUnsafeFileStore(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.store = cli.userdata.UnsafeFileStore(pathlib.Path(self._tmpdir.name))
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def testAppend_records_readInOrder(self):
+        self.assertEqual(self.store.get_records('a@a.xyz#identities'), [])
+        self.store.append('a@a.xyz#identities', [b'1 <1@a.xyz>', b'2 <2@a.xyz>'])
+        self.store.append('a@a.xyz#identities', [])
+        self.store.append('a@a.xyz#identities', [b'X-GM-MSGID 3'])
+        self.assertEqual(
+            self.store.get_records('a@a.xyz#identities'),
+            [b'1 <1@a.xyz>', b'2 <2@a.xyz>', b'X-GM-MSGID 3']
+        )
+        self.store.delete('a@a.xyz#identities')
+        self.assertEqual(self.store.get_records('a@a.xyz#identities'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,339 @@
+import unittest
+import pathlib
+import tempfile
+import mailbox
+import time
+import imaplib
+import collections
+import datetime
+import easy.email
+import easy.mbox
+import tests.fakeimap
+
+
+_mbox_data = (
+    b'From a@a.xyz Fri Mar  1 10:15:00 2024\n'
+    b'Message-ID: <1@a.xyz>\n'
+    b'\n'
+    b'first\n'
+    b'\n'
+    b'From b@b.xyz Fri Mar  1 10:16:00 2024\n'
+    b'Message-ID: <2@b.xyz>\n'
+    b'\n'
+    b'second\n'
+    b'\n'
+    b'\n'
+    b'From c@c.xyz Fri Mar  1 10:17:00 2024\n'
+    b'Message-ID: <3@c.xyz>\n'
+    b'\n'
+    b'third'
+)
+
+
+class TestLocalMbox(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self._tmpdir.name) / 'test.mbox'
+        self.path.write_bytes(_mbox_data)
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def expected_raws(self) -> list[bytes]:
+        mbox = mailbox.mbox(self.path)
+        return [mbox.get_bytes(k) for k in mbox.iterkeys()]
+
+    def testFetchRaw_matchesMailbox(self):
+        inbox = easy.email.LocalMbox({'path': str(self.path)})
+        self.assertEqual(list(inbox.fetch_raw()), self.expected_raws())
+
+    def testFetch_parsesMessages(self):
+        inbox = easy.email.LocalMbox({'path': str(self.path)})
+        msgids = [m['message-id'] for m in inbox.fetch()]
+        self.assertEqual(msgids, ['<1@a.xyz>', '<2@b.xyz>', '<3@c.xyz>'])
+
+    def testSlice_rangeOfMessages(self):
+        inbox = easy.email.LocalMbox({'path': str(self.path)})
+        shard = inbox.slice(1, None)
+        self.assertEqual(len(shard), 2)
+        self.assertEqual(list(shard.fetch_raw()), self.expected_raws()[1:])
+        self.assertEqual(shard.get(-1)['message-id'], '<3@c.xyz>')
+
+    def testFetchRawHeaders_bodiesExcluded(self):
+        inbox = easy.email.LocalMbox({'path': str(self.path)})
+        self.assertEqual(
+            list(inbox.fetch_raw_headers()),
+            [b'Message-ID: <1@a.xyz>\n\n', b'Message-ID: <2@b.xyz>\n\n', b'Message-ID: <3@c.xyz>\n\n']
+        )
+        msgids = [m['message-id'] for m in inbox.fetch_headers()]
+        self.assertEqual(msgids, ['<1@a.xyz>', '<2@b.xyz>', '<3@c.xyz>'])
+
+    def testFetchLazy_bodyLoadedOnDemand(self):
+        inbox = easy.email.LocalMbox({'path': str(self.path)})
+        msgs = list(inbox.fetch_lazy())
+        self.assertEqual(msgs[1]['message-id'], '<2@b.xyz>')
+        self.assertFalse(msgs[1].loaded)
+        self.assertEqual(msgs[1].message.get_content(), 'second\n\n')
+        self.assertTrue(msgs[1].loaded)
+
+    def testEmptyFile_noMessages(self):
+        self.path.write_bytes(b'')
+        inbox = easy.email.LocalMbox({'path': str(self.path)})
+        self.assertEqual(list(inbox.fetch_raw()), [])
+
+    def testSavedIndex_reusedAfterAppend(self):
+        easy.email.LocalMbox({'path': str(self.path)}, save_index=True)
+        self.assertTrue(easy.mbox.index_path(self.path).exists())
+        with open(self.path, 'ab') as f:
+            f.write(b'\n\nFrom d@d.xyz Fri Mar  1 10:18:00 2024\nMessage-ID: <4@d.xyz>\n\nfourth\n')
+        inbox = easy.email.LocalMbox({'path': str(self.path)}, save_index=True)
+        self.assertEqual(list(inbox.fetch_raw()), self.expected_raws())
+        index = easy.mbox.MboxIndex.load(easy.mbox.index_path(self.path))
+        self.assertEqual(len(index), 4)
+
+    def testSavedIndex_rewrittenSameSize_rebuilt(self):
+        easy.email.LocalMbox({'path': str(self.path)}, save_index=True)
+        # a 'From ' line is still found where the last message started
+        rewritten = _mbox_data.replace(b'second\n\n\n', b's\nFrom x\n').replace(b'third', b'THIRD')
+        self.assertEqual(len(rewritten), len(_mbox_data))
+        self.path.write_bytes(rewritten)
+        inbox = easy.email.LocalMbox({'path': str(self.path)}, save_index=True)
+        self.assertEqual(list(inbox.fetch_raw()), self.expected_raws())
+        self.assertEqual(len(inbox), 4)
+
+
+
+def _imap_msgs(n: int) -> dict[int, bytes]:
+    return {uid: f'Message-ID: <{uid}@a.xyz>\r\n\r\nbody\r\n'.encode() for uid in range(1, n + 1)}
+
+
+class TestImapInbox(unittest.TestCase):
+
+    def inbox(self, client, credentials=None, **kwargs) -> easy.email.ImapInbox:
+        self.opened = 0
+        test = self
+
+        class Inbox(easy.email.ImapInbox):
+            def _open(self):
+                test.opened += 1
+                return client
+
+        if credentials is None:
+            credentials = {'user': 'a@a.xyz', 'access_token': 'token'}
+        return Inbox({}, credentials, backoff=0, **kwargs)
+
+    def refresh(self, credentials: dict) -> dict:
+        self.refreshed.append(credentials['access_token'])
+        return credentials | {'access_token': 'new', 'expires_at': time.time() + 3600}
+
+    def setUp(self):
+        self.refreshed = []
+
+    def testFetchRaw_checkpoint_onlyNewer(self):
+        client = tests.fakeimap.FakeImapClient(_imap_msgs(5))
+        checkpoints = {}
+        self.assertEqual(len(list(self.inbox(client, checkpoints=checkpoints).fetch_raw(batch_size=2))), 5)
+        self.assertEqual(checkpoints, {'INBOX': {'uidvalidity': 1, 'uid': 5}})
+        self.assertEqual(list(self.inbox(client, checkpoints=checkpoints).fetch_raw()), [])
+        client.msgs[6] = b'Message-ID: <6@a.xyz>\r\n\r\nbody\r\n'
+        self.assertEqual(list(self.inbox(client, checkpoints=checkpoints).fetch_raw()), [client.msgs[6]])
+        self.assertEqual(checkpoints['INBOX']['uid'], 6)
+
+    def testFetchRawDated_internalDates_timestamps(self):
+        msgs = _imap_msgs(2)
+        msgs[1] = b'Date: Wed, 17 Jul 1996 02:44:25 -0700\r\n' + msgs[1]
+        client = tests.fakeimap.FakeImapClient(msgs)
+        self.assertEqual(
+            list(self.inbox(client).fetch_raw_dated()),
+            [(837596665, msgs[1]), (0, msgs[2])]
+        )
+        self.assertEqual(easy.email._internal_date(b' 7-Jul-1996 02:44:25 +0000'), 836707465)
+        self.assertIsNone(easy.email._internal_date(b'not a date'))
+
+    def testFetchRaw_stopped_checkpointAtLastConsumed(self):
+        client = tests.fakeimap.FakeImapClient(_imap_msgs(6))
+        inbox = self.inbox(client)
+        msgs = inbox.fetch_raw(batch_size=4)
+        for _ in range(3):
+            next(msgs)
+        msgs.close()
+        # a message is consumed once the next one is requested, the rest
+        # of the batch has been fetched, not consumed
+        self.assertEqual(inbox.checkpoints['INBOX']['uid'], 2)
+        inbox = self.inbox(client, checkpoints=inbox.checkpoints)
+        self.assertEqual(list(inbox.fetch_raw()), [client.msgs[u] for u in (3, 4, 5, 6)])
+
+    def testFetchRaw_uidvalidityChanged_fullResync(self):
+        client = tests.fakeimap.FakeImapClient(_imap_msgs(5), uidvalidity=2)
+        inbox = self.inbox(client, checkpoints={'INBOX': {'uidvalidity': 1, 'uid': 3}})
+        self.assertEqual(inbox.invalidated(), ['INBOX'])
+        self.assertEqual(len(list(inbox.fetch_raw())), 5)
+        self.assertEqual(inbox.checkpoints, {'INBOX': {'uidvalidity': 2, 'uid': 5}})
+        self.assertEqual(inbox.invalidated(), [])
+
+    def testFetchRaw_droppedConnection_resumedFromBatch(self):
+        client = tests.fakeimap.FakeImapClient(_imap_msgs(10))
+        client.drop_at = {3}
+        inbox = self.inbox(client)
+        self.assertEqual(list(inbox.fetch_raw(batch_size=2)), list(client.msgs.values()))
+        self.assertEqual(
+            [uids for uids, _ in client.fetches],
+            ['1,2', '3,4', '5,6', '5,6', '7,8', '9,10']
+        )
+        self.assertEqual(self.opened, 2)
+
+    def testFetchRaw_concurrentDrops_eachBatchFetchedOnce(self):
+        client = tests.fakeimap.FakeImapClient(_imap_msgs(10))
+        client.drop_at = {2, 4}
+        inbox = self.inbox(client, connections=3)
+        self.assertEqual(list(inbox.fetch_raw(batch_size=2)), list(client.msgs.values()))
+        fetched = collections.Counter(uids for uids, _ in client.fetches)
+        self.assertEqual(len(fetched), 5)
+        self.assertEqual(sum(fetched.values()), 7)
+
+    def testFetchRaw_retriesExhausted_raises(self):
+        client = tests.fakeimap.FakeImapClient(_imap_msgs(4))
+        client.drop_at = {2, 3, 4}
+        inbox = self.inbox(client, retries=2)
+        with self.assertRaises(imaplib.IMAP4.abort):
+            list(inbox.fetch_raw(batch_size=2))
+        self.assertEqual(inbox.checkpoints['INBOX']['uid'], 2)
+
+    def testConnect_expiredToken_refreshedBeforeLogin(self):
+        client = tests.fakeimap.FakeImapClient(_imap_msgs(4), tokens={'new'})
+        credentials = {
+            'user': 'a@a.xyz', 'access_token': 'old', 'refresh_token': 'r', 'expires_at': time.time() - 1
+        }
+        inbox = self.inbox(client, credentials, refresh=self.refresh)
+        self.assertEqual(len(list(inbox.fetch_raw())), 4)
+        self.assertEqual(self.refreshed, ['old'])
+
+    def testReconnect_refusedToken_refreshedOnce(self):
+        client = tests.fakeimap.FakeImapClient(_imap_msgs(4))
+        credentials = {'user': 'a@a.xyz', 'access_token': 'old', 'refresh_token': 'r'}
+        inbox = self.inbox(client, credentials, refresh=self.refresh)
+        # token revoked while fetching
+        client.tokens = {'new'}
+        client.drop_at = {1}
+        self.assertEqual(len(list(inbox.fetch_raw(batch_size=1))), 4)
+        self.assertEqual(self.refreshed, ['old'])
+
+
+    def testSearchCriteria_filters_imapSyntax(self):
+        criteria = easy.email.search_criteria({
+            'since': datetime.date(2024, 3, 1),
+            'before': datetime.date(2024, 4, 1),
+            'sender': 'news@shop.xyz',
+            'headers': ['List-Unsubscribe'],
+            'larger': 1024,
+        })
+        self.assertEqual(
+            criteria,
+            'SINCE 1-Mar-2024 BEFORE 1-Apr-2024 FROM "news@shop.xyz" '
+            'HEADER "List-Unsubscribe" "" LARGER 1024'
+        )
+        with self.assertRaises(ValueError):
+            easy.email.search_criteria({'sender': 'caffè'})
+
+    def testFetchRaw_search_onlyMatchingFetched(self):
+        msgs = {
+            uid: (
+                f'From: {sender}\r\nDate: {date}\r\n{extra}Message-ID: <{uid}@a.xyz>\r\n\r\nbody\r\n'
+            ).encode()
+            for uid, (sender, date, extra) in enumerate([
+                ('news@shop.xyz', 'Fri, 1 Mar 2024 10:00:00 +0000', 'List-Unsubscribe: <mailto:u@shop.xyz>\r\n'),
+                ('bob@b.xyz', 'Sat, 2 Mar 2024 10:00:00 +0000', ''),
+                ('news@shop.xyz', 'Thu, 1 Feb 2024 10:00:00 +0000', 'List-Unsubscribe: <mailto:u@shop.xyz>\r\n'),
+                ('deals@shop.xyz', 'Sun, 3 Mar 2024 10:00:00 +0000', 'List-Unsubscribe: <mailto:d@shop.xyz>\r\n'),
+            ], start=1)
+        }
+        client = tests.fakeimap.FakeImapClient(msgs)
+        search = {'since': datetime.date(2024, 3, 1), 'headers': ['List-Unsubscribe']}
+        inbox = self.inbox(client, search=search)
+        self.assertEqual(list(inbox.fetch_raw()), [msgs[1], msgs[4]])
+        self.assertEqual(client.fetches, [('1,4', '(RFC822)')])
+        self.assertNotIn('INBOX', inbox.checkpoints)
+        self.assertEqual(len(inbox.checkpoints), 1)
+
+    def testFetchRaw_allFoldersGmail_duplicatesNeverFetched(self):
+        msgs = _imap_msgs(4)
+        client = tests.fakeimap.FakeImapClient(
+            {1: msgs[1], 2: msgs[2]},
+            folders={'Work': {7: msgs[3]}, '[Gmail]/All Mail': msgs},
+            gmail=True
+        )
+        inbox = self.inbox(client, folders=['*'])
+        self.assertEqual(inbox.folders(), ['INBOX', 'Work', '[Gmail]/All Mail'])
+        self.assertEqual(list(inbox.fetch_raw()), list(msgs.values()))
+        self.assertEqual(
+            [uids for uids, items in client.fetches if items == '(RFC822)'],
+            ['1,2', '7', '4']
+        )
+        self.assertEqual(client.sent, sum(len(m) for m in msgs.values()))
+        self.assertEqual(inbox.checkpoints['[Gmail]/All Mail']['uid'], 4)
+
+    def testFetchRaw_folders_duplicatesByMessageIdAndSize(self):
+        msgs = _imap_msgs(2)
+        edited = msgs[2].replace(b'body', b'edited body')
+        anonymous = b'Subject: no id\r\n\r\nbody\r\n'
+        client = tests.fakeimap.FakeImapClient(
+            {1: msgs[1], 2: msgs[2], 3: anonymous},
+            folders={'Archive': {1: msgs[1], 2: edited, 3: anonymous}}
+        )
+        inbox = self.inbox(client, folders=['INBOX', 'Archive'])
+        self.assertEqual(
+            list(inbox.fetch_raw()), [msgs[1], msgs[2], anonymous, edited, anonymous]
+        )
+        self.assertEqual(inbox.checkpoints['Archive']['uid'], 3)
+
+    def testFetchRaw_filedInFolderAfterSync_notFetchedAgain(self):
+        msgs = _imap_msgs(3)
+        for gmail in (True, False):
+            with self.subTest(gmail=gmail):
+                archive = {1: msgs[1]}
+                client = tests.fakeimap.FakeImapClient({1: msgs[1], 2: msgs[2]}, folders={'Archive': archive}, gmail=gmail)
+                inbox = self.inbox(client, folders=['INBOX', 'Archive'])
+                self.assertEqual(list(inbox.fetch_raw()), [msgs[1], msgs[2]])
+                # filed in Archive after the first run
+                archive[2] = msgs[2]
+                archive[3] = msgs[3]
+                inbox = self.inbox(
+                    client, folders=['INBOX', 'Archive'], checkpoints=inbox.checkpoints, identities=inbox.identities
+                )
+                self.assertEqual(list(inbox.fetch_raw()), [msgs[3]])
+                self.assertEqual(len(inbox.identities), 3)
+
+    def testFetchLazy_bodiesLoadedInOtherFolder_ownFolderFetched(self):
+        def folder_msgs(folder: str) -> dict[int, bytes]:
+            return {
+                uid: f'Message-ID: <{uid}@{folder}.xyz>\r\n\r\n{folder} {uid}\r\n'.encode()
+                for uid in (1, 2, 3)
+            }
+
+        for connections in (1, 2):
+            with self.subTest(connections=connections):
+                client = tests.fakeimap.FakeImapClient(
+                    folder_msgs('inbox'), folders={'Archive': folder_msgs('archive')}
+                )
+                inbox = self.inbox(client, folders=['INBOX', 'Archive'], connections=connections)
+                msgs = list(inbox.fetch_lazy(batch_size=2))
+                # the connection drops while loading the first body
+                client.drop_at = {len(client.fetches) + 1}
+                bodies = [m.message.get_content() for m in msgs]
+                self.assertEqual(
+                    bodies,
+                    [f'{f} {u}\r\n' for f in ('inbox', 'archive') for u in (1, 2, 3)]
+                )
+
+    def testFetchLazy_uidvalidityChangedBeforeLoad_raises(self):
+        client = tests.fakeimap.FakeImapClient(_imap_msgs(2), folders={'Archive': _imap_msgs(2)})
+        inbox = self.inbox(client, folders=['INBOX', 'Archive'])
+        msgs = list(inbox.fetch_lazy())
+        client.uidvalidity = 2
+        with self.assertRaisesRegex(imaplib.IMAP4.error, 'UIDVALIDITY'):
+            msgs[0].message
+
+
+if __name__ == '__main__':
+    unittest.main()
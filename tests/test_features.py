@@ -6,6 +6,7 @@ import email.parser
 import email.policy
 import tests.resources.features as testdata
 import easy.features 
+import easy.message
 
 
 class TestFeatures(unittest.TestCase):
@@ -37,6 +38,23 @@ class TestFeatures(unittest.TestCase):
                 features = easy.features.evaluate(email)
                 self.assertEqual(features, expected)
 
+    def testEvaluation_headerFeatures_bodyNotLoaded(self):
+        testdata_path = pathlib.Path(testdata.__path__[0])
+        msg = read_email_from_file(testdata_path / '3.txt')
+        expected = read_features_from_file(testdata_path / '3.json')
+        headers = email.parser.Parser(policy=email.policy.default) \
+                .parsestr(msg.as_string(), headersonly=True)
+        lazy = easy.message.LazyMessage(headers, lambda: msg)
+        features = easy.features.evaluate(lazy, ['has_list_unsubscribe', 'recipients_count'])
+        self.assertEqual(features, {
+            'has_list_unsubscribe': expected['has_list_unsubscribe'],
+            'recipients_count': expected['recipients_count'],
+        })
+        self.assertFalse(lazy.loaded)
+        features = easy.features.evaluate(lazy, ['has_attachment'])
+        self.assertEqual(features, {'has_attachment': expected['has_attachment']})
+        self.assertTrue(lazy.loaded)
+
 
 def find_matching_expected(res_id, testdata_path) -> pathlib.Path | None:
     expected_paths = list(testdata_path.glob('*.json'))
@@ -0,0 +1,38 @@
+import unittest
+import io
+import easy.matrix
+
+
+class TestMatrix(unittest.TestCase):
+
+    def testBuild_rowsAcrossChunks(self):
+        builder = easy.matrix.MatrixBuilder(['a', 'b'], chunk_size=2)
+        for i in range(5):
+            builder.append({'a': i, 'b': i / 2}, f'<{i}@a.xyz>')
+        matrix = builder.build()
+        self.assertEqual(matrix.features.shape, (5, 2))
+        self.assertEqual(matrix.features[4].tolist(), [4.0, 2.0])
+        self.assertEqual(matrix.msgids[4], '<4@a.xyz>')
+
+    def testLoad_afterSave_sameMatrix(self):
+        builder = easy.matrix.MatrixBuilder(['a', 'b'])
+        builder.append({'a': 1, 'b': 0.25})
+        buf = io.BytesIO()
+        easy.matrix.save(buf, builder.build())
+        buf.seek(0)
+        matrix = easy.matrix.load(buf)
+        self.assertEqual(matrix.columns, ['a', 'b'])
+        self.assertEqual(matrix.features.tolist(), [[1.0, 0.25]])
+        self.assertIsNone(matrix.msgids)
+
+    def testBatches_lastBatch_partial(self):
+        rows = [({'a': i, 'b': -i}, f'<{i}@a.xyz>') for i in range(5)]
+        batches = list(easy.matrix.batches(rows, ['b', 'a'], size=2))
+        self.assertEqual([len(f) for f, _ in batches], [2, 2, 1])
+        features, msgids = batches[2]
+        self.assertEqual(features.tolist(), [[-4.0, 4.0]])
+        self.assertEqual(msgids, ['<4@a.xyz>'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+import pathlib
+import tempfile
+import easy.email
+import easy.mbox
+
+
+class TestMboxWriter(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self._tmpdir.name) / 'test.mbox'
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def testAdd_readBackUnchanged(self):
+        msgs = [
+            b'Message-ID: <1@a.xyz>\r\n\r\nFrom here\r\n>From there\r\n',
+            b'Message-ID: <2@b.xyz>\n\nno trailing newline',
+        ]
+        with easy.mbox.MboxWriter(self.path) as writer:
+            for m in msgs:
+                writer.add(m)
+        inbox = easy.email.LocalMbox({'path': str(self.path)})
+        self.assertEqual(list(inbox.fetch_raw()), [
+            b'Message-ID: <1@a.xyz>\n\nFrom here\n>From there\n',
+            b'Message-ID: <2@b.xyz>\n\nno trailing newline\n',
+        ])
+
+    def testAdd_syncEveryMessages(self):
+        synced = []
+        writer = easy.mbox.MboxWriter(
+            self.path, 
+            sync_every=2, 
+            on_sync=lambda: synced.append(self.path.stat().st_size)
+        )
+        for i in range(5):
+            writer.add(f'Message-ID: <{i}@a.xyz>\n\nbody\n'.encode())
+        self.assertEqual(len(synced), 2)
+        writer.close()
+        self.assertEqual(len(synced), 3)
+        self.assertEqual(len(easy.email.LocalMbox({'path': str(self.path)})), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
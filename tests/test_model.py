@@ -0,0 +1,69 @@
+import unittest
+import io
+import pathlib
+import tempfile
+import numpy as np
+import easy.model
+
+
+class TestModel(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self._tmpdir.name) / 'labels.csv'
+        # services have list-unsubscribe, humans have few recipients
+        rng = np.random.default_rng(0)
+        lines = ['has_list_unsubscribe,recipients_count,msgid,label\n']
+        for i in range(2000):
+            label = i % 2
+            unsubscribe = label if rng.random() < 0.9 else 1 - label
+            recipients = rng.integers(1, 3) if label else rng.integers(1, 10)
+            lines.append(f'{unsubscribe},{recipients},<{i}@a.xyz>,{label}\n')
+        self.path.write_text(''.join(lines))
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def testFit_separableColumn_learnsSign(self):
+        columns, chunks = easy.model.labeled_chunks(self.path, chunk_size=300)
+        self.assertEqual(columns, ['has_list_unsubscribe', 'recipients_count'])
+        model = easy.model.fit(chunks, columns, epochs=5, batch_size=64)
+        self.assertGreater(model.weights[0], 0)
+        self.assertLess(model.weights[1], 0)
+
+    def testFit_exceedingMemory_sameModel(self):
+        columns, chunks = easy.model.labeled_chunks(self.path, chunk_size=300)
+        kept = easy.model.fit(chunks, columns, epochs=2)
+        streamed = easy.model.fit(chunks, columns, epochs=2, max_memory=0)
+        np.testing.assert_allclose(kept.weights, streamed.weights)
+
+    def testLabeledChunks_noLabel_raises(self):
+        self.path.write_text('has_list_unsubscribe,recipients_count\n1,2\n')
+        with self.assertRaises(ValueError):
+            easy.model.labeled_chunks(self.path)
+
+    def testLoad_afterSave_sameModel(self):
+        columns, chunks = easy.model.labeled_chunks(self.path)
+        model = easy.model.fit(chunks, columns, epochs=1)
+        buf = io.BytesIO()
+        easy.model.save(buf, model)
+        buf.seek(0)
+        loaded = easy.model.load(buf)
+        self.assertEqual(loaded.columns, model.columns)
+        np.testing.assert_array_equal(loaded.weights, model.weights)
+        self.assertEqual(loaded.bias, model.bias)
+        self.assertEqual(loaded.version, model.version)
+
+    def testScore_standardizationFolded_sameProbability(self):
+        columns, chunks = easy.model.labeled_chunks(self.path)
+        model = easy.model.fit(chunks, columns, epochs=1)
+        features, msgids = next(easy.model.feature_chunks(self.path, columns))
+        z = ((features - model.mean) / model.scale) @ model.weights + model.bias
+        np.testing.assert_allclose(
+            easy.model.score(model, features), 1 / (1 + np.exp(-z)), rtol=1e-5
+        )
+        self.assertEqual(msgids[0], '<0@a.xyz>')
+
+
+if __name__ == '__main__':
+    unittest.main()
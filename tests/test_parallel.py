@@ -0,0 +1,38 @@
+import unittest
+import pathlib
+import email
+import email.policy
+import tests.resources.features as testdata
+import easy.features
+import easy.parallel
+
+
+class TestParallel(unittest.TestCase):
+
+    def setUp(self):
+        testdata_path = pathlib.Path(testdata.__path__[0])
+        input_paths = sorted(testdata_path.glob('*.txt'))
+        # repeated so that results span several chunks
+        self.raws = [p.read_bytes() for p in input_paths] * 5
+
+    def testEvaluateParallel_ordered_matchesEvaluate(self):
+        expected = [
+            easy.features.evaluate(
+                email.message_from_bytes(raw, policy=email.policy.default)
+            ) for raw in self.raws
+        ]
+        results = easy.parallel.evaluate_parallel(
+            self.raws, workers=2, chunk_size=3
+        )
+        self.assertEqual([f for f, _ in results], expected)
+
+    def testEvaluateParallel_unordered_allMessages(self):
+        results = easy.parallel.evaluate_parallel(
+            self.raws, workers=2, chunk_size=3, ordered=False
+        )
+        msgids = [m for _, m in results]
+        self.assertEqual(len(msgids), len(self.raws))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+import pathlib
+import tests.resources.features as testdata
+import easy.features
+import easy.parallel
+import easy.profiling
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        testdata_path = pathlib.Path(testdata.__path__[0])
+        self.raws = [p.read_bytes() for p in sorted(testdata_path.glob('*.txt'))]
+
+    def testEvaluate_everyFeature_timed(self):
+        profiler = easy.profiling.Profiler()
+        for raw in self.raws:
+            _, features, error = profiler.evaluate(raw)
+            self.assertIsNone(error)
+        for name in easy.features.Features.__annotations__:
+            self.assertEqual(len(profiler.times[name]), len(self.raws))
+        self.assertEqual(len(profiler.times['parse']), len(self.raws))
+        self.assertEqual(len(profiler.times['body_analysis']), len(self.raws))
+
+    def testSlowest_moreMessages_keepsSlowest(self):
+        profiler = easy.profiling.Profiler(slowest=2)
+        for i, total in enumerate([0.3, 0.1, 0.5, 0.2]):
+            profiler.record(f'<{i}@a.xyz>', 10, {'parse': total})
+        self.assertEqual(
+            [msgid for _, msgid, _ in profiler.slowest()],
+            ['<2@a.xyz>', '<0@a.xyz>']
+        )
+
+    def testEvaluateParallel_profiler_mergesWorkers(self):
+        profiler = easy.profiling.Profiler()
+        results = list(easy.parallel.evaluate_parallel(
+            self.raws, workers=2, chunk_size=2, profiler=profiler
+        ))
+        self.assertEqual(len(profiler.sizes), len(results))
+        self.assertEqual(len(profiler.times['total']), len(self.raws))
+
+
+if __name__ == '__main__':
+    unittest.main()
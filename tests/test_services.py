@@ -0,0 +1,65 @@
+import unittest
+import email
+import email.policy
+import easy.services
+
+
+def _msg(sender: str, date: str = 'Fri, 01 Mar 2024 10:15:00 +0000', **headers):
+    lines = [f'From: {sender}', f'Date: {date}']
+    lines += [f'{k.replace("_", "-")}: {v}' for k, v in headers.items()]
+    return email.message_from_string('\n'.join(lines) + '\n\n', policy=email.policy.default)
+
+
+class TestServiceAggregator(unittest.TestCase):
+
+    def testAdd_sameDomain_aggregated(self):
+        aggregator = easy.services.aggregate([
+            _msg('news@mail.shop.com', list_unsubscribe='<mailto:u@shop.com>'),
+            _msg('Shop <orders@shop.com>', date='Sat, 02 Mar 2024 10:15:00 +0000'),
+            _msg('friend@other.org'),
+        ])
+        shop = aggregator.top(1)[0]
+        self.assertEqual(shop['domain'], 'shop.com')
+        self.assertEqual(shop['count'], 2)
+        self.assertEqual(shop['error'], 0)
+        self.assertEqual(shop['has_list_unsubscribe'], 1)
+        self.assertEqual(shop['first_seen'], '2024-03-01T10:15:00+00:00')
+        self.assertEqual(shop['last_seen'], '2024-03-02T10:15:00+00:00')
+
+    def testAdd_publicSuffixes_registrableDomains(self):
+        aggregator = easy.services.aggregate([
+            _msg('news@news.bbc.co.uk'),
+            _msg('a@bbc.co.uk'),
+            _msg('offers@tesco.co.uk'),
+            _msg('orders@amazon.com'),
+            _msg('orders@mail.amazon.de'),
+            _msg('a@News.Example.ORG'),
+        ])
+        counts = {s['domain']: s['count'] for s in aggregator.top()}
+        self.assertEqual(
+            counts,
+            {'bbc.co.uk': 2, 'tesco.co.uk': 1, 'amazon.com': 1, 'amazon.de': 1, 'example.org': 1}
+        )
+
+    def testAdd_noSender_skipped(self):
+        msg = email.message_from_string('Subject: x\n\n', policy=email.policy.default)
+        aggregator = easy.services.aggregate([msg, _msg('not an address'), _msg('a@co.uk')])
+        self.assertEqual(len(aggregator), 0)
+        self.assertEqual(aggregator.skipped, 3)
+
+    def testAdd_exceedingMaxDomains_keepsFrequent(self):
+        msgs = []
+        for i in range(50):
+            msgs.append(_msg('a@frequent.com'))
+            msgs.append(_msg(f'a@rare{i}.com'))
+        aggregator = easy.services.aggregate(msgs, max_domains=5)
+        self.assertEqual(len(aggregator), 5)
+        frequent = aggregator.top(1)[0]
+        self.assertEqual(frequent['domain'], 'frequent.com')
+        # count is overestimated by at most error
+        self.assertGreaterEqual(frequent['count'], 50)
+        self.assertLessEqual(frequent['count'] - frequent['error'], 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
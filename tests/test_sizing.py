@@ -0,0 +1,50 @@
+import unittest
+import random
+import email
+import email.message
+import email.policy
+import easy.sizing
+
+
+def _part(data: bytes, cte: str) -> email.message.EmailMessage:
+    m = email.message.EmailMessage()
+    m.set_content(data, 'application', 'octet-stream', cte=cte)
+    return email.message_from_bytes(m.as_bytes(), policy=email.policy.default)
+
+
+class TestSizing(unittest.TestCase):
+
+    def testPayloadSize_encodings_decodedLength(self):
+        r = random.Random(0)
+        for cte in ('base64', 'quoted-printable', '7bit'):
+            for n in (0, 1, 2, 3, 57, 1000):
+                data = bytes(r.randrange(128 if cte == '7bit' else 256) for _ in range(n))
+                if cte == '7bit':
+                    data = data.replace(b'\r', b'')
+                with self.subTest(cte=cte, n=n):
+                    p = _part(data, cte)
+                    self.assertEqual(easy.sizing.payload_size(p), len(p.get_content()))
+
+    def testPayloadSize_invalidBase64_decodedLength(self):
+        p = _part(b'abcdef', 'base64')
+        p.set_payload('YWJj!ZGVm\n')
+        self.assertEqual(easy.sizing.payload_size(p), len(p.get_content()))
+
+    def testTextSize_charsets_encodedLength(self):
+        for s in ('plain', 'caffè €', ''):
+            for charset in (None, 'us-ascii', 'iso-8859-15', 'utf-16'):
+                with self.subTest(s=s, charset=charset):
+                    try:
+                        expected = len(s.encode(charset or 'utf-8'))
+                    except UnicodeEncodeError:
+                        continue
+                    self.assertEqual(easy.sizing.text_size(s, charset), expected)
+
+    def testCleanTextSize_whitespace_collapsed(self):
+        self.assertEqual(easy.sizing.clean_text_size('  a \n\t b  c\n'), len('a b c'))
+        self.assertEqual(easy.sizing.clean_text_size(' \n '), 0)
+        self.assertEqual(easy.sizing.clean_text_size(' è  è ', 'utf-8'), len('è è'.encode()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import unittest
+import pathlib
+import tempfile
+import sqlite3
+import datetime
+import easy.store
+
+
+def _msg(uid: int, sender: str, date: str, extra: str = '') -> bytes:
+    return (
+        f'From: Sender <{sender}>\r\nDate: {date}\r\n{extra}'
+        f'Message-ID: <{uid}@a.xyz>\r\n\r\nbody {uid}\r\n'
+    ).encode()
+
+
+_msgs = [
+    _msg(0, 'news@shop.xyz', 'Fri, 1 Mar 2024 10:00:00 +0000', 'List-Unsubscribe: <mailto:u@shop.xyz>\r\n'),
+    _msg(1, 'bob@b.xyz', 'Sat, 2 Mar 2024 10:00:00 +0000'),
+    _msg(2, 'deals@mail.shop.xyz', 'Mon, 1 Jan 2024 00:30:00 +0100', 'List-Unsubscribe: <mailto:d@shop.xyz>\r\n'),
+    _msg(3, 'alice@notshop.xyz', 'Sun, 3 Mar 2024 10:00:00 +0000'),
+    _msg(4, 'news@shop.xyz', 'not a date'),
+]
+
+
+class TestMessageStore(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self._tmpdir.name) / 'store'
+        with easy.store.MessageStore(self.path, sync_every=2) as store:
+            self.added = [store.add(m) for m in _msgs + _msgs[:2]]
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def query(self, **search) -> list[bytes]:
+        with easy.store.MessageStore(self.path) as store:
+            return list(store.inbox(search).fetch_raw())
+
+    def testAdd_sameMessage_storedOnce(self):
+        self.assertEqual(self.added, [True] * 5 + [False] * 2)
+        with easy.store.MessageStore(self.path) as store:
+            self.assertEqual(len(store), 5)
+            self.assertFalse(store.add(_msgs[3]))
+
+    def testInbox_search_onlyMatching(self):
+        cases = [
+            ({}, _msgs),
+            ({'domain': 'shop.xyz'}, [_msgs[0], _msgs[2], _msgs[4]]),
+            ({'domain': 'mail.shop.xyz'}, [_msgs[2]]),
+            ({'domain': 'shop.xyz', 'since': datetime.date(2024, 1, 1), 'before': datetime.date(2025, 1, 1)}, [_msgs[0]]),
+            ({'sender': 'NEWS@'}, [_msgs[0], _msgs[4]]),
+            # display names match as well
+            ({'sender': 'sender <bob'}, [_msgs[1]]),
+            ({'headers': ['List-Unsubscribe']}, [_msgs[0], _msgs[2]]),
+            ({'larger': len(_msgs[1])}, [m for m in _msgs if len(m) > len(_msgs[1])]),
+            ({'sender': 'x%'}, []),
+        ]
+        for search, expected in cases:
+            with self.subTest(search=search):
+                self.assertEqual(self.query(**search), expected)
+
+    def testInbox_receivedDate_searchedInsteadOfDate(self):
+        received = int(datetime.datetime(2025, 2, 1, tzinfo=datetime.timezone.utc).timestamp())
+        late = _msg(5, 'news@shop.xyz', 'Fri, 1 Mar 2024 10:00:00 +0000')
+        with easy.store.MessageStore(self.path) as store:
+            store.add(late, received=received)
+        self.assertEqual(self.query(since=datetime.date(2025, 1, 1)), [late])
+        self.assertEqual(self.query(since=datetime.date(2024, 3, 1)), [_msgs[0], _msgs[1], _msgs[3], late])
+
+    def testOpen_previousVersion_migrated(self):
+        # version 0: no received and from_header columns
+        db = sqlite3.connect(self.path / 'index.sqlite')
+        db.executescript('''
+            CREATE TABLE old AS SELECT id, key, msgid, date, sender, domain, rdomain, size, list_id FROM messages;
+            DROP TABLE messages;
+            ALTER TABLE old RENAME TO messages;
+            PRAGMA user_version = 0;
+        ''')
+        db.close()
+        self.assertEqual(self.query(sender='sender <bob'), [_msgs[1]])
+        self.assertEqual(self.query(since=datetime.date(2024, 3, 2)), [_msgs[1], _msgs[3]])
+
+    def testAdd_syncedNotIndexed_indexedWhenReopened(self):
+        # crash after the archive has been synced, before the index commit
+        with easy.store.MessageStore(self.path) as store:
+            store._db.execute('DELETE FROM messages WHERE id >= 3')
+            store._db.execute('DELETE FROM header_names WHERE message >= 3')
+            store._db.commit()
+            self.assertEqual(len(store), 3)
+        with easy.store.MessageStore(self.path) as store:
+            self.assertFalse(store.add(_msgs[4]))
+            self.assertTrue(store.add(b'Message-ID: <5@a.xyz>\r\n\r\nbody 5\r\n'))
+            self.assertEqual(store.query({'sender': 'news@'}), [0, 4])
+            self.assertEqual(len(store.inbox()), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
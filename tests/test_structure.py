@@ -0,0 +1,113 @@
+import unittest
+import pathlib
+import email
+import email.policy
+import tests.resources.features as testdata
+import tests.fakeimap
+import easy.email
+import easy.features
+import easy.structure
+
+
+def _crlf(raw: bytes) -> bytes:
+    return raw.replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+
+
+_attachment = _crlf(
+    b'From: a@shop.xyz\n'
+    b'Message-ID: <1@shop.xyz>\n'
+    b'Content-Type: multipart/mixed; boundary="b"\n'
+    b'\n'
+    b'--b\n'
+    b'Content-Type: text/html; charset="utf-8"\n'
+    b'\n'
+    b'<html><head></head><body style="color: red"><a href="https://shop.xyz">x</a></body></html>\n'
+    b'--b\n'
+    b'Content-Type: application/pdf\n'
+    b'Content-Disposition: attachment; filename="invoice.pdf"\n'
+    b'Content-Transfer-Encoding: base64\n'
+    b'\n'
+    + b'\n'.join([b'QUJD' * 19] * 20) + b'\n'
+    b'QUI=\n'
+    b'--b--\n'
+)
+
+
+class TestStructure(unittest.TestCase):
+
+    def inbox(self, raws: list[bytes]) -> easy.email.ImapInbox:
+        self.client = tests.fakeimap.FakeImapClient(
+            {i + 1: raw for i, raw in enumerate(raws)}
+        )
+        client = self.client
+
+        class Inbox(easy.email.ImapInbox):
+            def _connect(self):
+                return client
+
+        return Inbox({}, {})
+
+    def testParseFetch_literals(self):
+        data = [
+            (b'1 (UID 7 BODY[HEADER] {9}', b'From: a\r\n'),
+            (b' BODY[2]<0> {3}', b'abc'),
+            b' BODYSTRUCTURE ("text" "plain" ("charset" "utf-8") NIL NIL "7bit" 3 1 NIL NIL NIL NIL))'
+        ]
+        (seq, items), = easy.structure.parse_fetch(data)
+        self.assertEqual(items['UID'], 7)
+        self.assertEqual(items['BODY[HEADER]'], b'From: a\r\n')
+        self.assertEqual(items['BODY[2]<0>'], b'abc')
+        part = easy.structure.parse_bodystructure(items['BODYSTRUCTURE'])
+        self.assertEqual(part['content_type'], 'text/plain')
+        self.assertEqual(part['params'], {'charset': 'utf-8'})
+        self.assertEqual(part['size'], 3)
+
+    def testFetchStructured_sameFeatures_bodyNotLoaded(self):
+        testdata_path = pathlib.Path(testdata.__path__[0])
+        raws = [_crlf(p.read_bytes()) for p in sorted(testdata_path.glob('*.txt'))]
+        raws.append(_attachment)
+        expected = [
+            easy.features.evaluate(email.message_from_bytes(raw, policy=email.policy.default))
+            for raw in raws
+        ]
+        msgs = list(self.inbox(raws).fetch_structured())
+        self.assertEqual([easy.features.evaluate(m) for m in msgs], expected)
+        self.assertFalse(any(m.loaded for m in msgs))
+
+    def testFetchStructured_base64_edgesFetched(self):
+        msg, = self.inbox([_attachment]).fetch_structured()
+        body = msg.analyze_body()
+        self.assertTrue(body['has_attachment'])
+        self.assertEqual(body['parts'][1]['size'], 20 * 57 + 2)
+        fetched = self.client.fetches[-1][1]
+        self.assertIn('BODY.PEEK[2]<0.256>', fetched)
+        self.assertNotIn('BODY.PEEK[2] ', fetched + ' ')
+
+    def testFetchStructured_irregularBase64_partFetched(self):
+        raw = _attachment.replace(b'QUJD\r\nQUI=', b'QUJDQUJD\r\nQUI=')
+        msg, = self.inbox([raw]).fetch_structured()
+        expected = easy.features.evaluate(
+            email.message_from_bytes(raw, policy=email.policy.default)
+        )
+        self.assertEqual(easy.features.evaluate(msg), expected)
+        self.assertIn('BODY.PEEK[2]', self.client.fetches[-1][1])
+
+    def testFetchStructured_unevenLineWrapping_partFetched(self):
+        # regular sizes modulo line lengths, lines shorter past the first one
+        data = 'QUJD' * 1977 + 'QUI='
+        lines = [data[:76]] + [data[i:i + 40] for i in range(76, len(data), 40)]
+        raw = _attachment.replace(
+            b'\r\n'.join([b'QUJD' * 19] * 20) + b'\r\nQUI=',
+            '\r\n'.join(lines).encode()
+        )
+        msg, = self.inbox([raw]).fetch_structured()
+        expected = easy.features.evaluate(
+            email.message_from_bytes(raw, policy=email.policy.default)
+        )
+        self.assertEqual(msg.analyze_body()['parts'][1]['size'], 5933)
+        self.assertEqual(easy.features.evaluate(msg), expected)
+        self.assertIn('BODY.PEEK[2]', self.client.fetches[-1][1])
+
+
+if __name__ == '__main__':
+    unittest.main()